@@ -1 +1,3 @@
 from .text_wav_datamodule import TextWavDataModule, TextWavDataset, do_preprocess_utterance
+from .samplers import LengthBucketBatchSampler
+from .packed import PackedFeatureWriter, PackedTextWavDataset
@@ -0,0 +1,309 @@
+"""
+Shared-memory cache of preprocessed utterances.
+
+The cache lives in two POSIX shared-memory blocks: an index with one row per utterance,
+and an arena holding the arrays of the cached utterances. Blocks are named after the dataset,
+so all dataloader workers and all training processes on a node (e.g. DDP ranks)
+share the same cache. Insertions are serialized with a file lock, reads take no lock.
+
+If the whole dataset fits in the arena, nothing is ever evicted and reads return views into
+the arena (zero-copy). Otherwise, the arena is used as a ring buffer: the oldest utterances are
+evicted to make room, and reads copy the arrays out and check they weren't evicted meanwhile.
+
+Shared-memory blocks are removed when the last process that created or attached the cache
+(excluding dataloader workers) closes it. Blocks left behind by crashed runs are reused
+by the next run on the same dataset, or can be deleted from `/dev/shm`.
+"""
+
+import fcntl
+import os
+import tempfile
+import weakref
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Optional
+
+import numpy as np
+
+from optispeech.utils import pylogger
+
+from .manifest import ARRAY_NAMES
+
+log = pylogger.get_pylogger(__name__)
+
+CACHE_ARRAY_NAMES = ("phoneme_ids", "text") + ARRAY_NAMES
+CACHE_DTYPES = tuple(np.dtype(dtype) for dtype in ("float32", "float16", "int16", "int64", "int32", "uint8", "float64"))
+# Cached arrays are aligned to this number of bytes
+ALIGNMENT = 64
+_MAGIC = 0x4F505443
+_EMPTY, _FILLED = 0, 1
+HEADER_DTYPE = np.dtype(
+    [
+        ("magic", np.uint32),
+        ("num_items", np.int64),
+        ("size", np.int64),
+        # Next insertion offset, and whether the arena is used as a ring buffer
+        ("head", np.int64),
+        ("evict", np.uint8),
+        # Number of processes (excluding dataloader workers) using the cache
+        ("refcount", np.int32),
+    ]
+)
+ROW_DTYPE = np.dtype(
+    [
+        ("state", np.uint8),
+        # Incremented whenever the utterance is evicted
+        ("generation", np.uint64),
+        ("offset", np.int64),
+        ("nbytes", np.int64),
+        ("sid", np.int32),
+        ("lid", np.int32),
+        *((f"{name}_dtype", np.uint8) for name in CACHE_ARRAY_NAMES),
+        *((f"{name}_shape", np.int64, (2,)) for name in CACHE_ARRAY_NAMES),
+    ]
+)
+
+
+def get_max_cache_size() -> Optional[int]:
+    """Free space of the shared-memory filesystem (in bytes), if known."""
+    try:
+        stats = os.statvfs("/dev/shm")
+    except OSError:
+        return None
+    return stats.f_bavail * stats.f_frsize
+
+
+def _align(nbytes: int) -> int:
+    return -(-nbytes // ALIGNMENT) * ALIGNMENT
+
+
+def _open_shared_memory(name, create=False, size=0):
+    shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    # The cache manages the lifetime of its blocks itself. Otherwise the resource tracker
+    # of the first process to exit would remove them from under the other processes
+    resource_tracker.unregister(shm._name, "shared_memory")  # pylint: disable=protected-access
+    return shm
+
+
+class SharedMemoryCache:
+    """
+    Cache of utterances (phoneme IDs, text, speaker/language IDs and feature arrays) in shared memory.
+
+    Utterances are identified by an integer key in `[0, num_items)`.
+    """
+
+    def __init__(self, name: str, num_items: int, size: int, evict: bool = True):
+        """
+        Creates the cache, or attaches to it if another process already created it.
+
+        Args:
+            name (str): name of the shared-memory blocks
+            num_items (int): number of utterances in the dataset
+            size (int): size of the arena (in bytes), if the cache is created
+            evict (bool): evict utterances when the arena is full, instead of not caching new ones,
+                if the cache is created. Disable it only if the whole dataset fits, so that reads can be zero-copy
+        """
+        self.name = name
+        self.num_items = num_items
+        self._owner_pid = os.getpid()
+        self._lock_file = None
+        self._lock_pid = None
+        with self._lock():
+            index_size = HEADER_DTYPE.itemsize + ROW_DTYPE.itemsize * num_items
+            try:
+                self._index = _open_shared_memory(f"{name}-index", create=True, size=index_size)
+                created = True
+            except FileExistsError:
+                self._index = _open_shared_memory(f"{name}-index")
+                created = False
+            if created:
+                self._arena = self._create_arena(size)
+            else:
+                self._arena = _open_shared_memory(f"{name}-arena")
+            self._map_index()
+            if created or (self.header["magic"] != _MAGIC):
+                self.rows[:] = np.zeros((), dtype=ROW_DTYPE)
+                self.header["num_items"] = num_items
+                self.header["size"] = size if created else self._arena.size
+                self.header["head"] = 0
+                self.header["evict"] = evict
+                self.header["refcount"] = 0
+                self.header["magic"] = _MAGIC
+            elif self.header["num_items"] != num_items:
+                raise ValueError(f"Shared-memory cache `{name}` exists with a different number of utterances")
+            # The process that created the cache decided its size
+            self.size = int(self.header["size"])
+            self.header["refcount"] += 1
+        self._finalizer = weakref.finalize(self, SharedMemoryCache._release, name, self._owner_pid)
+
+    def _create_arena(self, size):
+        try:
+            return _open_shared_memory(f"{self.name}-arena", create=True, size=size)
+        except FileExistsError:
+            # Left behind without its index
+            stale = _open_shared_memory(f"{self.name}-arena")
+            stale.close()
+            resource_tracker.register(stale._name, "shared_memory")  # pylint: disable=protected-access
+            stale.unlink()
+            return _open_shared_memory(f"{self.name}-arena", create=True, size=size)
+
+    def _map_index(self):
+        buffer = self._index.buf
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=buffer)
+        self.rows = np.ndarray((self.num_items,), dtype=ROW_DTYPE, buffer=buffer, offset=HEADER_DTYPE.itemsize)
+
+    def __getstate__(self):
+        # Dataloader workers attach to the blocks by name, without taking a reference
+        state = self.__dict__.copy()
+        for key in ("_index", "_arena", "_lock_file", "_lock_pid", "header", "rows", "_finalizer"):
+            state[key] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._index = _open_shared_memory(f"{self.name}-index")
+        self._arena = _open_shared_memory(f"{self.name}-arena")
+        self._map_index()
+
+    @contextmanager
+    def _lock(self):
+        # Forked processes need their own open file, or they'd share the lock with their parent
+        if self._lock_pid != os.getpid():
+            self._lock_file = open(os.path.join(tempfile.gettempdir(), f"{self.name}.lock"), "a+b")
+            self._lock_pid = os.getpid()
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    @property
+    def evict(self) -> bool:
+        return bool(self.header["evict"])
+
+    def cached_bytes(self) -> int:
+        filled = self.rows["state"] == _FILLED
+        return int(self.rows["nbytes"][filled].sum())
+
+    def __contains__(self, key: int) -> bool:
+        return self.rows[key]["state"] == _FILLED
+
+    def _views(self, row) -> Dict[str, np.ndarray]:
+        arrays = {}
+        offset = int(row["offset"])
+        for name in CACHE_ARRAY_NAMES:
+            dtype = CACHE_DTYPES[row[f"{name}_dtype"]]
+            shape = tuple(int(dim) for dim in row[f"{name}_shape"] if dim >= 0)
+            array = np.ndarray(shape, dtype=dtype, buffer=self._arena.buf, offset=offset)
+            arrays[name] = array
+            offset += _align(array.nbytes)
+        return arrays
+
+    def get(self, key: int):
+        """
+        Returns:
+            (phoneme_ids, text, sid, lid, arrays) if the utterance is cached, else None.
+                `arrays` holds the `wav`, `mel`, `energy` and `pitch` arrays (in their storage precision)
+        """
+        row = self.rows[key].copy()
+        if row["state"] != _FILLED:
+            return None
+        arrays = self._views(row)
+        if self.evict:
+            # The utterance may be evicted at any time: copy it, then check it wasn't
+            arrays = {name: array.copy() for name, array in arrays.items()}
+            if (self.rows[key]["state"] != _FILLED) or (self.rows[key]["generation"] != row["generation"]):
+                return None
+        return self._unpack(row, arrays)
+
+    @staticmethod
+    def _unpack(row, arrays):
+        sid = int(row["sid"]) if row["sid"] >= 0 else None
+        lid = int(row["lid"]) if row["lid"] >= 0 else None
+        text = arrays.pop("text").tobytes().decode("utf-8")
+        phoneme_ids = arrays.pop("phoneme_ids")
+        return phoneme_ids, text, sid, lid, arrays
+
+    def put(self, key: int, phoneme_ids, text: str, sid, lid, arrays) -> bool:
+        """
+        Cache an utterance (`arrays` are stored in their storage precision).
+
+        Returns:
+            bool: whether the utterance is cached
+        """
+        arrays = {
+            "phoneme_ids": np.asarray(phoneme_ids, dtype=np.int64),
+            "text": np.frombuffer(text.encode("utf-8"), dtype=np.uint8),
+            **{name: np.ascontiguousarray(arrays[name]) for name in ARRAY_NAMES},
+        }
+        if any(array.dtype not in CACHE_DTYPES or array.ndim > 2 for array in arrays.values()):
+            return False
+        nbytes = sum(_align(array.nbytes) for array in arrays.values())
+        if nbytes > self.size:
+            return False
+        with self._lock():
+            if self.rows[key]["state"] == _FILLED:
+                return True
+            offset = int(self.header["head"])
+            if offset + nbytes > self.size:
+                if not self.evict:
+                    return False
+                offset = 0
+            if self.evict:
+                self._evict(offset, offset + nbytes)
+            position = offset
+            for name, array in arrays.items():
+                target = np.ndarray(array.shape, dtype=array.dtype, buffer=self._arena.buf, offset=position)
+                target[...] = array
+                position += _align(array.nbytes)
+            row = self.rows[key]
+            row["offset"] = offset
+            row["nbytes"] = nbytes
+            row["sid"] = sid if sid is not None else -1
+            row["lid"] = lid if lid is not None else -1
+            for name, array in arrays.items():
+                row[f"{name}_dtype"] = CACHE_DTYPES.index(array.dtype)
+                row[f"{name}_shape"] = tuple(array.shape) + (-1,) * (2 - array.ndim)
+            # Published last, readers don't take the lock
+            self.rows["state"][key] = _FILLED
+            self.header["head"] = offset + nbytes
+        return True
+
+    def _evict(self, start: int, end: int):
+        rows = self.rows
+        filled = rows["state"] == _FILLED
+        overlapping = filled & (rows["offset"] < end) & (rows["offset"] + rows["nbytes"] > start)
+        # Invalidate before the data is overwritten
+        rows["state"][overlapping] = _EMPTY
+        rows["generation"][overlapping] += 1
+
+    def close(self):
+        """Release this process' reference to the cache, removing it if it was the last one."""
+        self._finalizer()
+
+    @staticmethod
+    def _release(name, owner_pid):
+        if os.getpid() != owner_pid:
+            return
+        lock_path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        with open(lock_path, "a+b") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = _open_shared_memory(f"{name}-index")
+            except FileNotFoundError:
+                return
+            header = np.ndarray((), dtype=HEADER_DTYPE, buffer=index.buf)
+            header["refcount"] -= 1
+            remove = header["refcount"] <= 0
+            del header
+            index.close()
+            if remove:
+                for suffix in ("index", "arena"):
+                    try:
+                        shm = _open_shared_memory(f"{name}-{suffix}")
+                        shm.close()
+                        # `unlink` unregisters the block from the resource tracker
+                        resource_tracker.register(shm._name, "shared_memory")  # pylint: disable=protected-access
+                        shm.unlink()
+                    except FileNotFoundError:
+                        pass
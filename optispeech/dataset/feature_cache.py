@@ -0,0 +1,160 @@
+"""
+Cache of the features extracted from audio files.
+
+Features are keyed by a hash of the audio file's content, under a directory named after a hash of
+the feature extractor's configuration (see `FeatureExtractor.get_config`):
+
+    <cache_dir>/<config hash>/config.json
+    <cache_dir>/<config hash>/<first two characters of the audio hash>/<audio hash>.npz
+
+So features are reused as long as neither the audio nor the feature extractor changes
+(e.g. when only the text processor changes), and are never reused otherwise.
+Directories of configurations that are no longer used can simply be deleted.
+
+`PitchTrackCache` stores the pitch tracks of a pitch extractor the same way, keyed by a hash
+of the waveform they were extracted from.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+from optispeech.utils import pylogger
+
+from .manifest import ARRAY_NAMES
+
+log = pylogger.get_pylogger(__name__)
+
+# Bump to invalidate cached features when the feature extraction code changes
+FEATURE_CACHE_VERSION = 1
+_READ_SIZE = 1024**2
+
+
+def hash_file(filepath) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        while chunk := file.read(_READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_config_dir(cache_dir, config: dict) -> Path:
+    """Directory of the configuration under `cache_dir` (created if needed, with the configuration in `config.json`)."""
+    config_json = json.dumps(config, sort_keys=True, default=str)
+    config_hash = hashlib.sha256(config_json.encode("utf-8")).hexdigest()[:16]
+    config_dir = Path(cache_dir).joinpath(config_hash)
+    config_dir.mkdir(parents=True, exist_ok=True)
+    config_path = config_dir.joinpath("config.json")
+    if not config_path.is_file():
+        tmp_path = config_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(config, file, indent=2, sort_keys=True, default=str)
+        os.replace(tmp_path, config_path)
+    return config_dir
+
+
+def save_atomically(path: Path, save_func):
+    """Write a file with `save_func(file)`, through a temporary file so other processes never read partial files."""
+    path.parent.mkdir(exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as file:
+        save_func(file)
+    os.replace(tmp_path, path)
+
+
+class AudioFeatureCache:
+    """
+    Wraps a `FeatureExtractor`: can be called like it, extracting the features only if they aren't cached yet.
+
+    Several processes can share the cache directory.
+    """
+
+    def __init__(self, cache_dir, feature_extractor):
+        """
+        Args:
+            cache_dir (str|Path): root directory of the cache
+            feature_extractor (FeatureExtractor): initialized feature extractor (see `initialize_components`)
+        """
+        self.feature_extractor = feature_extractor
+        self.config = dict(version=FEATURE_CACHE_VERSION, **feature_extractor.get_config())
+        self.cache_dir = make_config_dir(cache_dir, self.config)
+        self.hits = self.misses = 0
+
+    def get_cache_path(self, audio_hash: str) -> Path:
+        return self.cache_dir.joinpath(audio_hash[:2], audio_hash + ".npz")
+
+    def get(self, audio_path) -> Optional[Tuple[np.ndarray, ...]]:
+        """Cached `(wav, mel, energy, pitch)` of the audio file, if any."""
+        return self._load(self.get_cache_path(hash_file(audio_path)))
+
+    def _load(self, cache_path: Path):
+        try:
+            with np.load(cache_path, allow_pickle=False) as data:
+                return tuple(data[name] for name in ARRAY_NAMES)
+        except FileNotFoundError:
+            return None
+
+    def _save(self, cache_path: Path, features):
+        save_atomically(
+            cache_path, lambda file: np.savez(file, allow_pickle=False, **dict(zip(ARRAY_NAMES, features)))
+        )
+
+    def extract_batch(self, audio_paths, **kwargs) -> list:
+        """Features of several audio files, the uncached ones are extracted as a batch (see `extract_batch`)."""
+        cache_paths = [self.get_cache_path(hash_file(audio_path)) for audio_path in audio_paths]
+        features = [self._load(cache_path) for cache_path in cache_paths]
+        missing = [i for (i, item_features) in enumerate(features) if item_features is None]
+        self.hits += len(features) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            extracted = self.feature_extractor.extract_batch([audio_paths[i] for i in missing], **kwargs)
+            for (i, item_features) in zip(missing, extracted):
+                self._save(cache_paths[i], item_features)
+                features[i] = item_features
+        return features
+
+    def __call__(self, audio_path):
+        cache_path = self.get_cache_path(hash_file(audio_path))
+        features = self._load(cache_path)
+        if features is not None:
+            self.hits += 1
+            return features
+        self.misses += 1
+        features = self.feature_extractor(audio_path)
+        self._save(cache_path, features)
+        return features
+
+
+class PitchTrackCache:
+    """Pitch tracks of a pitch extractor, keyed by a hash of the waveform and of the number of frames."""
+
+    def __init__(self, cache_dir, config: dict):
+        """
+        Args:
+            cache_dir (str|Path): root directory of the cache
+            config (dict): configuration of the pitch extractor (see `BasePitchExtractor.get_config`)
+        """
+        self.config = dict(version=FEATURE_CACHE_VERSION, **config)
+        self.cache_dir = make_config_dir(cache_dir, self.config)
+
+    @staticmethod
+    def get_key(wav: np.ndarray, mel_length: int) -> str:
+        digest = hashlib.sha256(np.ascontiguousarray(wav).tobytes())
+        digest.update(f"{wav.dtype}-{mel_length}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def get_cache_path(self, key: str) -> Path:
+        return self.cache_dir.joinpath(key[:2], key + ".npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        try:
+            return np.load(self.get_cache_path(key), allow_pickle=False)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, pitch: np.ndarray):
+        save_atomically(self.get_cache_path(key), lambda file: np.save(file, pitch, allow_pickle=False))
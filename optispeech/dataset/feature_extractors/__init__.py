@@ -1,4 +1,5 @@
-from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
 
 import librosa
 import numpy as np
@@ -8,7 +9,7 @@ from torchaudio.functional import gain, highpass_biquad, lowpass_biquad
 
 from optispeech.utils import pylogger, trim_or_pad_to_target_length
 from optispeech.utils.audio import spectral_normalize_torch
-from .norm_audio import make_silence_detector, trim_audio
+from .norm_audio import make_silence_detector, trim_audio, trim_audio_batch
 
 
 log = pylogger.get_pylogger(__name__)
@@ -67,10 +68,93 @@ class FeatureExtractor:
             f_max=self.f_max,
         )
         self._silence_detector = make_silence_detector()
-    
+
+    def close(self):
+        """Shut down the workers of the pitch extractor, if any."""
+        if self.pitch_extractor is not None:
+            self.pitch_extractor.close()
+
+    def get_config(self) -> dict:
+        """Class and parameters of the extractor and of its pitch extractor (everything the features depend on)."""
+        if self.pitch_extractor is None:
+            raise RuntimeError("Feature extractor not fully initialized. call `feature_extractor.initialize_components()` first.")
+        return dict(
+            name=f"{type(self).__module__}.{type(self).__qualname__}",
+            sample_rate=self.sample_rate,
+            n_feats=self.n_feats,
+            n_fft=self.n_fft,
+            hop_length=self.hop_length,
+            win_length=self.win_length,
+            f_min=self.f_min,
+            f_max=self.f_max,
+            center=self.center,
+            preemphasis_filter_coef=self.preemphasis_filter_coef,
+            lowpass_freq=self.lowpass_freq,
+            highpass_freq=self.highpass_freq,
+            gain_db=self.gain_db,
+            trim_silence=self.trim_silence,
+            trim_silence_args=dict(self.trim_silence_args) if self.trim_silence_args else None,
+            pitch_extractor=self.pitch_extractor.get_config(),
+        )
+
     def __call__(self, audio_path):
         if self.pitch_extractor is None:
             raise RuntimeError("Feature extractor not fully initialized. call `feature_extractor.initialize_components()` first.")
+        wav = self.load_audio(audio_path)
+        # One STFT, shared by the mel spectrogram and the energy
+        magnitudes = self.get_magnitudes(wav)
+        mel = self.get_mel(wav, magnitudes=magnitudes)
+        mel_length = mel.shape[-1]
+        energy = self.get_energy(wav, mel_length, magnitudes=magnitudes)
+        pitch = self.get_pitch(wav, mel_length)
+        return (wav.squeeze(), mel.squeeze(), energy.squeeze(), pitch.squeeze())
+
+    def extract_batch(self, audio_paths, batch_size: int = 16, num_workers: Optional[int] = None) -> list:
+        """
+        Extract the features of several audio files, as calling the extractor on each of them would.
+
+        Audio files are decoded by `num_workers` threads (with `trim_silence`, the VAD model runs on all of them
+        as one batch). Waveforms are then grouped by length into batches of `batch_size` utterances,
+        and each batch goes through one STFT and one call of the pitch extractor.
+
+        Returns:
+            list: `(wav, mel, energy, pitch)` of each audio file, in order
+        """
+        if self.pitch_extractor is None:
+            raise RuntimeError("Feature extractor not fully initialized. call `feature_extractor.initialize_components()` first.")
+        with ThreadPoolExecutor(num_workers) as executor:
+            if not self.trim_silence:
+                wavs = list(executor.map(self.load_audio, audio_paths))
+            else:
+                # The silence detector runs on all the files as one batch
+                trimmed = trim_audio_batch(
+                    audio_paths=audio_paths,
+                    detector=self._silence_detector,
+                    sample_rate=self.sample_rate,
+                    num_workers=num_workers,
+                    **self.trim_silence_args,
+                )
+                wavs = list(executor.map(self.process_audio, [wav for (wav, __sr) in trimmed]))
+        # Utterances of similar lengths are batched together, to keep padding small
+        order = sorted(range(len(wavs)), key=lambda i: len(wavs[i]))
+        features = [None] * len(wavs)
+        for start in range(0, len(order), batch_size):
+            indices = order[start : start + batch_size]
+            batch = [wavs[i] for i in indices]
+            magnitudes, num_frames = self.get_magnitudes_batch(batch)
+            mels, energies = [], []
+            for (wav, item_magnitudes, item_frames) in zip(batch, magnitudes, num_frames):
+                item_magnitudes = item_magnitudes[None, :, :item_frames]
+                mel = self.get_mel(wav, magnitudes=item_magnitudes)
+                mels.append(mel)
+                energies.append(self.get_energy(wav, mel.shape[-1], magnitudes=item_magnitudes))
+            pitches = self.pitch_extractor.extract_batch(batch, [mel.shape[-1] for mel in mels])
+            for (i, wav, mel, energy, pitch) in zip(indices, batch, mels, energies, pitches):
+                features[i] = (wav.squeeze(), mel.squeeze(), energy.squeeze(), pitch.squeeze())
+        return features
+
+    def load_audio(self, audio_path) -> np.ndarray:
+        """Decode the audio file at the target sample rate, then trim, filter and normalize it."""
         if not self.trim_silence:
             wav, __sr = librosa.load(audio_path, sr=self.sample_rate, mono=True)
         else:
@@ -81,6 +165,10 @@ class FeatureExtractor:
                 **self.trim_silence_args,
             )
         assert __sr == self.sample_rate
+        return self.process_audio(wav)
+
+    def process_audio(self, wav: np.ndarray) -> np.ndarray:
+        """Filter and normalize a waveform (at the target sample rate)."""
         # Enhance higher frequencies (useful with some datasets)
         if self.preemphasis_filter_coef is not None:
             wav = librosa.effects.preemphasis(wav, coef=self.preemphasis_filter_coef)
@@ -96,30 +184,37 @@ class FeatureExtractor:
         if self.gain_db is not None:
             wav = gain(torch.from_numpy(wav.copy()), gain_db=self.gain_db).numpy()
         # Peak normalization
-        wav = librosa.util.normalize(wav)
-        mel = self.get_mel(wav)
-        mel_length = mel.shape[-1]
-        energy = self.get_energy(wav, mel_length)
-        pitch = self.get_pitch(wav, mel_length)
-        return (wav.squeeze(), mel.squeeze(), energy.squeeze(), pitch.squeeze())
+        return librosa.util.normalize(wav)
 
-    def get_mel(self, wav: np.ndarray) -> np.ndarray:
-        raise NotImplementedError
+    def get_magnitudes(self, wav: np.ndarray) -> torch.Tensor:
+        """Magnitude spectrogram of the waveform, of shape `(1, n_fft // 2 + 1, frames)`."""
+        magnitudes, __ = self.get_magnitudes_batch([wav])
+        return magnitudes
+
+    def get_magnitudes_batch(self, wavs: List[np.ndarray]) -> Tuple[torch.Tensor, List[int]]:
+        """
+        Magnitude spectrograms of several waveforms, from one batched STFT.
 
-    def get_energy(self, wav, mel_length):
-        y = torch.from_numpy(wav).unsqueeze(0)
+        Returns:
+            (magnitudes, num_frames): magnitudes of shape `(batch, n_fft // 2 + 1, frames)`,
+                and the number of frames of each waveform (the following frames are padding)
+        """
+        padding = int((self.n_fft - self.hop_length) / 2)
+        padded = []
+        for wav in wavs:
+            y = torch.from_numpy(wav).view(1, 1, -1)
+            y = torch.nn.functional.pad(y, (padding, padding), mode="reflect")
+            # Padded here like `torch.stft` would, so that each waveform is reflected at its own end
+            if self.center:
+                y = torch.nn.functional.pad(y, (self.n_fft // 2, self.n_fft // 2), mode="reflect")
+            padded.append(y.view(-1))
+        num_frames = [1 + (len(y) - self.n_fft) // self.hop_length for y in padded]
+        y = torch.nn.utils.rnn.pad_sequence(padded, batch_first=True)
 
-        hann_win_key = str(y.device)
+        hann_win_key = f"{self.win_length}_{y.device}"
         if hann_win_key not in self.hann_window:
             self.hann_window[hann_win_key] = torch.hann_window(self.win_length).to(y.device)
 
-        y = torch.nn.functional.pad(
-            y.unsqueeze(1),
-            (int((self.n_fft - self.hop_length) / 2), int((self.n_fft - self.hop_length) / 2)),
-            mode="reflect",
-        )
-        y = y.squeeze(1)
-
         spec = torch.view_as_real(
             torch.stft(
                 y,
@@ -127,15 +222,21 @@ class FeatureExtractor:
                 hop_length=self.hop_length,
                 win_length=self.win_length,
                 window=self.hann_window[hann_win_key],
-                center=self.center,
-                pad_mode="reflect",
+                center=False,
                 normalized=False,
                 onesided=True,
                 return_complex=True,
             )
         )
 
-        magnitudes = torch.sqrt(spec.pow(2).sum(-1) + (1e-9))
+        return torch.sqrt(spec.pow(2).sum(-1) + (1e-9)), num_frames
+
+    def get_mel(self, wav: np.ndarray, magnitudes: Optional[torch.Tensor] = None) -> np.ndarray:
+        raise NotImplementedError
+
+    def get_energy(self, wav, mel_length, magnitudes: Optional[torch.Tensor] = None):
+        if magnitudes is None:
+            magnitudes = self.get_magnitudes(wav)
         energy = torch.norm(magnitudes, dim=1)
         energy = trim_or_pad_to_target_length(energy.squeeze(), mel_length)
 
@@ -149,47 +250,24 @@ class CommonFeatureExtractor(FeatureExtractor):
 
     mel_basis = {}
 
-    def get_mel(self, wav):
-        y = torch.from_numpy(wav).unsqueeze(0)
+    def get_mel(self, wav, magnitudes=None):
+        y = torch.from_numpy(wav)
 
         if torch.min(y) < -1.0:
             log.warning(f"min value is {torch.min(y)}")
         if torch.max(y) > 1.0:
             log.warning(f"max value is {torch.max(y)}")
 
-        mel_basis_key = str(self.f_max) + "_" + str(y.device)
-        hann_win_key = str(y.device)
+        if magnitudes is None:
+            magnitudes = self.get_magnitudes(wav)
 
+        mel_basis_key = f"{self.sample_rate}_{self.n_fft}_{self.n_feats}_{self.f_min}_{self.f_max}_{magnitudes.device}"
         if mel_basis_key not in self.mel_basis:
             mel = librosa_mel_fn(
                 sr=self.sample_rate, n_fft=self.n_fft, n_mels=self.n_feats, fmin=self.f_min, fmax=self.f_max
             )
-            self.mel_basis[mel_basis_key] = torch.from_numpy(mel).float().to(y.device)
-            self.hann_window[hann_win_key] = torch.hann_window(self.win_length).to(y.device)
-
-        y = torch.nn.functional.pad(
-            y.unsqueeze(1),
-            (int((self.n_fft - self.hop_length) / 2), int((self.n_fft - self.hop_length) / 2)),
-            mode="reflect",
-        )
-        y = y.squeeze(1)
-
-        spec = torch.view_as_real(
-            torch.stft(
-                y,
-                self.n_fft,
-                hop_length=self.hop_length,
-                win_length=self.win_length,
-                window=self.hann_window[hann_win_key],
-                center=self.center,
-                pad_mode="reflect",
-                normalized=False,
-                onesided=True,
-                return_complex=True,
-            )
-        )
+            self.mel_basis[mel_basis_key] = torch.from_numpy(mel).float().to(magnitudes.device)
 
-        magnitudes = torch.sqrt(spec.pow(2).sum(-1) + (1e-9))
         spec = torch.matmul(self.mel_basis[mel_basis_key], magnitudes)
         spec = spectral_normalize_torch(spec)
         return spec.squeeze().cpu().numpy()
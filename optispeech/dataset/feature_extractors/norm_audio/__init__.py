@@ -1,14 +1,18 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import librosa
 import numpy as np
 import torch
 
-from .trim import trim_silence
+from .trim import trim_silence, trim_silence_batch
 from .vad import SileroVoiceActivityDetector
 
 _DIR = Path(__file__).parent
+# The VAD model works on 16khz
+VAD_SAMPLE_RATE = 16000
 
 
 def make_silence_detector() -> SileroVoiceActivityDetector:
@@ -16,6 +20,15 @@ def make_silence_detector() -> SileroVoiceActivityDetector:
     return SileroVoiceActivityDetector(silence_model)
 
 
+def decode_audio(audio_path: Path, sample_rate: int) -> Tuple[np.array, np.array]:
+    """Decode the audio file once, and resample it for the VAD model and to `sample_rate`."""
+    # NOTE: audio is already in [-1, 1] coming from librosa
+    audio, native_sample_rate = librosa.load(path=audio_path, sr=None)
+    audio_16khz = librosa.resample(audio, orig_sr=native_sample_rate, target_sr=VAD_SAMPLE_RATE)
+    audio = librosa.resample(audio, orig_sr=native_sample_rate, target_sr=sample_rate)
+    return audio_16khz, audio
+
+
 def trim_audio(
     audio_path: Path,
     detector: SileroVoiceActivityDetector,
@@ -25,27 +38,48 @@ def trim_audio(
     silence_keep_chunks_before: int = 2,
     silence_keep_chunks_after: int = 2,
 ) -> Tuple[np.array, int]:
-    # The VAD model works on 16khz, so we determine the portion of audio
-    # to keep and then just load that with librosa.
-    vad_sample_rate = 16000
-    audio_16khz, _sr = librosa.load(path=audio_path, sr=vad_sample_rate)
+    return trim_audio_batch(
+        [audio_path],
+        detector,
+        sample_rate,
+        silence_threshold=silence_threshold,
+        silence_samples_per_chunk=silence_samples_per_chunk,
+        silence_keep_chunks_before=silence_keep_chunks_before,
+        silence_keep_chunks_after=silence_keep_chunks_after,
+    )[0]
+
+
+def trim_audio_batch(
+    audio_paths: List[Path],
+    detector: SileroVoiceActivityDetector,
+    sample_rate: int,
+    silence_threshold: float = 0.2,
+    silence_samples_per_chunk: int = 480,
+    silence_keep_chunks_before: int = 2,
+    silence_keep_chunks_after: int = 2,
+    num_workers: Optional[int] = None,
+) -> List[Tuple[np.array, int]]:
+    """
+    Trim the silence at the start and end of several audio files.
 
-    offset_sec, duration_sec = trim_silence(
-        audio_16khz,
+    Files are decoded by `num_workers` threads, then the VAD model runs on all of them as one batch.
+    """
+    with ThreadPoolExecutor(num_workers) as executor:
+        decoded = list(executor.map(functools.partial(decode_audio, sample_rate=sample_rate), audio_paths))
+
+    trim_ranges = trim_silence_batch(
+        [audio_16khz for (audio_16khz, __) in decoded],
         detector,
         threshold=silence_threshold,
         samples_per_chunk=silence_samples_per_chunk,
-        sample_rate=vad_sample_rate,
+        sample_rate=VAD_SAMPLE_RATE,
         keep_chunks_before=silence_keep_chunks_before,
         keep_chunks_after=silence_keep_chunks_after,
     )
 
-    # NOTE: audio is already in [-1, 1] coming from librosa
-    audio_norm_array, _sr = librosa.load(
-        path=audio_path,
-        sr=sample_rate,
-        offset=offset_sec,
-        duration=duration_sec,
-    )
-
-    return audio_norm_array, _sr
+    trimmed = []
+    for ((__, audio), (offset_sec, duration_sec)) in zip(decoded, trim_ranges):
+        start = int(offset_sec * sample_rate)
+        end = start + int(duration_sec * sample_rate) if duration_sec is not None else None
+        trimmed.append((audio[start:end], sample_rate))
+    return trimmed
@@ -1,4 +1,4 @@
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 import numpy as np
 
@@ -15,36 +15,61 @@ def trim_silence(
     keep_chunks_after: int = 2,
 ) -> Tuple[float, Optional[float]]:
     """Returns the offset/duration of trimmed audio in seconds"""
+    return trim_silence_batch(
+        [audio_array],
+        detector,
+        threshold=threshold,
+        samples_per_chunk=samples_per_chunk,
+        sample_rate=sample_rate,
+        keep_chunks_before=keep_chunks_before,
+        keep_chunks_after=keep_chunks_after,
+    )[0]
+
+
+def trim_silence_batch(
+    audio_arrays: List[np.ndarray],
+    detector: SileroVoiceActivityDetector,
+    threshold: float = 0.2,
+    samples_per_chunk=480,
+    sample_rate=16000,
+    keep_chunks_before: int = 2,
+    keep_chunks_after: int = 2,
+) -> List[Tuple[float, Optional[float]]]:
+    """Returns the offset/duration of trimmed audio in seconds, for each audio array (detected as one batch)"""
+    speech_probs = detector.get_speech_probs(audio_arrays, samples_per_chunk=samples_per_chunk, sample_rate=sample_rate)
+    trim_ranges = []
+    for (audio_array, probs) in zip(audio_arrays, speech_probs):
+        # The last chunk (even if full) is never looked at
+        num_chunks = max(len(audio_array) - 1, 0) // samples_per_chunk
+        trim_ranges.append(
+            get_trim_range(
+                probs[:num_chunks] >= threshold,
+                samples_per_chunk=samples_per_chunk,
+                sample_rate=sample_rate,
+                keep_chunks_before=keep_chunks_before,
+                keep_chunks_after=keep_chunks_after,
+            )
+        )
+    return trim_ranges
+
+
+def get_trim_range(
+    is_speech: np.ndarray,
+    samples_per_chunk=480,
+    sample_rate=16000,
+    keep_chunks_before: int = 2,
+    keep_chunks_after: int = 2,
+) -> Tuple[float, Optional[float]]:
+    """Returns the offset/duration in seconds of the main block of speech, given whether each chunk is speech"""
     offset_sec: float = 0.0
     duration_sec: Optional[float] = None
-    first_chunk: Optional[int] = None
-    last_chunk: Optional[int] = None
     seconds_per_chunk: float = samples_per_chunk / sample_rate
 
-    chunk = audio_array[:samples_per_chunk]
-    audio_array = audio_array[samples_per_chunk:]
-    chunk_idx: int = 0
-
-    # Determine main block of speech
-    while len(audio_array) > 0:
-        prob = detector(chunk, sample_rate=sample_rate)
-        is_speech = prob >= threshold
-
-        if is_speech:
-            if first_chunk is None:
-                # First speech
-                first_chunk = chunk_idx
-            else:
-                # Last speech so far
-                last_chunk = chunk_idx
-
-        chunk = audio_array[:samples_per_chunk]
-        audio_array = audio_array[samples_per_chunk:]
-        chunk_idx += 1
-
-    if (first_chunk is not None) and (last_chunk is not None):
-        first_chunk = max(0, first_chunk - keep_chunks_before)
-        last_chunk = min(chunk_idx, last_chunk + keep_chunks_after)
+    # Determine main block of speech (needs more than one chunk of speech)
+    speech_chunks = np.flatnonzero(is_speech)
+    if len(speech_chunks) > 1:
+        first_chunk = max(0, int(speech_chunks[0]) - keep_chunks_before)
+        last_chunk = min(len(is_speech), int(speech_chunks[-1]) + keep_chunks_after)
 
         # Compute offset/duration
         offset_sec = first_chunk * seconds_per_chunk
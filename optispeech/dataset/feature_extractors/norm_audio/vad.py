@@ -2,6 +2,7 @@ import typing
 from pathlib import Path
 
 import numpy as np
+import onnx
 import onnxruntime
 
 
@@ -41,10 +42,25 @@ class SileroVoiceActivityDetector:
     def __init__(self, onnx_path: typing.Union[str, Path]):
         onnx_path = str(onnx_path)
 
-        self.session = WrapInferenceSession(onnx_path)
+        self.session = WrapInferenceSession(self._with_batch_dim(onnx_path))
         self.session.intra_op_num_threads = 1
         self.session.inter_op_num_threads = 1
 
+        self.reset_states()
+
+    @staticmethod
+    def _with_batch_dim(onnx_path: str) -> bytes:
+        """The model, with a dynamic batch dimension instead of a batch size of 1."""
+        model = onnx.load(onnx_path)
+        for value in [*model.graph.input, *model.graph.output]:
+            # Batch dimension of the audio and the output, or of the recurrent state
+            batch_axis = 0 if value.name in ("input", "output") else 1
+            batch_dim = value.type.tensor_type.shape.dim[batch_axis]
+            batch_dim.ClearField("dim_value")
+            batch_dim.dim_param = "batch"
+        return model.SerializeToString()
+
+    def reset_states(self):
         self._h = np.zeros((2, 1, 64)).astype("float32")
         self._c = np.zeros((2, 1, 64)).astype("float32")
 
@@ -77,3 +93,41 @@ class SileroVoiceActivityDetector:
         out = out.squeeze(2)[:, 1]  # make output type match JIT analog
 
         return out
+
+    def get_speech_probs(
+        self, audio_arrays: typing.List[np.ndarray], samples_per_chunk: int = 480, sample_rate: int = 16000
+    ) -> typing.List[np.ndarray]:
+        """Return the probability of speech in each (full) chunk of several 16Khz audio arrays.
+
+        Each array starts from a fresh state. The arrays are run as one batch, a chunk at a time.
+        """
+        if sample_rate != 16000:
+            raise ValueError("Only 16Khz audio is supported")
+
+        num_chunks = [len(audio_array) // samples_per_chunk for audio_array in audio_arrays]
+        # By decreasing length, so that the arrays that still have chunks are always the first ones
+        order = sorted(range(len(audio_arrays)), key=lambda i: -num_chunks[i])
+        chunks = np.zeros((len(order), max(num_chunks, default=0), samples_per_chunk), dtype=np.float32)
+        for (row, i) in enumerate(order):
+            chunks[row, : num_chunks[i]] = audio_arrays[i][: num_chunks[i] * samples_per_chunk].reshape(
+                -1, samples_per_chunk
+            )
+        probs = np.zeros(chunks.shape[:2], dtype=np.float32)
+        h = np.zeros((2, len(order), 64), dtype=np.float32)
+        c = np.zeros((2, len(order), 64), dtype=np.float32)
+        active = len(order)
+        for chunk_idx in range(chunks.shape[1]):
+            while num_chunks[order[active - 1]] <= chunk_idx:
+                active -= 1
+            ort_inputs = {
+                "input": chunks[:active, chunk_idx],
+                "h0": np.ascontiguousarray(h[:, :active]),
+                "c0": np.ascontiguousarray(c[:, :active]),
+            }
+            out, h[:, :active], c[:, :active] = self.session.run(None, ort_inputs)
+            probs[:active, chunk_idx] = out[:, 1, 0]
+
+        speech_probs = [None] * len(audio_arrays)
+        for (row, i) in enumerate(order):
+            speech_probs[i] = probs[row, : num_chunks[i]]
+        return speech_probs
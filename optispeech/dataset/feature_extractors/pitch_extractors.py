@@ -1,7 +1,9 @@
 import dataclasses
+import multiprocessing
 import typing
 import warnings
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
 
 import librosa
@@ -13,6 +15,7 @@ import penn
 import pyworld as pw
 from scipy.interpolate import interp1d
 
+from optispeech.dataset.feature_cache import PitchTrackCache
 from optispeech.vendor.jdc import load_F0_model
 from optispeech.utils import pylogger, trim_or_pad_to_target_length
 
@@ -39,6 +42,17 @@ class BasePitchExtractor(ABC):
     def __call__(self, wav: np.ndarray, mel_length: int) -> np.ndarray:
         """Extract pitch."""
 
+    def extract_batch(self, wavs: typing.List[np.ndarray], mel_lengths: typing.List[int]) -> typing.List[np.ndarray]:
+        """Extract the pitch of several waveforms (extractors that can run batched override this)."""
+        return [self(wav, mel_length) for (wav, mel_length) in zip(wavs, mel_lengths)]
+
+    def close(self):
+        """Release the workers of the extractor, if any."""
+
+    def get_config(self) -> dict:
+        """Class and parameters of the extractor."""
+        return dict(name=f"{type(self).__module__}.{type(self).__qualname__}", **dataclasses.asdict(self))
+
     def __getstate__(self):
         return dataclasses.asdict(self)
 
@@ -111,7 +125,12 @@ class PENNPitchExtractor(BasePitchExtractor):
 
 @dataclass
 class JDCPitchExtractor(BasePitchExtractor):
-    """https://github.com/yl4579/StyleTTS2/tree/main/Utils/JDC"""
+    """
+    https://github.com/yl4579/StyleTTS2/tree/main/Utils/JDC
+
+    Utterances are not batched: the convolutions and the BiLSTM would see the padding of the
+    shorter ones, making their pitch (and the cached features) depend on the rest of the batch.
+    """
 
     def __post_init__(self):
         self.jdc_model = load_F0_model()
@@ -145,7 +164,10 @@ class JDCPitchExtractor(BasePitchExtractor):
 @dataclass
 class CrepePitchExtractor(BasePitchExtractor):
     """https://github.com/maxrmorrison/torchcrepe"""
-    
+
+    # Frames per call of the model
+    CREPE_BATCH_SIZE: typing.ClassVar[int] = 1024
+
     def __post_init__(self):
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.pe_fmin = self.f_min
@@ -199,14 +221,18 @@ class CrepePitchExtractor(BasePitchExtractor):
             f0_max,
             pad=True,
             model="full",
-            batch_size=1024,
+            batch_size=CrepePitchExtractor.CREPE_BATCH_SIZE,
             device=device,
             return_periodicity=True,
         )
 
+        return CrepePitchExtractor.filter_f0(f0, pd, audio_16k_torch, hop_length_new, threshold)
+
+    @staticmethod
+    def filter_f0(f0, pd, audio_16k, hop_length_new, threshold=0.3):
         # Filter, de-silence, set up threshold for unvoiced part
         pd = torchcrepe.filter.median(pd, 3)
-        pd = torchcrepe.threshold.Silence(-60.0)(pd, audio_16k_torch, 16000, hop_length_new)
+        pd = torchcrepe.threshold.Silence(-60.0)(pd, audio_16k, 16000, hop_length_new)
         f0 = torchcrepe.threshold.At(threshold)(f0, pd)
         f0 = torchcrepe.filter.mean(f0, 3)
         
@@ -214,9 +240,60 @@ class CrepePitchExtractor(BasePitchExtractor):
         f0 = torch.where(torch.isnan(f0), torch.full_like(f0, 0), f0)
         return f0
 
+    def extract_batch(self, wavs, mel_lengths):
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        hop_length_new = int((self.hop_length / self.sample_rate) * 16000.0)
+        audios_16k = [
+            torch.FloatTensor(librosa.resample(wav, orig_sr=self.sample_rate, target_sr=16000)).unsqueeze(0).to(device)
+            for wav in wavs
+        ]
+        # Crepe works on independent frames: the frames of all the utterances go through the model together
+        frames = [
+            torch.cat(list(torchcrepe.preprocess(audio, 16000, hop_length_new, device=device, pad=True)))
+            for audio in audios_16k
+        ]
+        with torch.no_grad():
+            probabilities = torch.cat(
+                [
+                    torchcrepe.infer(batch_frames, model="full", device=device)
+                    for batch_frames in torch.cat(frames).split(self.CREPE_BATCH_SIZE)
+                ]
+            )
+        pitches = []
+        for (audio_16k, item_probabilities, mel_length) in zip(
+            audios_16k, probabilities.split([len(item_frames) for item_frames in frames]), mel_lengths
+        ):
+            # Decoded in chunks, like `torchcrepe.predict`
+            f0, pd = zip(
+                *(
+                    torchcrepe.postprocess(
+                        chunk.reshape(1, -1, torchcrepe.PITCH_BINS).transpose(1, 2),
+                        self.pe_fmin,
+                        self.pe_fmax,
+                        torchcrepe.decode.viterbi,
+                        return_periodicity=True,
+                    )
+                    for chunk in item_probabilities.split(self.CREPE_BATCH_SIZE)
+                )
+            )
+            f0 = self.filter_f0(torch.cat(f0, 1), torch.cat(pd, 1), audio_16k, hop_length_new)
+            f0 = f0.detach().cpu().numpy().squeeze()
+            pitches.append(trim_or_pad_to_target_length(f0, mel_length))
+        return pitches
+
 
 @dataclass
 class EnsemblePitchExtractor(BasePitchExtractor):
+    """
+    Weighted average of the pitch of several extractors.
+
+    Members run concurrently: pyworld members in `num_processes` worker processes (pyworld holds the GIL),
+    neural members in threads. Each preprocessing worker starts its own processes, so preprocessing
+    runs `n_workers × num_processes` of them; `close` shuts them down. With `cache_dir`, the pitch
+    track of each member is persisted, so that changing the scores in `extractor_classes` or the
+    `uv_detector` blends the cached tracks again instead of extracting them again.
+    """
+
     # cls -> voiced-reliability score
     extractor_classes = {
         DIOPitchExtractor: 0.75,
@@ -224,29 +301,98 @@ class EnsemblePitchExtractor(BasePitchExtractor):
         JDCPitchExtractor: 0.15,
         CrepePitchExtractor: 0.02,
     }
+    # Class name of the member whose pitch decides which frames are unvoiced
+    uv_detector: str = "JDCPitchExtractor"
+    # Directory to persist the pitch tracks of the members in
+    cache_dir: typing.Optional[str] = None
+    # Worker processes for the pyworld members (0 to run them in this process)
+    num_processes: int = 1
 
     def __post_init__(self):
-        extractor_kw = dataclasses.asdict(self)
+        extractor_kw = {field.name: getattr(self, field.name) for field in dataclasses.fields(BasePitchExtractor)}
         self._extractors = [
             (ex_cls(**extractor_kw), score)
             for (ex_cls, score) in self.extractor_classes.items()
         ]
+        member_names = [type(extractor).__name__ for (extractor, score) in self._extractors]
+        if self.uv_detector not in member_names:
+            raise ValueError(f"UV detector `{self.uv_detector}` is not one of the members: {member_names}")
+        self._uv_detector_index = member_names.index(self.uv_detector)
         self.uv_threshold = self.f_min // 3.5
+        self._caches = None
+        if self.cache_dir is not None:
+            self._caches = [
+                PitchTrackCache(self.cache_dir, extractor.get_config()) for (extractor, score) in self._extractors
+            ]
+        # Started on first use
+        self._thread_pool = self._process_pool = None
+
+    def get_config(self) -> dict:
+        config = super().get_config()
+        # Where the members run and are cached doesn't change the pitch
+        del config["cache_dir"], config["num_processes"]
+        config["members"] = [dict(extractor.get_config(), score=score) for (extractor, score) in self._extractors]
+        return config
 
     def __call__(self, wav, mel_length):
-        preds = []
-        weights = []
-        for (extractor, score) in self._extractors:
-            weights.append(score)
-            ptch = extractor(wav, mel_length)
-            preds.append(ptch)
+        return self.extract_batch([wav], [mel_length])[0]
+
+    def extract_batch(self, wavs, mel_lengths):
+        member_preds = self.extract_members(wavs, mel_lengths)
+        return [self.blend(preds) for preds in zip(*member_preds)]
+
+    def extract_members(self, wavs, mel_lengths) -> typing.List[typing.List[np.ndarray]]:
+        """Pitch of the waveforms from each member (from the cache, if any)."""
+        member_preds = [[None] * len(wavs) for __ in self._extractors]
+        cache_keys = []
+        if self._caches is not None:
+            cache_keys = [PitchTrackCache.get_key(wav, mel_length) for (wav, mel_length) in zip(wavs, mel_lengths)]
+            for (preds, cache) in zip(member_preds, self._caches):
+                for (i, key) in enumerate(cache_keys):
+                    preds[i] = cache.get(key)
+        futures = []
+        for (m, (extractor, score)) in enumerate(self._extractors):
+            missing = [i for (i, pred) in enumerate(member_preds[m]) if pred is None]
+            if not missing:
+                continue
+            args = ([wavs[i] for i in missing], [mel_lengths[i] for i in missing])
+            futures.append((m, missing, self._get_executor(extractor).submit(extractor.extract_batch, *args)))
+        for (m, missing, future) in futures:
+            for (i, pred) in zip(missing, future.result()):
+                member_preds[m][i] = pred
+                if self._caches is not None:
+                    self._caches[m].put(cache_keys[i], pred)
+        return member_preds
+
+    def _get_executor(self, extractor):
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(len(self._extractors))
+        if not isinstance(extractor, DIOPitchExtractor) or self.num_processes < 1:
+            return self._thread_pool
+        if self._process_pool is None:
+            # Spawned, forking a process that runs torch threads isn't safe
+            context = multiprocessing.get_context("spawn")
+            self._process_pool = ProcessPoolExecutor(self.num_processes, mp_context=context)
+        return self._process_pool
+
+    def close(self, wait: bool = True):
+        """Shut down the worker threads and processes (they are started again on the next use)."""
+        for pool in (getattr(self, "_thread_pool", None), getattr(self, "_process_pool", None)):
+            if pool is not None:
+                pool.shutdown(wait=wait)
+        self._thread_pool = self._process_pool = None
+
+    def __del__(self):
+        self.close(wait=False)
+
+    def blend(self, preds):
+        """Blend the pitch tracks of the members (in the order of `extractor_classes`)."""
+        weights = [score for (extractor, score) in self._extractors]
         pitch = np.stack(preds, 0)
-        uv_detector = pitch[2] # JDC
+        uv_detector = pitch[self._uv_detector_index]
         uv_mask = uv_detector <= self.uv_threshold
         pitch = np.average(pitch, axis=0, weights=weights)
         pitch[uv_mask] = 0.0
         if self.interpolate:
             pitch = self.perform_interpolation(pitch)
         return pitch
-
-
@@ -0,0 +1,157 @@
+"""
+Per-utterance lengths, IDs and array offsets of a preprocessed dataset split.
+
+The manifest is a numpy structured array saved next to the filelist (`train.txt` -> `train.manifest.npy`),
+with one row per filelist line. It is written by `optispeech.tools.preprocess_dataset`,
+or built on first use by reading the headers of every utterance's files.
+"""
+
+import json
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+from optispeech.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+MANIFEST_SUFFIX = ".manifest.npy"
+ARRAY_NAMES = ("wav", "mel", "energy", "pitch")
+MANIFEST_DTYPE = np.dtype(
+    [
+        ("x_len", np.int32),
+        ("mel_len", np.int32),
+        ("wav_len", np.int64),
+        # -1 if the dataset has no speaker/language IDs
+        ("sid", np.int32),
+        ("lid", np.int32),
+        # Byte offsets of the array data inside the (uncompressed) `.npz` file, -1 if compressed
+        *((f"{name}_offset", np.int64) for name in ARRAY_NAMES),
+    ]
+)
+# Size of the fixed part of a zip local file header
+_ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def get_manifest_path(filelist_path) -> Path:
+    return Path(filelist_path).with_suffix(MANIFEST_SUFFIX)
+
+
+def read_npy_header(file):
+    """Read the header of a `.npy` file object, leaving it at the start of the data."""
+    version = np.lib.format.read_magic(file)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+    return shape, fortran_order, dtype
+
+
+def read_npz_array_headers(npz_filepath) -> dict:
+    """
+    Read the shape and the byte offset of the data of each array stored in an `.npz` file,
+    without loading the arrays.
+    """
+    headers = {}
+    with open(npz_filepath, "rb") as raw_file, zipfile.ZipFile(raw_file) as archive:
+        for info in archive.infolist():
+            with archive.open(info) as file:
+                shape, __, __ = read_npy_header(file)
+                npy_header_size = file.tell()
+            offset = _get_data_offset(raw_file, info, npy_header_size)
+            headers[info.filename.removesuffix(".npy")] = (shape, offset)
+    return headers
+
+
+def _get_data_offset(raw_file, info: zipfile.ZipInfo, npy_header_size: int) -> int:
+    # Byte offset of the array data of an (uncompressed) `.npz` member, -1 if compressed
+    if info.compress_type != zipfile.ZIP_STORED:
+        return -1
+    raw_file.seek(info.header_offset + 26)
+    name_size, extra_size = np.frombuffer(raw_file.read(4), dtype="<u2")
+    return info.header_offset + _ZIP_LOCAL_HEADER_SIZE + int(name_size) + int(extra_size) + npy_header_size
+
+
+class NpzArraySlicer:
+    """
+    Reads slices of a 1D array stored in an `.npz` file, without reading the rest of the array
+    (unless the file is compressed).
+
+    Slicing returns a (read-only) numpy array in the stored dtype.
+    """
+
+    def __init__(self, npz_filepath, name):
+        self.npz_filepath = npz_filepath
+        self.name = name
+        with open(npz_filepath, "rb") as raw_file, zipfile.ZipFile(raw_file) as archive:
+            info = archive.getinfo(f"{name}.npy")
+            with archive.open(info) as file:
+                self.shape, __, self.dtype = read_npy_header(file)
+                npy_header_size = file.tell()
+            self._data_offset = _get_data_offset(raw_file, info, npy_header_size)
+        assert len(self.shape) == 1, "Only 1D arrays can be sliced"
+
+    def __getitem__(self, key: slice) -> np.ndarray:
+        start, stop, step = key.indices(self.shape[0])
+        assert step == 1, "Strided slices are not supported"
+        if self._data_offset < 0:
+            with np.load(self.npz_filepath, allow_pickle=False) as data:
+                return data[self.name][start:stop]
+        with open(self.npz_filepath, "rb") as file:
+            file.seek(self._data_offset + start * self.dtype.itemsize)
+            data = file.read(max(stop - start, 0) * self.dtype.itemsize)
+        return np.frombuffer(data, dtype=self.dtype)
+
+
+def read_manifest_row(filepath) -> np.ndarray:
+    """Build the manifest row of a preprocessed utterance from its `.json` and `.npz` files."""
+    input_file = Path(filepath)
+    with open(input_file.with_suffix(".json"), encoding="utf-8") as file:
+        data = json.load(file)
+    headers = read_npz_array_headers(input_file.with_suffix(".npz"))
+    row = np.zeros((), dtype=MANIFEST_DTYPE)
+    row["x_len"] = len(data["phoneme_ids"])
+    row["mel_len"] = headers["mel"][0][-1]
+    row["wav_len"] = headers["wav"][0][-1]
+    row["sid"] = data.get("sid", -1)
+    row["lid"] = data.get("lid", -1)
+    for name in ARRAY_NAMES:
+        row[f"{name}_offset"] = headers[name][1]
+    return row
+
+
+def build_manifest(filepaths) -> np.ndarray:
+    manifest = np.zeros(len(filepaths), dtype=MANIFEST_DTYPE)
+    for i, filepath in enumerate(filepaths):
+        manifest[i] = read_manifest_row(filepath)
+    return manifest
+
+
+def write_manifest(filelist_path, manifest: np.ndarray) -> Path:
+    manifest_path = get_manifest_path(filelist_path)
+    np.save(manifest_path, manifest, allow_pickle=False)
+    return manifest_path
+
+
+def load_manifest(filelist_path, filepaths) -> np.ndarray:
+    """
+    Load the manifest of the given filelist, building it first if it's missing or outdated.
+
+    Args:
+        filelist_path (str|Path): path to the filelist
+        filepaths (list[str]): entries of the filelist (in file order)
+
+    Returns:
+        np.ndarray: manifest rows (in file order)
+    """
+    filelist_path = Path(filelist_path)
+    manifest_path = get_manifest_path(filelist_path)
+    if manifest_path.is_file() and (manifest_path.stat().st_mtime >= filelist_path.stat().st_mtime):
+        manifest = np.load(manifest_path, mmap_mode="r", allow_pickle=False)
+        if (manifest.dtype == MANIFEST_DTYPE) and (len(manifest) == len(filepaths)):
+            return manifest
+    log.info(f"Building dataset manifest for `{filelist_path}`")
+    manifest = build_manifest(filepaths)
+    write_manifest(filelist_path, manifest)
+    return manifest
@@ -0,0 +1,356 @@
+"""
+Packed feature store: the features of a whole dataset split in a few large shard files.
+
+Layout of a packed split directory (e.g. `train.packed/`):
+
+- `shard-00000.bin`, ...: the `wav`, `mel`, `energy` and `pitch` arrays of the utterances, back to back
+- `index.npy`: one row per utterance (see `PACKED_INDEX_DTYPE`), with the shard and byte offsets of its arrays
+- `phoneme_ids.npy`: the phoneme IDs of all utterances, concatenated
+- `texts.bin` and `names.bin`: UTF-8 texts and utterance names, concatenated
+- `meta.json`: format version and array dtypes, written last
+
+`rewrite_packed_texts` writes new versions of the index, phoneme IDs and texts next to the current
+ones (e.g. `index.1.npy`), then switches to them by replacing `meta.json`, which records their `text_generation`.
+
+Shards are memory-mapped when reading, so reading an utterance doesn't copy
+or parse anything until its arrays are used.
+"""
+
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from optispeech.utils import pylogger
+
+from .manifest import ARRAY_NAMES, MANIFEST_DTYPE
+from .storage import STORAGE_DTYPES, to_storage_dtype
+from .text_wav_datamodule import TextWavDataset
+
+log = pylogger.get_pylogger(__name__)
+
+PACKED_FORMAT = "optispeech-packed"
+PACKED_VERSION = 1
+PACKED_SUFFIX = ".packed"
+DEFAULT_SHARD_SIZE = 1024**3
+# Array offsets are aligned to this number of bytes
+ALIGNMENT = 64
+# Same fields as the manifest, with offsets relative to the shard file
+PACKED_INDEX_DTYPE = np.dtype(
+    MANIFEST_DTYPE.descr
+    + [
+        ("shard", np.int32),
+        ("phoneme_offset", np.int64),
+        ("text_offset", np.int64),
+        ("text_len", np.int32),
+        ("name_offset", np.int64),
+        ("name_len", np.int32),
+    ]
+)
+
+
+def is_packed_dataset(path) -> bool:
+    return Path(path).joinpath("meta.json").is_file()
+
+
+def shard_filename(shard: int) -> str:
+    return f"shard-{shard:05d}.bin"
+
+
+def text_filenames(generation: int) -> dict:
+    """Names of the index, phoneme IDs and texts files of the given `text_generation`."""
+    suffix = f".{generation}" if generation else ""
+    return dict(index=f"index{suffix}.npy", phoneme_ids=f"phoneme_ids{suffix}.npy", texts=f"texts{suffix}.bin")
+
+
+def read_meta(packed_dir) -> dict:
+    with open(Path(packed_dir).joinpath("meta.json"), encoding="utf-8") as file:
+        return json.load(file)
+
+
+class PackedFeatureWriter:
+    """
+    Writes utterances to a packed split directory.
+
+    `add` can be called from several threads. Utterances are stored in the order of their `position`
+    (if given), else in the order they were added. The store is only readable after `close`.
+    """
+
+    def __init__(self, output_dir, n_feats: int, shard_size: int = DEFAULT_SHARD_SIZE, precision: str = "float32"):
+        """
+        Args:
+            output_dir (str|Path): directory to create
+            n_feats (int): number of mel channels
+            shard_size (int): size (in bytes) after which a new shard is started
+            precision (str): storage precision of the arrays (see `optispeech.dataset.storage`)
+        """
+        if precision not in STORAGE_DTYPES:
+            raise ValueError(f"Unknown storage precision `{precision}`")
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=False)
+        self.n_feats = n_feats
+        self.shard_size = shard_size
+        self.dtypes = STORAGE_DTYPES[precision]
+        self._lock = threading.Lock()
+        self._rows = []
+        self._positions = []
+        self._phoneme_ids = []
+        self._texts = bytearray()
+        self._names = bytearray()
+        self._phoneme_offset = 0
+        self._shard = -1
+        self._shard_file = None
+        self._shard_offset = 0
+        self._next_shard()
+
+    def _next_shard(self):
+        if self._shard_file is not None:
+            self._shard_file.close()
+        self._shard += 1
+        self._shard_file = open(self.output_dir.joinpath(shard_filename(self._shard)), "wb")
+        self._shard_offset = 0
+
+    def _write_array(self, array: np.ndarray, dtype) -> int:
+        padding = -self._shard_offset % ALIGNMENT
+        if padding:
+            self._shard_file.write(bytes(padding))
+            self._shard_offset += padding
+        offset = self._shard_offset
+        array = np.ascontiguousarray(to_storage_dtype(array, dtype))
+        self._shard_file.write(array.tobytes())
+        self._shard_offset += array.nbytes
+        return offset
+
+    def add(self, name, phoneme_ids, text, wav, mel, energy, pitch, sid=None, lid=None, position=None):
+        assert mel.shape[0] == self.n_feats, f"Expected {self.n_feats} mel channels, got {mel.shape[0]}"
+        text_bytes = text.encode("utf-8")
+        name_bytes = os.fspath(name).encode("utf-8")
+        with self._lock:
+            if self._shard_offset >= self.shard_size:
+                self._next_shard()
+            row = np.zeros((), dtype=PACKED_INDEX_DTYPE)
+            row["x_len"] = len(phoneme_ids)
+            row["mel_len"] = mel.shape[-1]
+            row["wav_len"] = wav.shape[-1]
+            row["sid"] = sid if sid is not None else -1
+            row["lid"] = lid if lid is not None else -1
+            row["shard"] = self._shard
+            for array_name, array in zip(ARRAY_NAMES, (wav, mel, energy, pitch)):
+                row[f"{array_name}_offset"] = self._write_array(array, self.dtypes[array_name])
+            row["phoneme_offset"] = self._phoneme_offset
+            row["text_offset"] = len(self._texts)
+            row["text_len"] = len(text_bytes)
+            row["name_offset"] = len(self._names)
+            row["name_len"] = len(name_bytes)
+            self._rows.append(row)
+            self._positions.append(position if position is not None else len(self._positions))
+            self._phoneme_ids.append(np.asarray(phoneme_ids, dtype=np.int64))
+            self._phoneme_offset += len(phoneme_ids)
+            self._texts += text_bytes
+            self._names += name_bytes
+
+    def close(self):
+        self._shard_file.close()
+        # Rows only hold offsets, so they can be reordered without touching the data
+        order = np.argsort(self._positions, kind="stable")
+        index = np.stack([self._rows[i] for i in order]) if self._rows else np.zeros(0, dtype=PACKED_INDEX_DTYPE)
+        np.save(self.output_dir.joinpath("index.npy"), index, allow_pickle=False)
+        phoneme_ids = np.concatenate(self._phoneme_ids) if self._phoneme_ids else np.zeros(0, dtype=np.int64)
+        np.save(self.output_dir.joinpath("phoneme_ids.npy"), phoneme_ids, allow_pickle=False)
+        self.output_dir.joinpath("texts.bin").write_bytes(bytes(self._texts))
+        self.output_dir.joinpath("names.bin").write_bytes(bytes(self._names))
+        meta = dict(
+            format=PACKED_FORMAT,
+            version=PACKED_VERSION,
+            n_feats=self.n_feats,
+            num_shards=self._shard + 1,
+            num_utterances=len(index),
+            dtypes=self.dtypes,
+        )
+        with open(self.output_dir.joinpath("meta.json"), "w", encoding="utf-8") as file:
+            json.dump(meta, file, indent=2)
+        return self.output_dir
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._shard_file.close()
+
+
+def rewrite_packed_texts(packed_dir, get_text_data) -> list:
+    """
+    Replace the phoneme IDs, texts and speaker/language IDs of the utterances of a packed split,
+    without touching their arrays.
+
+    Args:
+        packed_dir (str|Path): packed split directory
+        get_text_data (callable): called with the name of each utterance, returns its new
+            `(phoneme_ids, text, sid, lid)`, or None to keep the current ones
+
+    Returns:
+        list[str]: names of the utterances whose phoneme IDs changed
+    """
+    packed_dir = Path(packed_dir)
+    meta = read_meta(packed_dir)
+    generation = meta.get("text_generation", 0)
+    old_filenames = text_filenames(generation)
+    index = np.load(packed_dir.joinpath(old_filenames["index"]), allow_pickle=False)
+    old_phoneme_ids = np.load(packed_dir.joinpath(old_filenames["phoneme_ids"]), allow_pickle=False)
+    old_texts = packed_dir.joinpath(old_filenames["texts"]).read_bytes()
+    names = packed_dir.joinpath("names.bin").read_bytes()
+    phoneme_ids = []
+    texts = bytearray()
+    phoneme_offset = 0
+    changed = []
+    for row in index:
+        name = names[row["name_offset"] : row["name_offset"] + row["name_len"]].decode("utf-8")
+        current_ids = old_phoneme_ids[row["phoneme_offset"] : row["phoneme_offset"] + row["x_len"]]
+        text_data = get_text_data(name)
+        if text_data is None:
+            ids = current_ids
+            text_bytes = old_texts[row["text_offset"] : row["text_offset"] + row["text_len"]]
+        else:
+            ids, text, sid, lid = text_data
+            ids = np.asarray(ids, dtype=np.int64)
+            text_bytes = text.encode("utf-8")
+            row["sid"] = sid if sid is not None else -1
+            row["lid"] = lid if lid is not None else -1
+            if not np.array_equal(ids, current_ids):
+                changed.append(name)
+        row["x_len"] = len(ids)
+        row["phoneme_offset"] = phoneme_offset
+        row["text_offset"] = len(texts)
+        row["text_len"] = len(text_bytes)
+        phoneme_ids.append(ids)
+        phoneme_offset += len(ids)
+        texts += text_bytes
+    phoneme_ids = np.concatenate(phoneme_ids) if phoneme_ids else np.zeros(0, dtype=np.int64)
+    # The new files are only used once `meta.json` points to them, so that readers (and a crash
+    # in between) see either the old or the new index, phoneme IDs and texts, never a mix of both
+    new_filenames = text_filenames(generation + 1)
+    np.save(packed_dir.joinpath(new_filenames["index"]), index, allow_pickle=False)
+    np.save(packed_dir.joinpath(new_filenames["phoneme_ids"]), phoneme_ids, allow_pickle=False)
+    packed_dir.joinpath(new_filenames["texts"]).write_bytes(bytes(texts))
+    meta["text_generation"] = generation + 1
+    tmp_path = packed_dir.joinpath("meta.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(meta, file, indent=2)
+    os.replace(tmp_path, packed_dir.joinpath("meta.json"))
+    for filename in old_filenames.values():
+        packed_dir.joinpath(filename).unlink()
+    return changed
+
+
+class PackedArrays:
+    """Lazily reads the arrays of one utterance from a memory-mapped shard."""
+
+    def __init__(self, shard: np.memmap, row: np.ndarray, n_feats: int, dtypes: dict):
+        self.shard = shard
+        self.row = row
+        self.n_feats = n_feats
+        self.dtypes = dtypes
+
+    def __getitem__(self, name) -> np.ndarray:
+        shape = {
+            "wav": (int(self.row["wav_len"]),),
+            "mel": (self.n_feats, int(self.row["mel_len"])),
+            "energy": (int(self.row["mel_len"]),),
+            "pitch": (int(self.row["mel_len"]),),
+        }[name]
+        dtype = np.dtype(self.dtypes[name])
+        if np.prod(shape) == 0:
+            return np.zeros(shape, dtype=dtype)
+        # Plain ndarray view over the (copy-on-write) mapping
+        return np.ndarray(shape, dtype=dtype, buffer=self.shard, offset=int(self.row[f"{name}_offset"]))
+
+
+class PackedTextWavDataset(TextWavDataset):
+    """
+    `TextWavDataset` that reads from a packed split directory written by `PackedFeatureWriter`.
+
+    Shards are memory-mapped lazily in each dataloader worker.
+    """
+
+    def __init__(
+        self,
+        num_speakers,
+        packed_dir,
+        text_processor,
+        feature_extractor,
+        seed=None,
+        use_precomputed_durations=False,
+        min_duration=None,
+        max_duration=None,
+        lazy_wav=False,
+    ):
+        self.num_speakers = num_speakers
+        self.text_processor = text_processor
+        self.feature_extractor = feature_extractor
+        self.use_precomputed_durations = use_precomputed_durations
+        # Memory-mapped waveforms are already read on access
+        self.lazy_wav = lazy_wav
+        self.filelist_path = packed_dir
+        self.packed_dir = Path(packed_dir)
+        self.uv_threshold = self.feature_extractor.f_min // 3.5
+        self.meta = read_meta(self.packed_dir)
+        if self.meta.get("format") != PACKED_FORMAT:
+            raise ValueError(f"`{packed_dir}` is not a packed OptiSpeech dataset")
+        if self.meta["n_feats"] != self.feature_extractor.n_feats:
+            raise ValueError(
+                f"Packed dataset has {self.meta['n_feats']} mel channels, but the feature extractor has {self.feature_extractor.n_feats}"
+            )
+        self._text_filenames = text_filenames(self.meta.get("text_generation", 0))
+        self._manifest = np.load(self.packed_dir.joinpath(self._text_filenames["index"]), allow_pickle=False)
+        names = self.packed_dir.joinpath("names.bin").read_bytes()
+        self.file_paths = [
+            names[offset : offset + length].decode("utf-8")
+            for (offset, length) in zip(self._manifest["name_offset"].tolist(), self._manifest["name_len"].tolist())
+        ]
+        self.data_dir = Path(self.file_paths[0]).parent if self.file_paths else self.packed_dir
+        self._mapped = None
+        self.cache = None
+        self._init_order(seed, min_duration, max_duration)
+
+    def _open(self):
+        # Opened on first use so that each dataloader worker has its own mappings
+        if self._mapped is None:
+            self._mapped = dict(
+                shards=[
+                    np.memmap(self.packed_dir.joinpath(shard_filename(shard)), dtype=np.uint8, mode="c")
+                    for shard in range(self.meta["num_shards"])
+                ],
+                phoneme_ids=np.load(self.packed_dir.joinpath(self._text_filenames["phoneme_ids"]), mmap_mode="r"),
+                texts=np.memmap(self.packed_dir.joinpath(self._text_filenames["texts"]), dtype=np.uint8, mode="r")
+                if self.packed_dir.joinpath(self._text_filenames["texts"]).stat().st_size
+                else np.zeros(0, dtype=np.uint8),
+            )
+        return self._mapped
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_mapped"] = None
+        return state
+
+    def get_source_file(self):
+        return self.packed_dir.joinpath(self._text_filenames["index"])
+
+    def read_utterance(self, index):
+        mapped = self._open()
+        row = self._manifest[self._manifest_rows[index]]
+        phoneme_offset = int(row["phoneme_offset"])
+        phoneme_ids = torch.from_numpy(
+            np.array(mapped["phoneme_ids"][phoneme_offset : phoneme_offset + int(row["x_len"])])
+        )
+        text_offset = int(row["text_offset"])
+        text = mapped["texts"][text_offset : text_offset + int(row["text_len"])].tobytes().decode("utf-8")
+        arrays = PackedArrays(mapped["shards"][int(row["shard"])], row, self.meta["n_feats"], self.meta["dtypes"])
+        sid = int(row["sid"]) if row["sid"] >= 0 else None
+        lid = int(row["lid"]) if row["lid"] >= 0 else None
+        return phoneme_ids, text, sid, lid, arrays
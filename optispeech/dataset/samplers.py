@@ -0,0 +1,147 @@
+import math
+from typing import Iterator, List, Optional
+
+import numpy as np
+from torch.utils.data import BatchSampler, Sampler
+from torch.utils.data.distributed import DistributedSampler
+
+
+class LengthBucketBatchSampler(BatchSampler):
+    """
+    Groups utterances of similar length into batches under a padded-size budget.
+
+    Utterances are split into `num_buckets` buckets of (roughly) equal size by frame length.
+    Every epoch, each bucket is shuffled and cut into batches such that
+    `batch_size * longest_item` stays within `max_frames` (and `max_tokens`),
+    then the batches of all buckets are shuffled together.
+    An utterance that exceeds the budget on its own is put in a batch by itself.
+
+    Under DDP, all ranks build the same batches and each rank takes every `num_replicas`-th batch,
+    so all ranks run the same number of steps. The DDP settings are read from `sampler`
+    when it is a `DistributedSampler` (which is what Lightning injects when training with DDP).
+    """
+
+    def __init__(
+        self,
+        sampler: Optional[Sampler],
+        frame_lengths: np.ndarray,
+        token_lengths: Optional[np.ndarray] = None,
+        max_frames: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        num_buckets: int = 10,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+    ):
+        """
+        Args:
+            sampler (Sampler|None): only used for its DDP settings if it is a `DistributedSampler`
+            frame_lengths (np.ndarray): number of frames of each utterance
+            token_lengths (np.ndarray|None): number of phonemes of each utterance (required by `max_tokens`)
+            max_frames (int|None): maximum number of padded frames in a batch
+            max_tokens (int|None): maximum number of padded phonemes in a batch
+            batch_size (int|None): maximum number of utterances in a batch
+            num_buckets (int): number of length buckets
+            shuffle (bool): shuffle utterances within buckets and batches across buckets
+            seed (int): random seed, combined with the epoch
+            drop_last (bool): under DDP, drop the batches that can't be evenly split between ranks instead of repeating some
+        """
+        if (max_frames is None) and (max_tokens is None) and (batch_size is None):
+            raise ValueError("At least one of `max_frames`, `max_tokens` or `batch_size` is required")
+        if (max_tokens is not None) and (token_lengths is None):
+            raise ValueError("`token_lengths` are required to limit the number of tokens in a batch")
+        self.sampler = sampler
+        self.frame_lengths = np.asarray(frame_lengths, dtype=np.int64)
+        self.token_lengths = np.asarray(token_lengths, dtype=np.int64) if token_lengths is not None else None
+        self.max_frames = max_frames
+        self.max_tokens = max_tokens
+        self.batch_size = batch_size
+        self.num_buckets = num_buckets
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        if isinstance(sampler, DistributedSampler):
+            self.num_replicas = sampler.num_replicas
+            self.rank = sampler.rank
+        else:
+            self.num_replicas = 1
+            self.rank = 0
+
+        # Buckets with (roughly) the same number of utterances
+        quantiles = np.linspace(0, 1, num_buckets + 1)[1:-1]
+        boundaries = np.unique(np.quantile(self.frame_lengths, quantiles).astype(np.int64))
+        bucket_ids = np.searchsorted(boundaries, self.frame_lengths, side="right")
+        self.buckets = [np.flatnonzero(bucket_ids == i) for i in range(len(boundaries) + 1)]
+        self._cached_epoch = None
+        self._cached_batches = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _current_epoch(self) -> int:
+        # Lightning calls `set_epoch` on the distributed sampler it injects, not on the batch sampler
+        if isinstance(self.sampler, DistributedSampler):
+            return self.sampler.epoch
+        return self.epoch
+
+    def _fits(self, count: int, max_frame_length: int, max_token_length: int) -> bool:
+        if (self.batch_size is not None) and (count > self.batch_size):
+            return False
+        if (self.max_frames is not None) and (count * max_frame_length > self.max_frames):
+            return False
+        if (self.max_tokens is not None) and (count * max_token_length > self.max_tokens):
+            return False
+        return True
+
+    def _make_batches(self, epoch: int) -> List[List[int]]:
+        rng = np.random.default_rng((self.seed, epoch))
+        token_lengths = self.token_lengths if self.token_lengths is not None else self.frame_lengths
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = rng.permutation(bucket)
+            batch = []
+            max_frame_length = max_token_length = 0
+            for idx, frame_length, token_length in zip(
+                bucket.tolist(), self.frame_lengths[bucket].tolist(), token_lengths[bucket].tolist()
+            ):
+                new_max_frame_length = max(max_frame_length, frame_length)
+                new_max_token_length = max(max_token_length, token_length)
+                if batch and not self._fits(len(batch) + 1, new_max_frame_length, new_max_token_length):
+                    batches.append(batch)
+                    batch = []
+                    new_max_frame_length, new_max_token_length = frame_length, token_length
+                batch.append(idx)
+                max_frame_length, max_token_length = new_max_frame_length, new_max_token_length
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        # Same number of batches on every rank
+        if self.num_replicas > 1:
+            if self.drop_last:
+                batches = batches[: len(batches) - len(batches) % self.num_replicas]
+            else:
+                num_batches = math.ceil(len(batches) / self.num_replicas) * self.num_replicas
+                batches = (batches * math.ceil(num_batches / len(batches)))[:num_batches]
+            batches = batches[self.rank :: self.num_replicas]
+        return batches
+
+    def _batches(self) -> List[List[int]]:
+        epoch = self._current_epoch()
+        if self._cached_epoch != epoch:
+            self._cached_batches = self._make_batches(epoch)
+            self._cached_epoch = epoch
+        return self._cached_batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        yield from self._batches()
+        if not isinstance(self.sampler, DistributedSampler):
+            # Nobody calls `set_epoch` on us outside of DDP
+            self.epoch += 1
+
+    def __len__(self) -> int:
+        return len(self._batches())
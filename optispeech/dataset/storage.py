@@ -0,0 +1,55 @@
+"""
+Precision of the arrays stored by `optispeech.tools.preprocess_dataset`.
+
+- `float32`: all arrays are stored as computed
+- `compact`: `wav` is stored as 16-bit PCM, and `mel`, `energy` and `pitch` as float16,
+  which halves the size of the dataset on disk and in the page cache
+
+Stored arrays are upcast to float32 when they're read (see `from_storage`),
+so datasets of both precisions can be used interchangeably.
+"""
+
+from typing import Dict
+
+import numpy as np
+
+from .manifest import ARRAY_NAMES
+
+STORAGE_DTYPES = {
+    "float32": dict.fromkeys(ARRAY_NAMES, "float32"),
+    "compact": dict(wav="int16", mel="float16", energy="float16", pitch="float16"),
+}
+STORAGE_PRECISIONS = tuple(STORAGE_DTYPES)
+# Full scale of 16-bit PCM
+PCM_SCALE = 32768.0
+
+
+def from_storage(array: np.ndarray) -> np.ndarray:
+    """Upcast a stored array to float32 (float32 arrays are returned as-is)."""
+    if array.dtype == np.int16:
+        return array.astype(np.float32) / PCM_SCALE
+    if array.dtype != np.float32:
+        return array.astype(np.float32)
+    return array
+
+
+def to_storage_dtype(array: np.ndarray, dtype) -> np.ndarray:
+    """Convert an array (of any storage dtype) to the given storage dtype."""
+    dtype = np.dtype(dtype)
+    if array.dtype == dtype:
+        return array
+    array = from_storage(np.asarray(array))
+    if dtype == np.int16:
+        return np.clip(np.round(array * PCM_SCALE), -PCM_SCALE, PCM_SCALE - 1).astype(np.int16)
+    if dtype == np.float16:
+        max_value = np.finfo(np.float16).max
+        return np.clip(array, -max_value, max_value).astype(np.float16)
+    return array.astype(dtype)
+
+
+def to_storage_precision(arrays: Dict[str, np.ndarray], precision: str) -> Dict[str, np.ndarray]:
+    """Convert the `wav`, `mel`, `energy` and `pitch` arrays to the given storage precision."""
+    if precision not in STORAGE_DTYPES:
+        raise ValueError(f"Unknown storage precision `{precision}`, expected one of {STORAGE_PRECISIONS}")
+    dtypes = STORAGE_DTYPES[precision]
+    return {name: to_storage_dtype(arrays[name], dtypes[name]) for name in ARRAY_NAMES}
@@ -1,5 +1,8 @@
+import hashlib
 import json
+import os
 import random
+from collections import ChainMap
 from hashlib import md5
 from pathlib import Path
 from typing import Any, Dict, Optional
@@ -11,14 +14,22 @@ import torch
 import torchaudio as ta
 from lightning import LightningDataModule
 from scipy.interpolate import interp1d
+from torch.utils.data import SequentialSampler
 from torch.utils.data.dataloader import DataLoader
 
+from optispeech.dataset.cache import ALIGNMENT, SharedMemoryCache, get_max_cache_size
 from optispeech.dataset.feature_extractors import FeatureExtractor
+from optispeech.dataset.manifest import ARRAY_NAMES, NpzArraySlicer, load_manifest
+from optispeech.dataset.samplers import LengthBucketBatchSampler
+from optispeech.dataset.storage import from_storage
 from optispeech.text import TextProcessor
 from optispeech.utils import normalize, pylogger
+from optispeech.utils.segments import get_random_segment_start_idxs
 
 log = pylogger.get_pylogger(__name__)
 
+# Written next to each `.npz` file by `optispeech.tools.extract_durations`
+DURATIONS_SUFFIX = ".durations.npz"
 
 
 def do_preprocess_utterance(
@@ -26,13 +37,15 @@ def do_preprocess_utterance(
     text_processor: TextProcessor,
     audio_filepath: str,
     text: str,
-    lang: str|None
+    lang: str|None,
+    features: Optional[tuple] = None,
 ):
+    """`features` are the `(wav, mel, energy, pitch)` of the audio file, if already extracted."""
     if text_processor.is_multi_language:
         assert lang is not None, "Language not provided for multi-language model"
-    lang = lang if not text_processor.is_multi_language else None
+    lang = lang if text_processor.is_multi_language else None
     phoneme_ids, text = text_processor(text, lang=lang)
-    wav, mel, energy, pitch = feature_extractor(audio_filepath)
+    wav, mel, energy, pitch = features if features is not None else feature_extractor(audio_filepath)
     return dict(
         phoneme_ids=phoneme_ids,
         text=text,
@@ -63,6 +76,15 @@ class TextWavDataModule(LightningDataModule):
         feature_extractor,
         data_statistics,
         seed,
+        use_precomputed_durations=False,
+        max_frames_per_batch=None,
+        max_tokens_per_batch=None,
+        num_buckets=10,
+        min_duration=None,
+        max_duration=None,
+        load_wav_segments=False,
+        cache_size_mb=None,
+        cache_prefill=False,
     ):
         super().__init__()
 
@@ -82,29 +104,73 @@ class TextWavDataModule(LightningDataModule):
         """
         # load and split datasets only if not loaded already
 
-        self.trainset = TextWavDataset(  # pylint: disable=attribute-defined-outside-init
-            num_speakers=self.hparams.num_speakers,
-            filelist_path=self.hparams.train_filelist_path,
-            text_processor=self.hparams.text_processor,
-            feature_extractor=self.feature_extractor,
-            seed=self.hparams.seed,
+        self.trainset = self.make_dataset(  # pylint: disable=attribute-defined-outside-init
+            self.hparams.train_filelist_path, lazy_wav=self.hparams.load_wav_segments
         )
-        self.validset = TextWavDataset(  # pylint: disable=attribute-defined-outside-init
+        self.validset = self.make_dataset(self.hparams.valid_filelist_path)  # pylint: disable=attribute-defined-outside-init
+        if self.hparams.cache_size_mb:
+            self.trainset.enable_cache(int(self.hparams.cache_size_mb * 1024**2), prefill=self.hparams.cache_prefill)
+
+    def make_dataset(self, filelist_path, lazy_wav=False):
+        """Dataset of a split, either a filelist or a packed split directory (see `optispeech.dataset.packed`)."""
+        # Imported here because the packed dataset subclasses `TextWavDataset`
+        from optispeech.dataset.packed import PackedTextWavDataset, is_packed_dataset
+
+        kwargs = dict(
             num_speakers=self.hparams.num_speakers,
-            filelist_path=self.hparams.valid_filelist_path,
             text_processor=self.hparams.text_processor,
             feature_extractor=self.feature_extractor,
             seed=self.hparams.seed,
+            use_precomputed_durations=self.hparams.use_precomputed_durations,
+            min_duration=self.hparams.min_duration,
+            max_duration=self.hparams.max_duration,
+            lazy_wav=lazy_wav,
+        )
+        if is_packed_dataset(filelist_path):
+            return PackedTextWavDataset(packed_dir=filelist_path, **kwargs)
+        return TextWavDataset(filelist_path=filelist_path, **kwargs)
+
+    def train_collate(self, do_normalize=True):
+        segment_size = None
+        if self.hparams.load_wav_segments and (self.trainer is not None):
+            # Only load the waveform segments the model trains its vocoder on (see `BaseLightningModule._process_batch`)
+            segment_size = self.trainer.lightning_module.generator.segment_size
+        return TextWavBatchCollate(
+            self.n_feats,
+            self.hparams.data_statistics,
+            do_normalize=do_normalize,
+            segment_size=segment_size,
+            hop_length=self.feature_extractor.hop_length,
         )
 
     def train_dataloader(self, do_normalize=True):
+        if (self.hparams.max_frames_per_batch is not None) or (self.hparams.max_tokens_per_batch is not None):
+            x_lengths, mel_lengths = self.trainset.get_lengths()
+            batch_sampler = LengthBucketBatchSampler(
+                SequentialSampler(self.trainset),
+                frame_lengths=mel_lengths,
+                token_lengths=x_lengths,
+                max_frames=self.hparams.max_frames_per_batch,
+                max_tokens=self.hparams.max_tokens_per_batch,
+                batch_size=self.hparams.batch_size,
+                num_buckets=self.hparams.num_buckets,
+                shuffle=True,
+                seed=self.hparams.seed,
+            )
+            return DataLoader(
+                dataset=self.trainset,
+                batch_sampler=batch_sampler,
+                num_workers=self.hparams.num_workers,
+                pin_memory=self.hparams.pin_memory,
+                collate_fn=self.train_collate(do_normalize=do_normalize),
+            )
         return DataLoader(
             dataset=self.trainset,
             batch_size=self.hparams.batch_size,
             num_workers=self.hparams.num_workers,
             pin_memory=self.hparams.pin_memory,
             shuffle=True,
-            collate_fn=TextWavBatchCollate(self.n_feats, self.hparams.data_statistics, do_normalize=do_normalize),
+            collate_fn=self.train_collate(do_normalize=do_normalize),
         )
 
     def val_dataloader(self):
@@ -119,7 +185,9 @@ class TextWavDataModule(LightningDataModule):
 
     def teardown(self, stage: Optional[str] = None):
         """Clean up after fit or test."""
-        pass  # pylint: disable=unnecessary-pass
+        trainset = getattr(self, "trainset", None)
+        if (trainset is not None) and (trainset.cache is not None):
+            trainset.cache.close()
 
     def state_dict(self):
         """Extra things to save to checkpoint."""
@@ -138,17 +206,143 @@ class TextWavDataset(torch.utils.data.Dataset):
         text_processor,
         feature_extractor,
         seed=None,
+        use_precomputed_durations=False,
+        min_duration=None,
+        max_duration=None,
+        lazy_wav=False,
     ):
         self.num_speakers = num_speakers
         self.text_processor = text_processor
         self.feature_extractor = feature_extractor
+        self.use_precomputed_durations = use_precomputed_durations
+        # Return a sliceable view of the waveform that is read on access, instead of the full waveform
+        self.lazy_wav = lazy_wav
+        self.filelist_path = filelist_path
         self.file_paths = parse_filelist(filelist_path)
         self.data_dir = Path(filelist_path).parent.joinpath("data")
         self.uv_threshold = self.feature_extractor.f_min // 3.5
+        self._manifest = None
+        self.cache = None
+        self._init_order(seed, min_duration, max_duration)
+
+    def _init_order(self, seed, min_duration, max_duration):
+        # Manifest row of each entry in `file_paths`
+        self._manifest_rows = np.arange(len(self.file_paths))
+        if (min_duration is not None) or (max_duration is not None):
+            self.filter_by_duration(min_duration, max_duration)
+        # Same order as shuffling `file_paths` in place
+        order = list(range(len(self.file_paths)))
         random.seed(seed)
-        random.shuffle(self.file_paths)
+        random.shuffle(order)
+        self.file_paths = [self.file_paths[i] for i in order]
+        self._manifest_rows = self._manifest_rows[order]
 
-    def get_datapoint(self, filepath):
+    @property
+    def manifest(self):
+        """
+        Manifest rows of the utterances (in `file_paths` order), see `optispeech.dataset.manifest`.
+
+        The manifest is built (by reading the headers of every utterance's files) if it doesn't exist.
+        """
+        return self._get_full_manifest()[self._manifest_rows]
+
+    def _get_full_manifest(self):
+        if self._manifest is None:
+            self._manifest = load_manifest(self.filelist_path, parse_filelist(self.filelist_path))
+        return self._manifest
+
+    def get_lengths(self):
+        """Phoneme and frame lengths of the utterances (in `file_paths` order)."""
+        manifest = self.manifest
+        return manifest["x_len"].astype(np.int64), manifest["mel_len"].astype(np.int64)
+
+    def filter_by_duration(self, min_duration=None, max_duration=None):
+        """Drop utterances shorter than `min_duration` or longer than `max_duration` (in seconds)."""
+        durations = self.manifest["wav_len"] / self.feature_extractor.sample_rate
+        keep = np.ones(len(durations), dtype=bool)
+        if min_duration is not None:
+            keep &= durations >= min_duration
+        if max_duration is not None:
+            keep &= durations <= max_duration
+        log.info(f"Keeping {keep.sum()} of {len(keep)} utterances in `{self.filelist_path}` after filtering by duration")
+        self.file_paths = [filepath for (filepath, keep_item) in zip(self.file_paths, keep) if keep_item]
+        self._manifest_rows = self._manifest_rows[keep]
+
+    def enable_cache(self, size, prefill=False):
+        """
+        Keep the utterances in a shared-memory cache (see `optispeech.dataset.cache`),
+        shared by all dataloader workers and all training processes on this node.
+
+        Args:
+            size (int): size of the cache (in bytes)
+            prefill (bool): read the whole dataset into the cache now (if it fits),
+                instead of caching utterances as they're first read
+        """
+        max_size = get_max_cache_size()
+        if (max_size is not None) and (size > max_size):
+            log.warning(f"Only {max_size / 1024**2:.0f} MB of shared memory are free, reducing the dataset cache to that")
+            size = max_size
+        # Processes using the same dataset share the cache
+        source = self.get_source_file()
+        source_stat = source.stat()
+        key = f"{source.resolve()}:{source_stat.st_mtime_ns}:{source_stat.st_size}:{os.getuid()}"
+        name = "optispeech-" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        # Utterances are identified by their row in the whole manifest (before filtering and shuffling)
+        num_items = len(self._get_full_manifest())
+        estimated_size = self.estimate_size()
+        self.cache = SharedMemoryCache(name, num_items, size, evict=estimated_size > size)
+        log.info(
+            f"Caching `{self.filelist_path}` (~{estimated_size / 1024**2:.0f} MB) "
+            f"in {self.cache.size / 1024**2:.0f} MB of shared memory" + (" with eviction" if self.cache.evict else "")
+        )
+        # Other training processes on this node share the cache filled by the first one
+        if prefill and (int(os.environ.get("LOCAL_RANK", 0)) == 0):
+            if self.cache.evict:
+                log.warning("The dataset doesn't fit in the cache, not prefilling it")
+            else:
+                for index in np.argsort(self._manifest_rows, kind="stable").tolist():
+                    self.get_cached_utterance(index)
+                log.info(f"Cached {self.cache.cached_bytes() / 1024**2:.0f} MB")
+
+    def get_source_file(self):
+        """File that identifies the dataset (and changes with it)."""
+        return Path(self.filelist_path)
+
+    def estimate_size(self):
+        """Estimated size of all the utterances (in bytes), in their storage precision."""
+        manifest = self._get_full_manifest()
+        __, __, __, __, arrays = self.read_utterance(0)
+        itemsizes = {name: np.dtype(arrays[name].dtype).itemsize for name in ARRAY_NAMES}
+        n_feats = self.feature_extractor.n_feats
+        sizes = (
+            manifest["wav_len"] * itemsizes["wav"]
+            + manifest["mel_len"] * (n_feats * itemsizes["mel"] + itemsizes["energy"] + itemsizes["pitch"])
+            # phoneme IDs and text
+            + manifest["x_len"] * 12
+            + 6 * ALIGNMENT
+        )
+        return int(sizes.sum())
+
+    def get_cached_utterance(self, index):
+        key = int(self._manifest_rows[index])
+        utterance = self.cache.get(key)
+        if utterance is not None:
+            phoneme_ids, text, sid, lid, arrays = utterance
+            return torch.from_numpy(phoneme_ids), text, sid, lid, arrays
+        phoneme_ids, text, sid, lid, arrays = self.read_utterance(index)
+        # Lazy waveforms are read in full, once
+        arrays = {name: arrays[name][:] for name in ARRAY_NAMES}
+        self.cache.put(key, phoneme_ids, text, sid, lid, arrays)
+        return phoneme_ids, text, sid, lid, arrays
+
+    def read_utterance(self, index):
+        """
+        Returns:
+            (phoneme_ids, text, sid, lid, arrays) of the utterance at `index` (see `make_datapoint`)
+        """
+        return self.read_utterance_files(self.file_paths[index])
+
+    def read_utterance_files(self, filepath):
         input_file = Path(filepath)
         json_filepath = input_file.with_suffix(".json")
         arrays_filepath = input_file.with_suffix(".npz")
@@ -159,22 +353,61 @@ class TextWavDataset(torch.utils.data.Dataset):
             sid = data.get("sid")
             lid = data.get("lid")
             phoneme_ids = torch.LongTensor(phoneme_ids)
-        data = np.load(arrays_filepath, allow_pickle=False)
-        # TODO: Maybe revisit this later
-        pitch = torch.from_numpy(data["pitch"])
-        pitch[pitch <= self.uv_threshold] = 0.0
+        arrays = np.load(arrays_filepath, allow_pickle=False)
+        if self.lazy_wav:
+            arrays = ChainMap({"wav": NpzArraySlicer(arrays_filepath, "wav")}, arrays)
+        return phoneme_ids, text, sid, lid, arrays
+
+    def get_datapoint(self, filepath):
+        return self.make_datapoint(filepath, *self.read_utterance_files(filepath))
+
+    def make_datapoint(self, filepath, phoneme_ids, text, sid, lid, arrays):
+        """
+        Args:
+            filepath (str): path of the utterance (without suffix)
+            phoneme_ids (torch.LongTensor): phoneme IDs
+            text (str): text
+            sid (int|None): speaker ID
+            lid (int|None): language ID
+            arrays (Mapping[str, np.ndarray]): `wav`, `mel`, `energy` and `pitch` arrays, read on access
+                (in any storage precision, they're upcast to float32).
+                With `lazy_wav`, `wav` only needs to support slicing and `shape`, and is returned as-is
+        """
+        mel = torch.from_numpy(from_storage(arrays["mel"]))
+        if self.use_precomputed_durations:
+            durations, pitch, energy = self.get_precomputed_durations(Path(filepath), phoneme_ids, mel)
+        else:
+            durations = None
+            energy = torch.from_numpy(from_storage(arrays["energy"]))
+            # TODO: Maybe revisit this later
+            pitch = torch.from_numpy(from_storage(arrays["pitch"]))
+            # Not in-place, arrays may be shared
+            pitch = pitch.masked_fill(pitch <= self.uv_threshold, 0.0)
         return dict(
             x=phoneme_ids,
-            wav=torch.from_numpy(data["wav"]),
-            mel=torch.from_numpy(data["mel"]),
-            energy=torch.from_numpy(data["energy"]),
+            wav=arrays["wav"] if self.lazy_wav else torch.from_numpy(from_storage(arrays["wav"])),
+            mel=mel,
+            energy=energy,
             pitch=pitch,
+            durations=durations,
             sid=sid,
             lid=lid,
             text=text,
             filepath=filepath,
         )
 
+    def get_precomputed_durations(self, input_file, phoneme_ids, mel):
+        durations_filepath = input_file.with_suffix(DURATIONS_SUFFIX)
+        if not durations_filepath.is_file():
+            raise FileNotFoundError(
+                f"Durations file `{durations_filepath}` not found. Run `optispeech.tools.extract_durations` first"
+            )
+        data = np.load(durations_filepath, allow_pickle=False)
+        durations = torch.from_numpy(data["durations"])
+        if (durations.shape[-1] != phoneme_ids.shape[-1]) or (durations.sum().item() != mel.shape[-1]):
+            raise ValueError(f"Durations in `{durations_filepath}` do not match the utterance. Extract them again")
+        return durations, torch.from_numpy(data["pitch"]), torch.from_numpy(data["energy"])
+
     def preprocess_utterance(self, audio_filepath: str, text: str, lang: str):
         return do_preprocess_utterance(
             feature_extractor=self.feature_extractor,
@@ -185,19 +418,42 @@ class TextWavDataset(torch.utils.data.Dataset):
         )
 
     def __getitem__(self, index):
-        filepath = self.file_paths[index]
-        datapoint = self.get_datapoint(filepath)
-        return datapoint
+        if self.cache is not None:
+            utterance = self.get_cached_utterance(index)
+        else:
+            utterance = self.read_utterance(index)
+        return self.make_datapoint(self.file_paths[index], *utterance)
 
     def __len__(self):
         return len(self.file_paths)
 
 
 class TextWavBatchCollate:
-    def __init__(self, n_feats: float, data_statistics: Dict[str, float], do_normalize: bool = True):
+    def __init__(
+        self,
+        n_feats: float,
+        data_statistics: Dict[str, float],
+        do_normalize: bool = True,
+        segment_size: Optional[int] = None,
+        hop_length: Optional[int] = None,
+    ):
+        """
+        Args:
+            n_feats (int): number of mel channels
+            data_statistics (Dict[str, float]): normalization statistics
+            do_normalize (bool): normalize mel, pitch and energy
+            segment_size (int|None): if given, pick the random segments (in frames) the vocoder is trained on,
+                and only read these segments of the waveforms. The batch's `wav` then holds the segments,
+                and `start_idxs` their start frames.
+            hop_length (int|None): hop length of the features (required with `segment_size`)
+        """
+        if (segment_size is not None) and (hop_length is None):
+            raise ValueError("`hop_length` is required to load waveform segments")
         self.n_feats = n_feats
         self.data_statistics = data_statistics
         self.do_normalize = do_normalize
+        self.segment_size = segment_size
+        self.hop_length = hop_length
 
     def __call__(self, batch):
         B = len(batch)
@@ -207,11 +463,24 @@ class TextWavBatchCollate:
         wav_max_length = max([item["wav"].shape[-1] for item in batch])
 
         x = torch.zeros((B, x_max_length), dtype=torch.long)
-        wav = np.zeros((B, wav_max_length), dtype=np.float32)
         mel = torch.zeros((B, self.n_feats, mel_max_length), dtype=torch.float32)
-
-        pitches = torch.zeros((B, mel_max_length), dtype=torch.float)
-        energies = torch.zeros((B, mel_max_length), dtype=torch.float)
+        if self.segment_size is not None:
+            # Same as picking the segments in the generator
+            segment_size = min(self.segment_size, mel_max_length)
+            start_idxs = get_random_segment_start_idxs(
+                torch.tensor([item["mel"].shape[-1] for item in batch]), segment_size
+            )
+            wav = np.zeros((B, segment_size * self.hop_length), dtype=np.float32)
+        else:
+            start_idxs = None
+            wav = np.zeros((B, wav_max_length), dtype=np.float32)
+
+        # Phoneme-level pitch and energy come with precomputed durations
+        has_durations = batch[0]["durations"] is not None
+        pitch_max_length = x_max_length if has_durations else mel_max_length
+        pitches = torch.zeros((B, pitch_max_length), dtype=torch.float)
+        energies = torch.zeros((B, pitch_max_length), dtype=torch.float)
+        durations = torch.zeros((B, x_max_length), dtype=torch.long) if has_durations else None
 
         x_lengths, wav_lengths, mel_lengths = [], [], []
         sids, lids = [], []
@@ -222,10 +491,18 @@ class TextWavBatchCollate:
             wav_lengths.append(wav_.shape[-1])
             mel_lengths.append(mel_.shape[-1])
             x[i, : x_.shape[-1]] = x_
-            wav[i, : wav_.shape[-1]] = wav_
+            if start_idxs is not None:
+                wav_start = start_idxs[i].item() * self.hop_length
+                wav_ = wav_[wav_start : wav_start + wav.shape[-1]]
+            else:
+                wav_ = wav_[:]
+            # Waveforms read lazily are in their storage precision
+            wav[i, : wav_.shape[-1]] = from_storage(np.asarray(wav_))
             mel[i, :, : item["mel"].shape[-1]] = mel_
             energies[i, : item["energy"].shape[-1]] = item["energy"].float()
             pitches[i, : item["pitch"].shape[-1]] = item["pitch"].float()
+            if has_durations:
+                durations[i, : x_.shape[-1]] = item["durations"]
             if item["sid"] is not None:
                 sids.append(item["sid"])
             if item["lid"] is not None:
@@ -259,6 +536,8 @@ class TextWavBatchCollate:
             mel_lengths=mel_lengths,
             energies=energies,
             pitches=pitches,
+            durations=durations,
+            start_idxs=start_idxs,
             sids=sids,
             lids=lids,
             x_texts=x_texts,
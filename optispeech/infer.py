@@ -19,7 +19,7 @@ def main():
     parser.add_argument(
         "checkpoint",
         type=str,
-        help="Path to OptiSpeech checkpoint",
+        help="Path to OptiSpeech checkpoint (lightning `.ckpt` or slim checkpoint)",
     )
     parser.add_argument("text", type=str, help="Text to synthesise")
     parser.add_argument(
@@ -35,7 +35,11 @@ def main():
     args = parser.parse_args()
 
     device = torch.device("cuda") if args.cuda else torch.device("cpu")
-    model = OptiSpeech.load_from_checkpoint(args.checkpoint, map_location="cpu")
+    if args.checkpoint.endswith(".ckpt"):
+        model = OptiSpeech.load_from_checkpoint(args.checkpoint, map_location="cpu")
+    else:
+        # Inference-only checkpoint exported by `optispeech.tools.export_slim_checkpoint`
+        model = OptiSpeech.load_from_slim_checkpoint(args.checkpoint, map_location="cpu")
     model.to(device)
     model.eval()
 
@@ -24,6 +24,8 @@ class BaseLightningModule(LightningModule, ABC):
     def _process_batch(self, batch):
         sids = batch["sids"]
         lids = batch["lids"]
+        durations = batch.get("durations")
+        start_idxs = batch.get("start_idxs")
         gen_outputs = self.generator(
             x=batch["x"].to(self.device),
             x_lengths=batch["x_lengths"].to(self.device),
@@ -33,14 +35,20 @@ class BaseLightningModule(LightningModule, ABC):
             energies=batch["energies"].to(self.device),
             sids=sids.to(self.device) if sids is not None else None,
             lids=lids.to(self.device) if lids is not None else None,
+            durations=durations.to(self.device) if durations is not None else None,
+            start_idx=start_idxs.to(self.device) if start_idxs is not None else None,
         )
         segment_size = gen_outputs["segment_size"]
-        seg_gt_wav = get_segments_numpy(
-            x=np.expand_dims(batch["wav"], 1),
-            start_idxs=gen_outputs["start_idx"] * self.hop_length,
-            segment_size=segment_size * self.hop_length,
-        )
-        seg_gt_wav = torch.from_numpy(seg_gt_wav.squeeze(1)).type_as(gen_outputs["wav_hat"])
+        if start_idxs is not None:
+            # The dataloader only loaded the waveform segments (see `TextWavBatchCollate`)
+            seg_gt_wav = batch["wav"][:, : segment_size * self.hop_length]
+        else:
+            seg_gt_wav = get_segments_numpy(
+                x=np.expand_dims(batch["wav"], 1),
+                start_idxs=gen_outputs["start_idx"] * self.hop_length,
+                segment_size=segment_size * self.hop_length,
+            ).squeeze(1)
+        seg_gt_wav = torch.from_numpy(seg_gt_wav).type_as(gen_outputs["wav_hat"])
         gen_outputs["wav"] = seg_gt_wav
         return gen_outputs
 
@@ -320,3 +328,4 @@ class BaseLightningModule(LightningModule, ABC):
 
     def on_load_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
         self.ckpt_loaded_epoch = checkpoint["epoch"]  # pylint: disable=attribute-defined-outside-init
+        self.ckpt_loaded_global_step = checkpoint["global_step"]  # pylint: disable=attribute-defined-outside-init
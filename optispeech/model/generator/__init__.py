@@ -5,7 +5,7 @@ from torch import nn
 from torch.nn import functional as F
 
 from optispeech.utils import denormalize, sequence_mask
-from optispeech.utils.segments import get_random_segments
+from optispeech.utils.segments import get_random_segment_start_idxs, get_segments
 
 from .alignments import (
     AlignmentModule,
@@ -14,6 +14,7 @@ from .alignments import (
     viterbi_decode,
 )
 from .loss import FastSpeech2Loss, ForwardSumLoss
+from .modules import DropPath, LightSpeechTransformerDecoder
 
 
 class OptiSpeechGenerator(nn.Module):
@@ -33,11 +34,14 @@ class OptiSpeechGenerator(nn.Module):
         num_speakers,
         num_languages,
         data_statistics,
+        segment_local_decoding=False,
+        use_alignment_module=True,
         **kwargs
     ):
         super().__init__()
 
         self.segment_size = segment_size
+        self.segment_local_decoding = segment_local_decoding
         self.loss_coeffs = loss_coeffs
         self.n_feats = feature_extractor.n_feats
         self.n_fft = feature_extractor.n_fft
@@ -50,7 +54,11 @@ class OptiSpeechGenerator(nn.Module):
         self.text_embedding = text_embedding(dim=dim)
         self.encoder = encoder(dim=dim)
         self.duration_predictor = duration_predictor(dim=dim)
-        self.alignment_module = AlignmentModule(adim=dim, odim=self.n_feats)
+        # Only needed to learn durations, not when they are precomputed nor for inference
+        if use_alignment_module:
+            self.alignment_module = AlignmentModule(adim=dim, odim=self.n_feats)
+        else:
+            self.alignment_module = None
         self.pitch_predictor = pitch_predictor(dim=dim)
         self.energy_predictor = energy_predictor(dim=dim)
         self.feature_upsampler = GaussianUpsampling()
@@ -63,21 +71,37 @@ class OptiSpeechGenerator(nn.Module):
         self.loss_criterion = FastSpeech2Loss()
         self.forwardsum_loss = ForwardSumLoss()
 
-    def forward(self, x, x_lengths, mel, mel_lengths, pitches, energies, sids, lids):
+        if self.segment_local_decoding and getattr(self.decoder, "receptive_field", None) is None:
+            raise ValueError(
+                f"Segment-local decoding requires a decoder with a bounded receptive field (e.g. ConvNeXt or LightSpeech), got `{type(self.decoder).__name__}`"
+            )
+
+    def forward(self, x, x_lengths, mel, mel_lengths, pitches, energies, sids, lids, durations=None, start_idx=None):
         """
         Args:
             x (torch.Tensor): batch of texts, converted to a tensor with phoneme embedding ids.
                 shape: (batch_size, max_text_length)
             x_lengths (torch.Tensor): lengths of texts in batch.
                 shape: (batch_size,)
-            pitches (torch.Tensor): phoneme-level pitch values.
-                shape: (batch_size, max_text_length)
-            energies (torch.Tensor): phoneme-level energy values.
-                shape: (batch_size, max_text_length)
+            mel (torch.Tensor): batch of mel spectrograms.
+                shape: (batch_size, n_feats, max_mel_length)
+            mel_lengths (torch.Tensor): lengths of mel spectrograms in batch.
+                shape: (batch_size,)
+            pitches (torch.Tensor): frame-level pitch values, or phoneme-level if `durations` is given.
+                shape: (batch_size, max_mel_length) or (batch_size, max_text_length)
+            energies (torch.Tensor): frame-level energy values, or phoneme-level if `durations` is given.
+                shape: (batch_size, max_mel_length) or (batch_size, max_text_length)
             sids (torch.LongTensor): list of speaker IDs for each input sentence.
                 shape: (batch_size,)
             lids (torch.LongTensor): list of language IDs for each input sentence.
                 shape: (batch_size,)
+            durations (Optional[torch.Tensor]): precomputed phoneme durations (see `optispeech.tools.extract_durations`).
+                When given, the alignment module is skipped and the alignment loss is zero.
+                Required when the generator is built without the alignment module.
+                shape: (batch_size, max_text_length)
+            start_idx (Optional[torch.LongTensor]): start frames of the segments passed to the vocoder,
+                when they're picked by the data pipeline (see `TextWavBatchCollate`). Picked randomly otherwise.
+                shape: (batch_size,)
 
         Returns:
             loss: (torch.Tensor): scaler representing total loss
@@ -95,54 +119,41 @@ class OptiSpeechGenerator(nn.Module):
         input_padding_mask = ~x_mask.squeeze(1).bool().to(x.device)
         target_padding_mask = ~mel_mask.squeeze(1).bool().to(x.device)
 
-        # text embedding
-        x, __ = self.text_embedding(x)
-
-        # Encoder
-        x = self.encoder(x, input_padding_mask)
-
-        # Speaker and language embedding
-        if sids is not None:
-            sid_emb = self.sid_embed(sids.view(-1))
-            x = x + sid_emb.unsqueeze(1)
-        if lids is not None:
-            lid_embs = self.lid_embed(lids.view(-1))
-            x = x + lid_embs.unsqueeze(1)
+        x = self._encode(x, input_padding_mask, sids, lids)
 
         # alignment
-        log_p_attn = self.alignment_module(
-            text=x,
-            feats=mel.transpose(1, 2),
-            text_lengths=x_lengths,
-            feats_lengths=mel_lengths,
-            x_masks=input_padding_mask,
-        )
-        durations, bin_loss = viterbi_decode(log_p_attn, x_lengths, mel_lengths)
+        if durations is None:
+            log_p_attn, durations, bin_loss, pitches, energies = self._align(
+                x, x_lengths, mel, mel_lengths, pitches, energies, input_padding_mask
+            )
+            forwardsum_loss = self.forwardsum_loss(log_p_attn, x_lengths, mel_lengths)
+            align_loss = forwardsum_loss + bin_loss
+        else:
+            align_loss = torch.zeros((), device=x.device)
         duration_hat = self.duration_predictor(x.detach(), input_padding_mask)
 
-        # Average pitch and energy values based on durations
-        pitches = average_by_duration(durations, pitches.unsqueeze(-1), x_lengths, mel_lengths)
-        energies = average_by_duration(durations, energies.unsqueeze(-1), x_lengths, mel_lengths)
-
         # variance predictors
         x, pitch_hat = self.pitch_predictor(x, input_padding_mask, pitches)
         x, energy_hat = self.energy_predictor(x, input_padding_mask, energies)
 
-        # upsample to mel lengths
-        y = self.feature_upsampler(
-            hs=x, ds=durations, h_masks=mel_mask.squeeze(1).bool(), d_masks=x_mask.squeeze(1).bool()
-        )
+        if self.segment_local_decoding:
+            segment, start_idx, segment_size = self._decode_random_segments(
+                x, durations, x_mask.squeeze(1).bool(), mel_lengths, start_idx
+            )
+        else:
+            # upsample to mel lengths
+            y = self.feature_upsampler(
+                hs=x, ds=durations, h_masks=mel_mask.squeeze(1).bool(), d_masks=x_mask.squeeze(1).bool()
+            )
 
-        # Decoder
-        y = self.decoder(y, target_padding_mask)
+            # Decoder
+            y = self.decoder(y, target_padding_mask)
 
-        # get random segments
-        segment_size = min(self.segment_size, y.shape[-2])
-        segment, start_idx = get_random_segments(
-            y.transpose(1, 2),
-            mel_lengths.type_as(y),
-            segment_size,
-        )
+            # get random segments
+            segment_size = min(self.segment_size, y.shape[-2])
+            if start_idx is None:
+                start_idx = get_random_segment_start_idxs(mel_lengths.type_as(y), segment_size)
+            segment = get_segments(y.transpose(1, 2), start_idx, segment_size)
 
         # Generate wav
         wav_hat = self.wav_generator(segment)
@@ -158,8 +169,6 @@ class OptiSpeechGenerator(nn.Module):
             es=energies.unsqueeze(-1),
             ilens=x_lengths,
         )
-        forwardsum_loss = self.forwardsum_loss(log_p_attn, x_lengths, mel_lengths)
-        align_loss = forwardsum_loss + bin_loss
         loss = (
             (align_loss * loss_coeffs.lambda_align)
             + (duration_loss * loss_coeffs.lambda_duration)
@@ -178,6 +187,119 @@ class OptiSpeechGenerator(nn.Module):
             "energy_loss": energy_loss.detach().cpu(),
         }
 
+    @torch.no_grad()
+    def extract_durations(self, x, x_lengths, mel, mel_lengths, pitches, energies, sids, lids):
+        """
+        Align a training batch and return its phoneme-level targets.
+
+        Takes the same arguments as `forward` (with frame-level pitch and energy).
+
+        Returns:
+            durations: (torch.Tensor): phoneme durations
+                shape: (batch_size, max_text_length)
+            pitches: (torch.Tensor): phoneme-averaged pitch
+                shape: (batch_size, max_text_length)
+            energies: (torch.Tensor): phoneme-averaged energy
+                shape: (batch_size, max_text_length)
+        """
+        input_padding_mask = ~sequence_mask(x_lengths, x_lengths.max()).to(x.device)
+        x = self._encode(x, input_padding_mask, sids, lids)
+        __, durations, __, pitches, energies = self._align(
+            x, x_lengths, mel, mel_lengths, pitches, energies, input_padding_mask
+        )
+        return durations, pitches, energies
+
+    def _decode_random_segments(self, x, durations, d_masks, mel_lengths, start_idx=None):
+        """
+        Pick random segments first, then upsample and decode only the frames they depend on.
+
+        The decoded window spans each segment plus the decoder's receptive field on both sides,
+        so the segments are the same as the ones cut from a full-length decoding.
+        """
+        margin = self.decoder.receptive_field
+        mel_max_length = mel_lengths.max().item()
+        segment_size = min(self.segment_size, mel_max_length)
+        if start_idx is None:
+            start_idx = get_random_segment_start_idxs(mel_lengths, segment_size)
+
+        # Windows are kept within the padded batch, so they see the same boundaries as the full sequence
+        window_size = min(segment_size + 2 * margin, mel_max_length)
+        window_start = (start_idx - margin).clamp(min=0, max=mel_max_length - window_size)
+        positions = window_start.unsqueeze(1) + torch.arange(window_size, device=x.device)
+        window_mask = positions < mel_lengths.unsqueeze(1)
+
+        y = self.feature_upsampler(hs=x, ds=durations, h_masks=window_mask, d_masks=d_masks, positions=positions)
+        if isinstance(self.decoder, LightSpeechTransformerDecoder):
+            # Uses absolute positional embeddings
+            y = self.decoder(y, ~window_mask, positions=positions)
+        else:
+            y = self.decoder(y, ~window_mask)
+        segment = get_segments(y.transpose(1, 2), start_idx - window_start, segment_size)
+        return segment, start_idx, segment_size
+
+    def _encode(self, x, input_padding_mask, sids, lids):
+        # text embedding
+        x, __ = self.text_embedding(x)
+
+        # Encoder
+        x = self.encoder(x, input_padding_mask)
+
+        # Speaker and language embedding
+        if sids is not None:
+            sid_emb = self.sid_embed(sids.view(-1))
+            x = x + sid_emb.unsqueeze(1)
+        if lids is not None:
+            lid_embs = self.lid_embed(lids.view(-1))
+            x = x + lid_embs.unsqueeze(1)
+        return x
+
+    def _align(self, x, x_lengths, mel, mel_lengths, pitches, energies, input_padding_mask):
+        if self.alignment_module is None:
+            raise ValueError("This generator was built without the alignment module, and needs precomputed durations")
+        log_p_attn = self.alignment_module(
+            text=x,
+            feats=mel.transpose(1, 2),
+            text_lengths=x_lengths,
+            feats_lengths=mel_lengths,
+            x_masks=input_padding_mask,
+        )
+        durations, bin_loss = viterbi_decode(log_p_attn, x_lengths, mel_lengths)
+
+        # Average pitch and energy values based on durations
+        pitches, energies = average_by_duration(
+            durations, torch.stack([pitches, energies], dim=-1), x_lengths, mel_lengths
+        ).unbind(dim=-1)
+        return log_p_attn, durations, bin_loss, pitches, energies
+
+    @torch.no_grad()
+    def optimize_for_inference(self):
+        """
+        Fold constant computations and strip training-only modules in place.
+
+        - Positional embedding tables are precomputed and embedding scales are folded into the weights
+        - The two linear layers of the WaveNeXt head are merged into one
+        - Dropout layers are removed, and weight norm is folded into the weights
+
+        The resulting weights are not compatible with training checkpoints.
+        """
+        if getattr(self, "is_optimized_for_inference", False):
+            return self
+        self.eval()
+        for module in list(self.modules()):
+            if hasattr(module, "fold_for_inference"):
+                module.fold_for_inference()
+        for module in list(self.modules()):
+            for name, child in module.named_children():
+                if isinstance(child, (nn.Dropout, DropPath)):
+                    setattr(module, name, nn.Identity())
+                elif torch.nn.utils.parametrize.is_parametrized(child, "weight"):
+                    torch.nn.utils.parametrize.remove_parametrizations(child, "weight", leave_parametrized=True)
+                elif hasattr(child, "weight_g"):
+                    torch.nn.utils.remove_weight_norm(child)
+        self.requires_grad_(False)
+        self.is_optimized_for_inference = True
+        return self
+
     @torch.inference_mode()
     def synthesise(self, x, x_lengths, sids=None, lids=None, d_factor=1.0, p_factor=1.0, e_factor=1.0):
         """
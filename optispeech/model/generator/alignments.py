@@ -2,13 +2,13 @@
 #  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
 
 import logging
+from collections import OrderedDict
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from numba import jit
-from scipy.stats import betabinom
+from numba import jit, prange
 
 
 class AlignmentModule(nn.Module):
@@ -18,18 +18,21 @@ class AlignmentModule(nn.Module):
 
     """
 
-    def __init__(self, adim, odim, cache_prior=True):
+    def __init__(self, adim, odim, cache_prior=True, prior_cache_bytes=64 * 1024**2):
         """Initialize AlignmentModule.
 
         Args:
             adim (int): Dimension of attention.
             odim (int): Dimension of feats.
             cache_prior (bool): Whether to cache beta-binomial prior.
+            prior_cache_bytes (int): Maximum size of the prior cache (least recently used priors are dropped).
 
         """
         super().__init__()
         self.cache_prior = cache_prior
-        self._cache = {}
+        self.prior_cache_bytes = prior_cache_bytes
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
 
         self.t_conv1 = nn.Conv1d(adim, adim, kernel_size=3, padding=1)
         self.t_conv2 = nn.Conv1d(adim, adim, kernel_size=1, padding=0)
@@ -63,8 +66,9 @@ class AlignmentModule(nn.Module):
         feats = self.f_conv3(feats)
         feats = feats.transpose(1, 2)
 
-        dist = feats.unsqueeze(2) - text.unsqueeze(1)
-        dist = torch.norm(dist, p=2, dim=3)
+        # Pairwise L2 distance (B, T_feats, T_text), computed with matrix products
+        # instead of materializing the (B, T_feats, T_text, adim) difference tensor
+        dist = torch.cdist(feats, text, p=2.0)
         score = -dist
 
         if x_masks is not None:
@@ -85,6 +89,9 @@ class AlignmentModule(nn.Module):
     def _generate_prior(self, text_lengths, feats_lengths, w=1) -> torch.Tensor:
         """Generate alignment prior formulated as beta-binomial distribution
 
+        Priors are cached per item (keyed by its text and feature lengths), and the batch
+        is assembled from them, so an utterance hits the cache whatever batch it is drawn in.
+
         Args:
             text_lengths (Tensor): Batch of the lengths of each input (B,).
             feats_lengths (Tensor): Batch of the lengths of each target (B,).
@@ -94,33 +101,103 @@ class AlignmentModule(nn.Module):
             Tensor: Batched 2d static prior matrix (B, T_feats, T_text).
 
         """
-        B = len(text_lengths)
-        T_text = text_lengths.max()
-        T_feats = feats_lengths.max()
-
-        bb_prior = torch.full((B, T_feats, T_text), fill_value=-np.inf)
-        for bidx in range(B):
-            T = feats_lengths[bidx].item()
-            N = text_lengths[bidx].item()
-
-            key = str(T) + "," + str(N)
-            if self.cache_prior and key in self._cache:
-                prob = self._cache[key]
-            else:
-                alpha = w * np.arange(1, T + 1, dtype=float)  # (T,)
-                beta = w * np.array([T - t + 1 for t in alpha])
-                k = np.arange(N)
-                batched_k = k[..., None]  # (N,1)
-                prob = betabinom.logpmf(batched_k, N, alpha, beta)  # (N,T)
+        if not self.cache_prior:
+            return beta_binomial_log_prior(text_lengths, feats_lengths, w)
+
+        device = text_lengths.device
+        keys = [(N, T, w, str(device)) for (N, T) in zip(text_lengths.tolist(), feats_lengths.tolist())]
+        priors = {}
+        for key in keys:
+            prior = self._cache.get(key)
+            if prior is not None:
+                self._cache.move_to_end(key)
+                priors[key] = prior
+        missing = list(dict.fromkeys(key for key in keys if key not in priors))
+        if missing:
+            new_priors = beta_binomial_log_prior(
+                torch.tensor([N for (N, *__) in missing], device=device),
+                torch.tensor([T for (__, T, *__) in missing], device=device),
+                w,
+            )
+            for (idx, key) in enumerate(missing):
+                N, T = key[:2]
+                # Copied, so that cached items don't keep the whole batch alive
+                priors[key] = new_priors[idx, :T, :N].clone()
+                self._add_to_cache(key, priors[key])
+
+        bb_prior = torch.full(
+            (len(keys), feats_lengths.max(), text_lengths.max()), -np.inf, dtype=torch.float, device=device
+        )
+        for (idx, key) in enumerate(keys):
+            N, T = key[:2]
+            bb_prior[idx, :T, :N] = priors[key]
+        return bb_prior
 
-            # store cache
-            if self.cache_prior and key not in self._cache:
-                self._cache[key] = prob
+    def _add_to_cache(self, key, prior):
+        prior_bytes = prior.numel() * prior.element_size()
+        if prior_bytes > self.prior_cache_bytes:
+            return
+        self._cache[key] = prior
+        self._cache_bytes += prior_bytes
+        # Least recently used first
+        while self._cache_bytes > self.prior_cache_bytes:
+            __, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted.numel() * evicted.element_size()
 
-            prob = torch.from_numpy(prob).transpose(0, 1)  # -> (T,N)
-            bb_prior[bidx, :T, :N] = prob
+    def __getstate__(self):
+        # Don't pickle (or deep-copy) cached priors
+        state = super().__getstate__()
+        state["_cache"] = OrderedDict()
+        state["_cache_bytes"] = 0
+        return state
 
-        return bb_prior
+
+def beta_binomial_log_prior(text_lengths, feats_lengths, w=1) -> torch.Tensor:
+    """Log of the beta-binomial alignment prior of a batch, computed on the device of the lengths.
+
+    Args:
+        text_lengths (Tensor): Batch of the lengths of each input (B,).
+        feats_lengths (Tensor): Batch of the lengths of each target (B,).
+        w (float): Scaling factor; lower -> wider the width.
+
+    Returns:
+        Tensor: Batched 2d static prior matrix (B, T_feats, T_text), -inf outside of each item.
+
+    """
+    device = text_lengths.device
+    T_text = text_lengths.max()
+    T_feats = feats_lengths.max()
+    N = text_lengths.double().view(-1, 1, 1)
+    T = feats_lengths.double().view(-1, 1, 1)
+    t = torch.arange(1, T_feats + 1, dtype=torch.float64, device=device).view(1, -1, 1)
+    k = torch.arange(T_text, dtype=torch.float64, device=device).view(1, 1, -1)
+
+    # Same parametrization as `scipy.stats.betabinom.logpmf(k, N, alpha, beta)`:
+    # log(N choose k) + log_beta(k + alpha, N - k + beta) - log_beta(alpha, beta)
+    # The terms are grouped by the dimensions they depend on, so that only
+    # `lgamma(k + alpha)` and `lgamma(N - k + beta)` are evaluated over the (T_feats, T_text) grid.
+    alpha = w * t  # (1, T_feats, 1)
+    beta = w * (T - alpha + 1)  # (B, T_feats, 1)
+    log_comb = torch.lgamma(N + 1) - torch.lgamma(k + 1) - torch.lgamma(N - k + 1)  # (B, 1, T_text)
+    log_norm = torch.lgamma(alpha + beta) - torch.lgamma(alpha) - torch.lgamma(beta) - torch.lgamma(N + alpha + beta)
+    log_prob = log_comb + log_norm  # (B, T_feats, T_text)
+    if float(w).is_integer():
+        # Integer arguments: look lgamma up in a table of lgamma(1..) instead of evaluating it per element
+        w = int(w)
+        max_arg = w * (T_text + w * T_feats + T_feats + 1)
+        table = torch.lgamma(torch.arange(1, max_arg + 1, dtype=torch.float64, device=device))
+        t_idx = torch.arange(1, T_feats + 1, device=device).view(1, -1, 1)
+        k_idx = torch.arange(T_text, device=device).view(1, 1, -1)
+        log_prob += table[k_idx + w * t_idx - 1]
+        # N - k + beta - 1, which is negative only in the padded part
+        idx = (text_lengths + w * feats_lengths + w - 1).view(-1, 1, 1) - (k_idx + w * w * t_idx)
+        log_prob += table[idx.clamp_(min=0)]
+    else:
+        log_prob += torch.lgamma(k + alpha)
+        log_prob += torch.lgamma(N - k + beta)
+
+    mask = (t > T) | (k >= N)
+    return log_prob.masked_fill_(mask, -np.inf).float()
 
 
 class GaussianUpsampling(torch.nn.Module):
@@ -133,7 +210,7 @@ class GaussianUpsampling(torch.nn.Module):
         super().__init__()
         self.delta = delta
 
-    def forward(self, hs, ds, h_masks=None, d_masks=None):
+    def forward(self, hs, ds, h_masks=None, d_masks=None, positions=None):
         """Upsample hidden states according to durations.
 
         Args:
@@ -141,6 +218,7 @@ class GaussianUpsampling(torch.nn.Module):
             ds (Tensor): Batched token duration (B, T_text).
             h_masks (Tensor): Mask tensor (B, T_feats).
             d_masks (Tensor): Mask tensor (B, T_text).
+            positions (Tensor): Frame indices to compute (B, T_feats), all frames if not given.
 
         Returns:
             Tensor: Expanded hidden state (B, T_feat, adim).
@@ -156,11 +234,15 @@ class GaussianUpsampling(torch.nn.Module):
             #   So we do not need to care the padded sequence case here.
             ds[ds.sum(dim=1).eq(0)] = 1
 
-        if h_masks is None:
-            T_feats = ds.sum().int()
+        if positions is not None:
+            T_feats = positions.size(-1)
+            t = positions.float()
         else:
-            T_feats = h_masks.size(-1)
-        t = torch.arange(0, T_feats).unsqueeze(0).repeat(B, 1).to(device).float()
+            if h_masks is None:
+                T_feats = ds.sum().int()
+            else:
+                T_feats = h_masks.size(-1)
+            t = torch.arange(0, T_feats).unsqueeze(0).repeat(B, 1).to(device).float()
         if h_masks is not None:
             t = t * h_masks.float()
 
@@ -207,74 +289,99 @@ def _monotonic_alignment_search(log_p_attn):
     return A
 
 
-def viterbi_decode(log_p_attn, text_lengths, feats_lengths):
+@jit(nopython=True, parallel=True)
+def _batched_monotonic_alignment_search(log_p_attn, text_lengths, feats_lengths):
+    B = log_p_attn.shape[0]
+    T_feats = log_p_attn.shape[1]
+    paths = np.zeros((B, T_feats), dtype=np.int64)
+    for b in prange(B):
+        T_mel = feats_lengths[b]
+        T_inp = text_lengths[b]
+        paths[b, :T_mel] = _monotonic_alignment_search(log_p_attn[b, :T_mel, :T_inp])
+    return paths
+
+
+def viterbi_decode(log_p_attn, text_lengths, feats_lengths, return_paths=False):
     """Extract duration from an attention probability matrix
 
+    The alignment search of all batch items runs in parallel (numba `prange`) on
+    the padded batch, so there is a single device to host round-trip per call.
+
     Args:
         log_p_attn (Tensor): Batched log probability of attention
             matrix (B, T_feats, T_text).
         text_lengths (Tensor): Text length tensor (B,).
         feats_legnths (Tensor): Feature length tensor (B,).
+        return_paths (bool): Whether to also return the viterbi paths.
 
     Returns:
         Tensor: Batched token duration extracted from `log_p_attn` (B, T_text).
         Tensor: Binarization loss tensor ().
+        Tensor: (if `return_paths`) Token index of each frame (B, T_feats). Padded frames are 0.
 
     """
     B = log_p_attn.size(0)
     T_text = log_p_attn.size(2)
+    T_feats = log_p_attn.size(1)
     device = log_p_attn.device
 
-    bin_loss = 0
-    ds = torch.zeros((B, T_text), device=device)
-    for b in range(B):
-        cur_log_p_attn = log_p_attn[b, : feats_lengths[b], : text_lengths[b]]
-        viterbi = _monotonic_alignment_search(cur_log_p_attn.detach().float().cpu().numpy())
-        _ds = np.bincount(viterbi)
-        ds[b, : len(_ds)] = torch.from_numpy(_ds).to(device)
-
-        t_idx = torch.arange(feats_lengths[b])
-        bin_loss = bin_loss - cur_log_p_attn[t_idx, viterbi].mean()
-    bin_loss = bin_loss / B
-    return ds, bin_loss
+    paths = _batched_monotonic_alignment_search(
+        log_p_attn.detach().float().cpu().numpy(),
+        text_lengths.cpu().numpy(),
+        feats_lengths.cpu().numpy(),
+    )
+    paths = torch.from_numpy(paths).to(device)
+    feats_mask = torch.arange(T_feats, device=device).unsqueeze(0) < feats_lengths.unsqueeze(1)
 
+    ds = torch.zeros((B, T_text), device=device)
+    ds.scatter_add_(1, paths, feats_mask.float())
 
-@jit(nopython=True)
-def _average_by_duration(ds, xs, text_lengths, feats_lengths):
-    B = ds.shape[0]
-    xs_avg = np.zeros_like(ds)
-    ds = ds.astype(np.int32)
-    for b in range(B):
-        t_text = text_lengths[b]
-        t_feats = feats_lengths[b]
-        d = ds[b, :t_text]
-        d_cumsum = d.cumsum()
-        d_cumsum = [0] + list(d_cumsum)
-        x = xs[b, :t_feats]
-        for n, (start, end) in enumerate(zip(d_cumsum[:-1], d_cumsum[1:])):
-            if len(x[start:end]) != 0:
-                xs_avg[b, n] = x[start:end].mean()
-            else:
-                xs_avg[b, n] = 0
-    return xs_avg
+    path_log_p = log_p_attn.gather(2, paths.unsqueeze(-1)).squeeze(-1)
+    path_log_p = path_log_p.masked_fill(~feats_mask, 0.0)
+    bin_loss = -(path_log_p.sum(dim=1) / feats_lengths).mean()
+    if return_paths:
+        return ds, bin_loss, paths
+    return ds, bin_loss
 
 
 def average_by_duration(ds, xs, text_lengths, feats_lengths):
     """Average frame-level features into token-level according to durations
 
+    Runs on the device of the inputs. Several features can be averaged in one
+    call by stacking them along the last dimension.
+
     Args:
         ds (Tensor): Batched token duration (B, T_text).
-        xs (Tensor): Batched feature sequences to be averaged (B, T_feats).
+        xs (Tensor): Batched feature sequences to be averaged (B, T_feats) or (B, T_feats, C).
         text_lengths (Tensor): Text length tensor (B,).
         feats_lengths (Tensor): Feature length tensor (B,).
 
     Returns:
-        Tensor: Batched feature averaged according to the token duration (B, T_text).
+        Tensor: Batched feature averaged according to the token duration (B, T_text) or (B, T_text, C).
 
     """
+    is_1d = xs.dim() == 2
+    if is_1d:
+        xs = xs.unsqueeze(-1)
+    B, T_feats, C = xs.shape
+    T_text = ds.size(1)
     device = ds.device
-    args = [ds, xs, text_lengths, feats_lengths]
-    args = [arg.detach().float().cpu().numpy() for arg in args]
-    xs_avg = _average_by_duration(*args)
-    xs_avg = torch.from_numpy(xs_avg).to(device)
+
+    token_mask = torch.arange(T_text, device=device).unsqueeze(0) < text_lengths.unsqueeze(1)
+    ds = ds.long().masked_fill(~token_mask, 0)
+    # Token index of each frame
+    t = torch.arange(T_feats, device=device).unsqueeze(0).expand(B, -1).contiguous()
+    token_idx = torch.searchsorted(ds.cumsum(dim=1), t, right=True)
+    frame_mask = (t < feats_lengths.unsqueeze(1)) & (token_idx < T_text)
+    token_idx = token_idx.clamp(max=T_text - 1)
+
+    # Sum in float64 to keep the result within float32 rounding of a sequential sum
+    frame_weights = frame_mask.double()
+    sums = torch.zeros((B, T_text, C), dtype=torch.float64, device=device)
+    sums.scatter_add_(1, token_idx.unsqueeze(-1).expand(-1, -1, C), xs.detach().double() * frame_weights.unsqueeze(-1))
+    counts = torch.zeros((B, T_text), dtype=torch.float64, device=device)
+    counts.scatter_add_(1, token_idx, frame_weights)
+    xs_avg = (sums / counts.clamp(min=1).unsqueeze(-1)).float()
+    if is_1d:
+        xs_avg = xs_avg.squeeze(-1)
     return xs_avg
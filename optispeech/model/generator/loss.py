@@ -167,28 +167,29 @@ class ForwardSumLoss(torch.nn.Module):
             Tensor: forwardsum loss value.
 
         """
-        B = log_p_attn.size(0)
+        B, T_feats, T_text = log_p_attn.shape
 
         # a row must be added to the attention matrix to account for
         #    blank token of CTC loss
         # (B,T_feats,T_text+1)
         log_p_attn_pd = F.pad(log_p_attn, (1, 0, 0, 0, 0, 0), value=np.log(blank_prob))
-
-        loss = 0
-        for bidx in range(B):
-            # construct target sequnece.
-            # Every text token is mapped to a unique sequnece number.
-            target_seq = torch.arange(1, ilens[bidx] + 1).unsqueeze(0)
-            cur_log_p_attn_pd = log_p_attn_pd[bidx, : olens[bidx], : ilens[bidx] + 1].unsqueeze(
-                1
-            )  # (T_feats,1,T_text+1)
-            cur_log_p_attn_pd = F.log_softmax(cur_log_p_attn_pd, dim=-1)
-            loss += F.ctc_loss(
-                log_probs=cur_log_p_attn_pd,
-                targets=target_seq,
-                input_lengths=olens[bidx : bidx + 1],
-                target_lengths=ilens[bidx : bidx + 1],
-                zero_infinity=True,
-            )
-        loss = loss / B
+        # exclude padded text tokens from the softmax, and padded frames from the loss.
+        # A finite fill value keeps the gradient of `ctc_loss` free of NaNs (exp(-1e4) is 0 anyway)
+        device = log_p_attn.device
+        token_mask = torch.arange(T_text + 1, device=device).unsqueeze(0) > ilens.unsqueeze(1)
+        frame_mask = torch.arange(T_feats, device=device).unsqueeze(0) >= olens.unsqueeze(1)
+        pad_mask = token_mask.unsqueeze(1) | frame_mask.unsqueeze(2)
+        log_p_attn_pd = log_p_attn_pd.masked_fill(pad_mask, -1e4)
+        log_p_attn_pd = F.log_softmax(log_p_attn_pd, dim=-1)
+
+        # construct target sequnece.
+        # Every text token is mapped to a unique sequnece number.
+        target_seq = torch.arange(1, T_text + 1, device=device).unsqueeze(0).expand(B, -1)
+        loss = F.ctc_loss(
+            log_probs=log_p_attn_pd.transpose(0, 1),  # (T_feats,B,T_text+1)
+            targets=target_seq,
+            input_lengths=olens,
+            target_lengths=ilens,
+            zero_infinity=True,
+        )
         return loss
@@ -83,6 +83,8 @@ class ConvNeXtBackbone(nn.Module):
         )
         self.final_layer_norm = nn.LayerNorm(dim, eps=1e-6)
         self.apply(self._init_weights)
+        # Number of frames on each side that an output frame depends on
+        self.receptive_field = sum(block.dwconv.kernel_size[0] // 2 for block in self.convnext)
 
     def _init_weights(self, m):
         if isinstance(m, (nn.Conv1d, nn.Linear)):
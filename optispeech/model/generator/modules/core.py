@@ -17,6 +17,7 @@ class TextEmbedding(nn.Module):
         max_source_positions: int = DEFAULT_MAX_SOURCE_POSITIONS,
     ):
         super().__init__()
+        self.max_source_positions = max_source_positions
         self.embed_scale = math.sqrt(dim)
         self.embed_tokens = nn.Embedding(n_vocab, dim, padding_idx)
         self.embed_positions = ScaledSinusoidalEmbedding(dim, theta=max_source_positions)
@@ -24,12 +25,22 @@ class TextEmbedding(nn.Module):
 
     def forward(self, src_tokens):
         """embed tokens and positions."""
-        embed = self.embed_scale * self.embed_tokens(src_tokens)
+        embed = self.embed_tokens(src_tokens)
+        if self.embed_scale != 1.0:
+            embed = self.embed_scale * embed
         positions = self.embed_positions(src_tokens)
         x = embed + positions
         x = self.emb_dropout(x)
         return x, embed
 
+    @torch.no_grad()
+    def fold_for_inference(self):
+        """Fold `embed_scale` into the token embeddings and precompute positional embeddings."""
+        weight = self.embed_tokens.weight
+        self.embed_tokens.weight = nn.Parameter(weight * self.embed_scale, requires_grad=False)
+        self.embed_scale = 1.0
+        self.embed_positions.precompute(self.max_source_positions)
+
 
 class VariancePredictor(torch.nn.Module):
     """
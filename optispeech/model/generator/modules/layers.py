@@ -55,21 +55,37 @@ class ScaledSinusoidalEmbedding(nn.Module):
         freq_seq = torch.arange(half_dim).float() / half_dim
         inv_freq = theta ** -freq_seq.float()
         self.register_buffer("inv_freq", inv_freq, persistent=False)
+        # Filled by `precompute` for inference
+        self.register_buffer("pos_table", None, persistent=False)
 
     def forward(self, x, pos=None, seq_start_pos=None):
         seq_len = x.size(1)
         device = x.device
 
+        if (pos is None) and (seq_start_pos is None) and (self.pos_table is not None):
+            # Exported graphs compute the embeddings instead, so that their input length isn't bounded
+            if (not torch.onnx.is_in_onnx_export()) and (seq_len <= self.pos_table.shape[0]):
+                return self.pos_table[:seq_len]
+
         if pos is None:
             pos = torch.arange(seq_len, device=device)
 
         if seq_start_pos is not None:
             pos = pos - seq_start_pos[..., None]
 
-        emb = einsum("i, j -> i j", pos.float(), self.inv_freq)
+        return self._embed(pos)
+
+    def _embed(self, pos):
+        emb = einsum("... i, j -> ... i j", pos.float(), self.inv_freq)
         emb = torch.cat((emb.sin(), emb.cos()), dim=-1)
         return emb * self.scale
 
+    @torch.no_grad()
+    def precompute(self, max_positions: int):
+        """Cache the embeddings of positions `0..max_positions - 1`."""
+        pos = torch.arange(max_positions, device=self.inv_freq.device)
+        self.pos_table = self._embed(pos)
+
 
 class MultiheadAttention(nn.Module):
     def __init__(
@@ -63,15 +63,18 @@ class LightSpeechTransformerDecoder(nn.Module):
         )
         self.dropout = nn.Dropout(dropout)
         self.layer_norm = nn.LayerNorm(dim)
+        # Number of frames on each side that an output frame depends on (two convs per layer)
+        self.receptive_field = sum(2 * (kernel_size // 2) for kernel_size in kernel_sizes)
 
-    def forward(self, x, padding_mask, *, require_w=False):
+    def forward(self, x, padding_mask, *, require_w=False, positions=None):
         """
         :param x: [B, T, C]
         :param padding_mask: [B, T]
         :param require_w: True if this module needs to return weight matrix
+        :param positions: [B, T] absolute frame positions of `x` if it is a window of a longer sequence
         :return: [B, T, C]
         """
-        positions = self.pos_emb(x[..., 0])
+        positions = self.pos_emb(x[..., 0], pos=positions)
         x = x + positions
         x = x * (1 - padding_mask.float())[..., None]
         x = self.dropout(x)
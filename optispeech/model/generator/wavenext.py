@@ -47,6 +47,21 @@ class WaveNeXtHead(nn.Module):
         audio = torch.clip(audio, min=-1.0, max=1.0)
         return audio
 
+    @torch.no_grad()
+    def fold_for_inference(self):
+        """Merge `linear_1` and `linear_2` into a single linear layer (there is no nonlinearity between them)."""
+        weight_1 = self.linear_1.weight.double()
+        bias_1 = self.linear_1.bias.double()
+        weight_2 = self.linear_2.weight.double()
+        linear = torch.nn.Linear(
+            weight_1.shape[1], weight_2.shape[0], device=weight_1.device, dtype=self.linear_1.weight.dtype
+        )
+        linear.weight.copy_(weight_2 @ weight_1)
+        linear.bias.copy_(weight_2 @ bias_1)
+        linear.requires_grad_(False)
+        self.linear_1 = linear
+        self.linear_2 = nn.Identity()
+
 
 class WaveNeXt(nn.Module):
     def __init__(
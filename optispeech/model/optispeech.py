@@ -1,13 +1,18 @@
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 import torch
 from torch import nn
 
+from optispeech.text.phonemizer_pool import PhonemizerPool
 from optispeech.utils import pad_list
 from optispeech.values import InferenceInputs, InferenceOutputs
 
 from .base_lightning_module import BaseLightningModule
 
+# Marker stored in inference-only (slim) checkpoints
+SLIM_CHECKPOINT_FORMAT = "optispeech-slim"
+SLIM_CHECKPOINT_VERSION = 1
+
 
 class OptiSpeech(BaseLightningModule):
     def __init__(
@@ -20,6 +25,7 @@ class OptiSpeech(BaseLightningModule):
         inference_args,
         optimizer=None,
         scheduler=None,
+        use_alignment_module=None,
     ):
         super().__init__()
         self.save_hyperparameters(logger=False)
@@ -44,14 +50,87 @@ class OptiSpeech(BaseLightningModule):
         # GAN training requires this
         self.automatic_optimization = False
 
+        # The alignment module learns durations, so it is not needed when they are precomputed
+        if use_alignment_module is None:
+            use_alignment_module = not data_args.get("use_precomputed_durations", False)
+
         self.generator = generator(
             dim=dim,
             feature_extractor=data_args.feature_extractor,
             data_statistics=data_args.data_statistics,
             num_speakers=self.data_args.num_speakers,
             num_languages=self.text_processor.num_languages,
+            use_alignment_module=use_alignment_module,
         )
-        self.discriminator = discriminator(feature_extractor=data_args.feature_extractor)
+        # The discriminator is not needed for inference (see `load_from_slim_checkpoint`)
+        if discriminator is not None:
+            self.discriminator = discriminator(feature_extractor=data_args.feature_extractor)
+        else:
+            self.discriminator = None
+
+    @classmethod
+    def load_from_slim_checkpoint(cls, checkpoint_path, map_location="cpu", mmap=True) -> "OptiSpeech":
+        """
+        Load an inference-only model from a slim checkpoint written by
+        `optispeech.tools.export_slim_checkpoint`.
+
+        Only the generator modules needed by `synthesise` are built. The weights are
+        assigned directly from the loaded (optionally memory-mapped) tensors without copying.
+
+        Args:
+            checkpoint_path (str|Path): path to the slim checkpoint
+            map_location (str|torch.device): device to map the weights to
+            mmap (bool): memory-map the weights instead of reading them into memory
+
+        Returns:
+            OptiSpeech: model in eval mode
+        """
+        checkpoint = torch.load(checkpoint_path, map_location=map_location, mmap=mmap, weights_only=False)
+        if checkpoint.get("format") != SLIM_CHECKPOINT_FORMAT:
+            raise ValueError(f"`{checkpoint_path}` is not a slim OptiSpeech checkpoint")
+        hparams = dict(checkpoint["hyper_parameters"])
+        hparams["discriminator"] = None
+        hparams["optimizer"] = None
+        hparams["scheduler"] = None
+        # Not used during inference
+        hparams["use_alignment_module"] = False
+        model = cls(**hparams)
+        model.generator.load_state_dict(checkpoint["state_dict"], assign=True)
+        model.ckpt_loaded_epoch = checkpoint["epoch"]
+        model.ckpt_loaded_global_step = checkpoint["global_step"]
+        return model.eval()
+
+    def on_load_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        super().on_load_checkpoint(checkpoint)
+        if self.generator.alignment_module is None:
+            self._drop_alignment_module_from_checkpoint(checkpoint)
+
+    def _drop_alignment_module_from_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        """
+        Adapt a checkpoint trained with the alignment module (e.g. when continuing training
+        with precomputed durations): drop its weights and its optimizer states.
+        """
+        prefix = "generator.alignment_module."
+        state_dict = checkpoint["state_dict"]
+        if not any(name.startswith(prefix) for name in state_dict):
+            return
+        # The generator optimizer numbers the parameters in the order of `generator.parameters()`,
+        # which is also their order in the state dict (the alignment module has no buffers)
+        param_names = {f"generator.{name}" for (name, __) in self.generator.named_parameters()}
+        ckpt_param_names = [name for name in state_dict if name.startswith(prefix) or name in param_names]
+        kept_idxs = [idx for (idx, name) in enumerate(ckpt_param_names) if not name.startswith(prefix)]
+        for name in ckpt_param_names:
+            if name.startswith(prefix):
+                del state_dict[name]
+        optimizer_states = checkpoint.get("optimizer_states")
+        if optimizer_states:
+            gen_optimizer_state = optimizer_states[0]
+            new_idxs = {old_idx: new_idx for (new_idx, old_idx) in enumerate(kept_idxs)}
+            gen_optimizer_state["state"] = {
+                new_idxs[idx]: state for (idx, state) in gen_optimizer_state["state"].items() if idx in new_idxs
+            }
+            for param_group in gen_optimizer_state["param_groups"]:
+                param_group["params"] = [new_idxs[idx] for idx in param_group["params"] if idx in new_idxs]
 
     @torch.inference_mode()
     def synthesise(self, inputs: InferenceInputs) -> InferenceOutputs:
@@ -88,6 +167,7 @@ class OptiSpeech(BaseLightningModule):
         p_factor: float=None,
         e_factor: float=None,
         split_sentences: bool = True,
+        phonemizer: Optional[PhonemizerPool] = None,
     ) -> InferenceInputs:
         """
         Convenient helper.
@@ -100,6 +180,8 @@ class OptiSpeech(BaseLightningModule):
             p_factor (float|None): scaling value for pitch
             e_factor (float|None): scaling value for energy
             split_sentences (bool): split text into sentences (each sentence is an element in the batch)
+            phonemizer (PhonemizerPool|None): phonemize the text in the worker processes of this pool
+                (created from `self.text_processor`) instead of in this process
 
         Returns:
             InferenceInputs
@@ -127,7 +209,8 @@ class OptiSpeech(BaseLightningModule):
         else:
             lid = None
 
-        input_ids, clean_text = self.text_processor(text, lang=language, split_sentences=split_sentences)
+        text_processor = phonemizer if phonemizer is not None else self.text_processor
+        input_ids, clean_text = text_processor(text, lang=language, split_sentences=split_sentences)
         if split_sentences:
             lengths = [len(phids) for phids in input_ids]
         else:
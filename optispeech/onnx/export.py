@@ -69,7 +69,10 @@ def export_as_onnx(model, out_filename, opset):
 
     model._jit_is_scripting = True
     model_gen = model.generator
-    del model_gen.alignment_module
+    # Slim checkpoints are loaded without the alignment module
+    if hasattr(model_gen, "alignment_module"):
+        del model_gen.alignment_module
+    model_gen.optimize_for_inference()
 
     def _infer_forward(x, x_lengths, scales, sids=None, lids=None):
         d_factor = scales[0]
@@ -95,7 +98,7 @@ def export_as_onnx(model, out_filename, opset):
     return out_filename
 
 
-def add_inference_metadata(onnxfile, model):
+def add_inference_metadata(onnxfile, model, external_data=False):
     onnx_model = onnx.load(onnxfile)
 
     text_processor = model.text_processor
@@ -122,7 +125,17 @@ def add_inference_metadata(onnxfile, model):
     m1.key = "inference"
     m1.value = inference_data
     onnx.checker.check_model(onnx_model)
-    onnx.save(onnx_model, onnxfile)
+    if not external_data:
+        onnx.save(onnx_model, onnxfile)
+        return
+    # Store weights in a separate file next to the model
+    onnx.save_model(
+        onnx_model,
+        onnxfile,
+        save_as_external_data=True,
+        all_tensors_to_one_file=True,
+        location=Path(onnxfile).name + ".data",
+    )
 
 
 def main():
@@ -131,22 +144,30 @@ def main():
     parser.add_argument(
         "checkpoint_path",
         type=str,
-        help="Path to the model checkpoint",
+        help="Path to the model checkpoint (lightning `.ckpt` or slim checkpoint)",
     )
     parser.add_argument("output", type=str, help="Path to output `.onnx` file")
     parser.add_argument("--opset", type=int, default=DEFAULT_OPSET, help="ONNX opset version to use (default 15")
     parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="Random seed")
+    parser.add_argument(
+        "--external-data",
+        action="store_true",
+        help="Store weights in a separate `<output>.data` file instead of embedding them in the model",
+    )
 
     args = parser.parse_args()
     seed_everything(args.seed)
 
     log.info(f"Loading checkpoint from {args.checkpoint_path}")
     checkpoint_path = Path(args.checkpoint_path)
-    model = OptiSpeech.load_from_checkpoint(checkpoint_path, map_location="cpu")
+    if checkpoint_path.suffix == ".ckpt":
+        model = OptiSpeech.load_from_checkpoint(checkpoint_path, map_location="cpu")
+    else:
+        model = OptiSpeech.load_from_slim_checkpoint(checkpoint_path, map_location="cpu")
     model.eval()
 
     export_as_onnx(model, args.output, args.opset)
-    add_inference_metadata(args.output, model)
+    add_inference_metadata(args.output, model, external_data=args.external_data)
     log.info(f"ONNX model exported to  {args.output}")
 
 
@@ -0,0 +1,177 @@
+"""
+Pre-fork HTTP server for OptiSpeech models.
+
+The model is loaded once in the parent process, then the worker processes are forked from it.
+Workers share the parent's read-only weight pages (copy-on-write), so adding a worker
+costs roughly the memory needed for activations instead of a full copy of the model.
+Slim checkpoints are additionally memory-mapped, so their pages are shared through the page cache.
+
+Endpoints:
+    GET  /health      -> {"status": "ok", "pid": <worker pid>}
+    POST /synthesise  -> audio/wav
+        JSON body: {"text": str, "language": str, "speaker": str|int, "d_factor": float, "p_factor": float, "e_factor": float}
+"""
+
+import argparse
+import gc
+import io
+import json
+import os
+import signal
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import onnxruntime
+import soundfile as sf
+import torch
+
+from optispeech.model import OptiSpeech
+from optispeech.onnx.infer import OptiSpeechONNXModel
+from optispeech.utils import get_script_logger
+
+log = get_script_logger(__name__)
+
+
+def load_model(model_path: str):
+    """Load an ONNX model, a slim checkpoint or a lightning checkpoint for serving."""
+    if model_path.endswith(".onnx"):
+        # onnxruntime thread pools don't survive `fork`, so each worker runs single-threaded
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = 1
+        session_options.inter_op_num_threads = 1
+        return OptiSpeechONNXModel.from_onnx_file_path(model_path, session_options=session_options)
+    if model_path.endswith(".ckpt"):
+        model = OptiSpeech.load_from_checkpoint(model_path, map_location="cpu")
+        # Not used during inference
+        del model.discriminator
+        del model.generator.alignment_module
+    else:
+        model = OptiSpeech.load_from_slim_checkpoint(model_path, map_location="cpu", mmap=True)
+    model.generator.optimize_for_inference()
+    return model.eval()
+
+
+def synthesise_wav(model, params: dict) -> np.ndarray:
+    # The ONNX and pytorch models name the language argument differently
+    lang_kwarg = "lang" if isinstance(model, OptiSpeechONNXModel) else "language"
+    inputs = model.prepare_input(
+        params["text"],
+        speaker=params.get("speaker"),
+        d_factor=params.get("d_factor"),
+        p_factor=params.get("p_factor"),
+        e_factor=params.get("e_factor"),
+        split_sentences=True,
+        **{lang_kwarg: params.get("language")},
+    )
+    outputs = model.synthesise(inputs)
+    wavs = [np.asarray(wav).squeeze() for wav in outputs.unbatched_wavs()]
+    return np.concatenate(wavs)
+
+
+class SynthesisRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        self._send(HTTPStatus.OK, json.dumps(dict(status="ok", pid=os.getpid())).encode("utf-8"), "application/json")
+
+    def do_POST(self):
+        if self.path != "/synthesise":
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+            params = json.loads(self.rfile.read(content_length))
+            if not params.get("text", "").strip():
+                raise ValueError("`text` is required")
+        except (ValueError, AttributeError) as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        try:
+            wav = synthesise_wav(self.server.model, params)
+        except ValueError as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        buffer = io.BytesIO()
+        sf.write(buffer, wav, self.server.model.sample_rate, format="WAV")
+        self._send(HTTPStatus.OK, buffer.getvalue(), "audio/wav")
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(f"[{os.getpid()}] {self.address_string()} - {format % args}")
+
+
+class SynthesisServer(HTTPServer):
+    def __init__(self, server_address, model):
+        super().__init__(server_address, SynthesisRequestHandler)
+        self.model = model
+
+
+def serve_prefork(server: SynthesisServer, num_workers: int, num_threads: int = 1):
+    """Fork `num_workers` processes that accept connections on the (already bound) server socket."""
+    # Keep the garbage collector from touching (and un-sharing) objects created before forking
+    gc.freeze()
+    worker_pids = []
+    for __ in range(num_workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            torch.set_num_threads(num_threads)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        worker_pids.append(pid)
+    log.info(f"Started {num_workers} workers: {worker_pids}")
+
+    def _terminate_workers(signum, frame):
+        for pid in worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, _terminate_workers)
+    signal.signal(signal.SIGINT, _terminate_workers)
+    for pid in worker_pids:
+        os.waitpid(pid, 0)
+    server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-fork HTTP server for OptiSpeech")
+    parser.add_argument(
+        "model_path",
+        type=str,
+        help="Path to an ONNX model, a slim checkpoint or a lightning checkpoint",
+    )
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="Host to serve on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to serve on.")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of torch threads per worker (ONNX workers are always single-threaded)",
+    )
+    args = parser.parse_args()
+
+    log.info(f"Loading model from {args.model_path}")
+    model = load_model(args.model_path)
+    server = SynthesisServer((args.host, args.port), model)
+    log.info(f"Serving on {args.host}:{args.port}")
+    serve_prefork(server, args.workers, args.threads)
+
+
+if __name__ == "__main__":
+    main()
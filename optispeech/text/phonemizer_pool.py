@@ -0,0 +1,103 @@
+"""
+Phonemization in worker processes, with separate workers for each language.
+
+Phonemizers such as eSpeak keep global (per-process) language state, so texts of different
+languages can't be phonemized in parallel by threads of the same process. `PhonemizerPool`
+runs one pool of worker processes per language, each worker with its own text processor,
+and dispatches texts to the pool of their language.
+"""
+
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from optispeech.text import TextProcessor
+
+# Text processor of a worker process
+_worker_text_processor = None
+
+
+def _init_worker(text_processor_args):
+    global _worker_text_processor
+    _worker_text_processor = TextProcessor.from_dict(text_processor_args)
+
+
+def _phonemize(text, lang, split_sentences):
+    return _worker_text_processor(text, lang=lang, split_sentences=split_sentences)
+
+
+class PhonemizerPool:
+    """
+    Phonemizes texts in parallel, with `processes_per_language` worker processes for each language.
+
+    Can be called like the `TextProcessor` it was created from. Worker processes are started
+    when the first text of their language is submitted. Use `close()` (or a `with` block) to stop them.
+
+    Example:
+        >>> with PhonemizerPool(text_processor) as phonemizer:
+        ...     futures = [phonemizer.submit(text, lang) for (text, lang) in zip(texts, langs)]
+        ...     results = [future.result() for future in futures]
+    """
+
+    def __init__(self, text_processor: TextProcessor, processes_per_language: int = 1):
+        """
+        Args:
+            text_processor (TextProcessor): text processor to replicate in the worker processes
+            processes_per_language (int): number of worker processes for each language
+        """
+        if processes_per_language < 1:
+            raise ValueError("processes_per_language should be a positive integer >= 1")
+        self.text_processor_args = text_processor.asdict()
+        self.languages = text_processor.languages
+        self.default_language = text_processor.default_language
+        self.is_multi_language = text_processor.is_multi_language
+        self.processes_per_language = processes_per_language
+        self._executors = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self, lang: str) -> ProcessPoolExecutor:
+        with self._lock:
+            if lang not in self._executors:
+                # Spawned workers don't inherit the phonemizer state of this process
+                self._executors[lang] = ProcessPoolExecutor(
+                    max_workers=self.processes_per_language,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.text_processor_args,),
+                )
+            return self._executors[lang]
+
+    def submit(self, text: str, lang: str | None = None, split_sentences: bool = False) -> Future:
+        """
+        Phonemize a text in the worker processes of its language.
+
+        Returns:
+            Future: resolves to the `(phoneme_ids, normalized_text)` returned by the text processor
+        """
+        if lang is None:
+            lang = self.default_language
+        lang = lang.strip().lower()
+        if lang not in self.languages:
+            raise ValueError(f"Language {lang} does not exist in the supported language list.")
+        return self._get_executor(lang).submit(_phonemize, text, lang, split_sentences)
+
+    def __call__(self, text: str, lang: str | None = None, split_sentences: bool = False):
+        return self.submit(text, lang=lang, split_sentences=split_sentences).result()
+
+    def map(self, texts: list[str], langs: list[str | None], split_sentences: bool = False) -> list:
+        """Phonemize texts (of any languages) in parallel, returning the results in order."""
+        futures = [self.submit(text, lang=lang, split_sentences=split_sentences) for (text, lang) in zip(texts, langs)]
+        return [future.result() for future in futures]
+
+    def close(self):
+        with self._lock:
+            executors = list(self._executors.values())
+            self._executors.clear()
+        for executor in executors:
+            executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,69 @@
+import argparse
+from pathlib import Path
+
+import torch
+
+from optispeech.model.optispeech import SLIM_CHECKPOINT_FORMAT, SLIM_CHECKPOINT_VERSION
+from optispeech.utils import get_script_logger
+
+log = get_script_logger(__name__)
+
+# State-dict prefixes that are only used during training
+GENERATOR_PREFIX = "generator."
+TRAINING_ONLY_PREFIXES = ("generator.alignment_module.",)
+
+
+def make_slim_checkpoint(checkpoint: dict) -> dict:
+    """
+    Strip a lightning checkpoint down to what is needed for inference.
+
+    Drops the discriminator, the alignment module, optimizer and scheduler states,
+    and all callback states. Keeps the generator weights plus hyper-parameters.
+    """
+    state_dict = {
+        key.removeprefix(GENERATOR_PREFIX): value.contiguous()
+        for (key, value) in checkpoint["state_dict"].items()
+        if key.startswith(GENERATOR_PREFIX) and not key.startswith(TRAINING_ONLY_PREFIXES)
+    }
+    hparams = dict(checkpoint["hyper_parameters"])
+    for training_only_hparam in ("discriminator", "optimizer", "scheduler"):
+        hparams[training_only_hparam] = None
+    return dict(
+        format=SLIM_CHECKPOINT_FORMAT,
+        version=SLIM_CHECKPOINT_VERSION,
+        epoch=checkpoint["epoch"],
+        global_step=checkpoint["global_step"],
+        hyper_parameters=hparams,
+        state_dict=state_dict,
+    )
+
+
+def export_slim_checkpoint(checkpoint_path, output_path):
+    # mmap avoids reading optimizer states we'll throw away anyway
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", mmap=True, weights_only=False)
+    slim_checkpoint = make_slim_checkpoint(checkpoint)
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    # The zipfile format is what allows `torch.load(..., mmap=True)`
+    torch.save(slim_checkpoint, output_path, _use_new_zipfile_serialization=True)
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export an inference-only (slim) OptiSpeech checkpoint")
+    parser.add_argument(
+        "checkpoint_path",
+        type=str,
+        help="Path to the lightning checkpoint",
+    )
+    parser.add_argument("output", type=str, help="Path to output slim checkpoint (`.pt` file)")
+    args = parser.parse_args()
+
+    log.info(f"Loading checkpoint from {args.checkpoint_path}")
+    export_slim_checkpoint(args.checkpoint_path, args.output)
+    in_size = Path(args.checkpoint_path).stat().st_size / (1024**2)
+    out_size = Path(args.output).stat().st_size / (1024**2)
+    log.info(f"Slim checkpoint exported to {args.output} ({in_size:.2f} MB -> {out_size:.2f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import os
+from pathlib import Path
+
+import numpy as np
+import rootutils
+import torch
+from hydra import compose, initialize
+from omegaconf import open_dict
+from torch.utils.data.dataloader import DataLoader
+from tqdm.auto import tqdm
+
+from optispeech.dataset.text_wav_datamodule import DURATIONS_SUFFIX, TextWavBatchCollate, TextWavDataModule
+from optispeech.model import OptiSpeech
+from optispeech.utils import get_script_logger
+
+log = get_script_logger(__name__)
+
+
+@torch.no_grad()
+def extract_durations(model: OptiSpeech, dataloader: DataLoader, overwrite: bool = False) -> int:
+    """
+    Align every utterance with the model's alignment module, and write its durations
+    and phoneme-averaged pitch/energy next to the utterance's `.npz` file.
+
+    Pitch and energy are written denormalized (in the same units as the `.npz` file).
+    """
+    stats = model.data_args.data_statistics
+    num_written = 0
+    for batch in tqdm(dataloader, desc="Extracting", unit="batch"):
+        outputs = [Path(filepath).with_suffix(DURATIONS_SUFFIX) for filepath in batch["filepaths"]]
+        if not overwrite and all(output.is_file() for output in outputs):
+            continue
+        sids, lids = batch["sids"], batch["lids"]
+        durations, pitches, energies = model.generator.extract_durations(
+            x=batch["x"].to(model.device),
+            x_lengths=batch["x_lengths"].to(model.device),
+            mel=batch["mel"].to(model.device),
+            mel_lengths=batch["mel_lengths"].to(model.device),
+            pitches=batch["pitches"].to(model.device),
+            energies=batch["energies"].to(model.device),
+            sids=sids.to(model.device) if sids is not None else None,
+            lids=lids.to(model.device) if lids is not None else None,
+        )
+        # Averaging commutes with (de)normalization
+        pitches = pitches * stats["pitch_std"] + stats["pitch_mean"]
+        energies = energies * stats["energy_std"] + stats["energy_mean"]
+        durations, pitches, energies = durations.cpu().numpy(), pitches.cpu().numpy(), energies.cpu().numpy()
+        for i, (output, x_length) in enumerate(zip(outputs, batch["x_lengths"].tolist())):
+            np.savez(
+                output,
+                allow_pickle=False,
+                durations=durations[i, :x_length].astype(np.int64),
+                pitch=pitches[i, :x_length].astype(np.float32),
+                energy=energies[i, :x_length].astype(np.float32),
+            )
+            num_written += 1
+    return num_written
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract phoneme durations and phoneme-level pitch/energy for alignment-free training"
+    )
+    parser.add_argument(
+        "checkpoint_path",
+        type=str,
+        help="Path to a lightning checkpoint with a trained alignment module",
+    )
+    parser.add_argument(
+        "input_config",
+        type=str,
+        help="The name of the yaml config file under configs/data",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=32,
+        help="Batch size",
+    )
+    parser.add_argument(
+        "-w",
+        "--num-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of dataloader workers",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Overwrite existing durations files",
+    )
+    parser.add_argument("--cuda", action="store_true", help="Use GPU")
+    args = parser.parse_args()
+
+    with initialize(version_base="1.3", config_path="../../configs/data"):
+        cfg = compose(config_name=args.input_config, return_hydra_config=True, overrides=[])
+
+    root_path = rootutils.find_root(search_from=__file__, indicator=".project-root")
+
+    with open_dict(cfg):
+        del cfg["hydra"]
+        del cfg["_target_"]
+        cfg["seed"] = 1234
+        cfg["batch_size"] = args.batch_size
+        cfg["train_filelist_path"] = str(os.path.join(root_path, cfg["train_filelist_path"]))
+        cfg["valid_filelist_path"] = str(os.path.join(root_path, cfg["valid_filelist_path"]))
+        cfg["num_workers"] = args.num_workers
+        cfg["use_precomputed_durations"] = False
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    log.info(f"Loading checkpoint from {args.checkpoint_path}")
+    model = OptiSpeech.load_from_checkpoint(args.checkpoint_path, map_location=device)
+    model.eval()
+
+    datamodule = TextWavDataModule(**cfg)
+    datamodule.setup()
+    # Inputs are normalized with the statistics the model was trained with
+    collate_fn = TextWavBatchCollate(datamodule.n_feats, model.data_args.data_statistics)
+    for dataset in (datamodule.trainset, datamodule.validset):
+        dataloader = DataLoader(
+            dataset=dataset,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            shuffle=False,
+            collate_fn=collate_fn,
+        )
+        num_written = extract_durations(model, dataloader, overwrite=args.force)
+        log.info(f"Wrote durations for {num_written} of {len(dataset)} utterances")
+
+    log.info("Done! To train without the alignment module, set `data.use_precomputed_durations=true`")
+
+
+if __name__ == "__main__":
+    main()
@@ -143,6 +143,8 @@ def main():
         cfg["train_filelist_path"] = str(os.path.join(root_path, cfg["train_filelist_path"]))
         cfg["valid_filelist_path"] = str(os.path.join(root_path, cfg["valid_filelist_path"]))
         cfg["num_workers"] = args.num_workers
+        # Statistics are computed over frame-level values
+        cfg["use_precomputed_durations"] = False
 
     if args.output_dir is not None:
         output_dir = Path(args.output_dir)
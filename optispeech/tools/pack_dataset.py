@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from optispeech.dataset.packed import DEFAULT_SHARD_SIZE, PACKED_SUFFIX, PackedFeatureWriter
+from optispeech.dataset.storage import STORAGE_PRECISIONS
+from optispeech.dataset.text_wav_datamodule import parse_filelist
+from optispeech.utils import get_script_logger
+
+log = get_script_logger(__name__)
+
+
+def pack_filelist(filelist_path, output_dir, shard_size=DEFAULT_SHARD_SIZE, precision="float32"):
+    """Copy the utterances of a filelist (written by `preprocess_dataset`) to a packed feature store."""
+    filepaths = parse_filelist(filelist_path)
+    writer = None
+    for filepath in tqdm(filepaths, desc=f"Packing {Path(filelist_path).name}", unit="utterance"):
+        input_file = Path(filepath)
+        with open(input_file.with_suffix(".json"), encoding="utf-8") as file:
+            data = json.load(file)
+        arrays = np.load(input_file.with_suffix(".npz"), allow_pickle=False)
+        mel = arrays["mel"]
+        if writer is None:
+            writer = PackedFeatureWriter(output_dir, n_feats=mel.shape[0], shard_size=shard_size, precision=precision)
+        writer.add(
+            name=filepath,
+            phoneme_ids=data["phoneme_ids"],
+            text=data["text"],
+            wav=arrays["wav"],
+            mel=mel,
+            energy=arrays["energy"],
+            pitch=arrays["pitch"],
+            sid=data.get("sid"),
+            lid=data.get("lid"),
+        )
+    if writer is None:
+        raise ValueError(f"Filelist `{filelist_path}` is empty")
+    return writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert preprocessed filelists (e.g. `train.txt`, `val.txt`) to packed feature stores"
+    )
+    parser.add_argument(
+        "filelists",
+        type=str,
+        nargs="+",
+        help="filelists written by `preprocess_dataset`",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=DEFAULT_SHARD_SIZE // 1024**2,
+        help="Size of each shard file (in MiB)",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=STORAGE_PRECISIONS,
+        default="float32",
+        help="Storage precision of the arrays. `compact` stores wav as int16 and mel/pitch/energy as float16",
+    )
+    args = parser.parse_args()
+
+    for filelist_path in args.filelists:
+        output_dir = Path(filelist_path).with_suffix(PACKED_SUFFIX)
+        if output_dir.exists():
+            log.error(f"Output directory {output_dir} already exist. Stopping")
+            exit(1)
+        pack_filelist(filelist_path, output_dir, shard_size=args.shard_size * 1024**2, precision=args.precision)
+        log.info(f"Wrote packed dataset: {os.fspath(output_dir)}")
+    log.info("Use the `.packed` directories as `train_filelist_path` and `valid_filelist_path` in your data config")
+
+
+if __name__ == "__main__":
+    main()
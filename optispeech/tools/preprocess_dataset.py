@@ -1,29 +1,74 @@
 import argparse
+import contextlib
 import csv
 import functools
+import itertools
 import json
+import multiprocessing
 import os
+import re
 import traceback
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import cpu_count
+from multiprocessing.util import Finalize
 from pathlib import Path
 
 import hydra
 import numpy as np
 import rootutils
+import torch
 from hydra import compose, initialize
 from tqdm import tqdm
-from tqdm.contrib.concurrent import thread_map
 
 from optispeech.dataset import TextWavDataset, do_preprocess_utterance
+from optispeech.dataset.feature_cache import AudioFeatureCache
+from optispeech.dataset.manifest import MANIFEST_DTYPE, load_manifest, read_manifest_row, write_manifest
+from optispeech.dataset.packed import PACKED_SUFFIX, PackedFeatureWriter
+from optispeech.dataset.storage import STORAGE_PRECISIONS, to_storage_precision
+from optispeech.dataset.text_wav_datamodule import parse_filelist
+from optispeech.text.phonemizer_pool import PhonemizerPool
+from optispeech.tools.pack_dataset import pack_filelist
 from optispeech.utils import get_script_logger
 
-
 log = get_script_logger(__name__)
 
+SPLITS = ("train", "val")
+ID_MAPS = {"speaker_ids": "speaker IDs", "language_ids": "language IDs"}
+
+# Text processor and feature extractor of a worker process
+_worker_components = None
+
+
+def parse_shard(value):
+    """Parse a `--shard` argument (`i/N`, with `0 <= i < N`)."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard `{value}`, expected `i/N`")
+    if not (0 <= index < count):
+        raise argparse.ArgumentTypeError(f"Invalid shard `{value}`, expected `i/N` with 0 <= i < N")
+    return index, count
+
 
+def get_shard_filename(filename, shard):
+    """`train.txt` -> `train.shard-1-of-4.txt` (or `train.txt` if not sharded)."""
+    if shard is None:
+        return filename
+    stem, suffix = os.path.splitext(filename)
+    index, count = shard
+    return f"{stem}.shard-{index}-of-{count}{suffix}"
 
-def process_row(row, feature_extractor, text_processor, wav_path, data_dir, sids, lids):
+
+def get_shard_rows(rows, shard):
+    """Contiguous part of the rows processed by the shard, so that merged filelists keep the metadata order."""
+    if shard is None:
+        return rows
+    index, count = shard
+    return rows[len(rows) * index // count : len(rows) * (index + 1) // count]
+
+
+def parse_row(row):
     if len(row) == 2:
         filestem, text = row
         speaker = lang = None
@@ -35,48 +80,152 @@ def process_row(row, feature_extractor, text_processor, wav_path, data_dir, sids
     else:
         log.error(f"Invalid number of data items in dataset row: {len(row)}")
         exit(1)
+    return filestem, speaker, lang, text
+
+
+def is_processed(data_dir, file_stem):
+    # Data files are written atomically, an utterance is done once both exist
+    output_file = data_dir.joinpath(file_stem)
+    return output_file.with_suffix(".npz").is_file() and output_file.with_suffix(".json").is_file()
+
+
+def init_worker(cfg, phonemize=True, feature_cache_dir=None):
+    global _worker_components
+    # Utterances are processed in parallel by processes, not threads
+    torch.set_num_threads(1)
+    # Otherwise, texts are phonemized by a `PhonemizerPool`
+    text_processor = hydra.utils.instantiate(cfg.text_processor) if phonemize else None
+    feature_extractor = hydra.utils.instantiate(cfg.feature_extractor)
+    feature_extractor.initialize_components()
+    # Shut down the pools of the pitch extractor (if any) when the worker exits: it would wait for
+    # their processes forever otherwise. Runs before the queues of the pools are closed (exit priority 10)
+    Finalize(None, feature_extractor.close, exitpriority=100)
+    if feature_cache_dir is not None:
+        feature_extractor = AudioFeatureCache(feature_cache_dir, feature_extractor)
+    _worker_components = (text_processor, feature_extractor)
+
+
+def process_rows_in_worker(rows, **kwargs):
+    text_processor, feature_extractor = _worker_components
+    return process_rows(rows, feature_extractor=feature_extractor, text_processor=text_processor, **kwargs)
+
+
+def process_rows(rows, feature_extractor, text_processor, wav_path, **kwargs):
+    """
+    Process several rows like `process_row`, extracting their audio features as one batch.
+
+    Returns:
+        list: `(file_stem, result)` of each row
+    """
+    audio_paths = [wav_path.joinpath(parse_row(row)[0] + ".wav").resolve() for row in rows]
+    try:
+        batch_features = feature_extractor.extract_batch(audio_paths)
+    except Exception:
+        # Processed one at a time to find out which rows failed
+        return [process_row(row, feature_extractor, text_processor, wav_path, **kwargs) for row in rows]
+    return [
+        process_row(row, feature_extractor, text_processor, wav_path, features=features, **kwargs)
+        for (row, features) in zip(rows, batch_features)
+    ]
+
+
+def process_row(
+    row,
+    feature_extractor,
+    text_processor,
+    wav_path,
+    data_dir,
+    sids,
+    lids,
+    precision="float32",
+    packed=False,
+    features=None,
+):
+    """
+    `features` are the `(wav, mel, energy, pitch)` of the row's audio file, if already extracted.
+
+    Returns:
+        (file_stem, result): `result` is an exception if the utterance failed, the data and IDs of the utterance
+            if `packed`, else its manifest row (the data files are written to `data_dir`).
+            Without `text_processor`, only the audio features are extracted (and written), and `result`
+            holds the data (None if not `packed`) and IDs of the utterance
+    """
+    filestem, speaker, lang, text = parse_row(row)
     audio_path = wav_path.joinpath(filestem + ".wav")
     audio_path = audio_path.resolve()
     sid = sids.index(speaker.strip().lower()) if speaker else None
     lid = lids.index(lang.strip().lower()) if lang else None
     try:
-        data = do_preprocess_utterance(
-            feature_extractor=feature_extractor,
-            text_processor=text_processor,
-            audio_filepath=audio_path,
-            text=text,
-            lang=lang
-        )
+        if text_processor is not None:
+            data = do_preprocess_utterance(
+                feature_extractor=feature_extractor,
+                text_processor=text_processor,
+                audio_filepath=audio_path,
+                text=text,
+                lang=lang,
+                features=features,
+            )
+        else:
+            wav, mel, energy, pitch = features if features is not None else feature_extractor(audio_path)
+            data = dict(wav=wav, mel=mel, energy=energy, pitch=pitch)
     except Exception as e:
         formatted_exception = traceback.format_exception(e)
         return filestem, Exception(f"Failed to process file: {audio_path.name}", formatted_exception)
-    else:
-        write_data(data_dir, audio_path.stem, data, sid, lid)
-        return audio_path.stem, True
+    if packed:
+        return audio_path.stem, (data, sid, lid)
+    if text_processor is None:
+        write_arrays(data_dir, audio_path.stem, data, precision)
+        return audio_path.stem, (None, sid, lid)
+    write_data(data_dir, audio_path.stem, data, sid, lid, precision)
+    return audio_path.stem, read_manifest_row(data_dir.joinpath(audio_path.stem))
+
+
+def write_data(data_dir, file_stem, data, sid, lid, precision="float32"):
+    write_text_data(data_dir, file_stem, data["phoneme_ids"], data["text"], sid, lid)
+    write_arrays(data_dir, file_stem, data, precision)
 
 
-def write_data(data_dir, file_stem, data, sid, lid):
+# Data files are written to temporary files first, so that interrupted runs don't leave partial files behind
+
+
+def write_text_data(data_dir, file_stem, phoneme_ids, text, sid, lid):
     output_file = data_dir.joinpath(file_stem)
-    out_arrays = output_file.with_suffix(".npz")
     out_json = output_file.with_suffix(".json")
-    with open(out_json, "w", encoding="utf-8") as file:
+    tmp_json = output_file.with_suffix(".json.tmp")
+    with open(tmp_json, "w", encoding="utf-8") as file:
         ph_text_data = {
-            "phoneme_ids": data["phoneme_ids"],
-            "text": data["text"],
+            "phoneme_ids": phoneme_ids,
+            "text": text,
         }
         if sid is not None:
             ph_text_data["sid"] = sid
         if lid is not None:
             ph_text_data["lid"] = lid
         json.dump(ph_text_data, file, ensure_ascii=False)
-    np.savez(
-        out_arrays,
-        allow_pickle=False,
-        wav=data["wav"],
-        mel=data["mel"],
-        energy=data["energy"],
-        pitch=data["pitch"],
-    )
+    os.replace(tmp_json, out_json)
+
+
+def write_arrays(data_dir, file_stem, data, precision="float32"):
+    output_file = data_dir.joinpath(file_stem)
+    out_arrays = output_file.with_suffix(".npz")
+    tmp_arrays = output_file.with_suffix(".npz.tmp")
+    with open(tmp_arrays, "wb") as file:
+        np.savez(file, allow_pickle=False, **to_storage_precision(data, precision))
+    os.replace(tmp_arrays, out_arrays)
+
+
+def add_phonemes(data_dir, file_stem, retval, text_future):
+    """Complete the result of `process_row` (without text processor) with the phonemes from a `PhonemizerPool`."""
+    try:
+        phoneme_ids, text = text_future.result()
+    except Exception as e:
+        return Exception(f"Failed to phonemize the text of: {file_stem}", traceback.format_exception(e))
+    data, sid, lid = retval
+    if data is not None:
+        data.update(phoneme_ids=phoneme_ids, text=text)
+        return retval
+    write_text_data(data_dir, file_stem, phoneme_ids, text, sid, lid)
+    return read_manifest_row(data_dir.joinpath(file_stem))
 
 
 def get_sids_and_lids(dataset, all_utterances):
@@ -102,6 +251,178 @@ def sort_by_most_common(iterable):
     return [j for j, k in counter.most_common()]
 
 
+def write_id_maps(output_dir, id_maps, shard=None):
+    for name, ids in zip(ID_MAPS, id_maps):
+        if ids is None:
+            continue
+        ids_json = output_dir.joinpath(get_shard_filename(f"{name}.json", shard))
+        with open(ids_json, "w", encoding="utf-8") as jfile:
+            json.dump(ids, jfile, ensure_ascii=False, indent=2)
+        log.info(f"Wrote {ID_MAPS[name]} to file: {ids_json}")
+
+
+def process_split(args, executor, phonemizer, root, output_dir, data_dir, out_filename, sids, lids, n_feats):
+    log.info(f"Extracting datasplit `{root.name}`")
+    with open(root.joinpath("metadata.csv"), encoding="utf-8") as file:
+        reader = csv.reader(file, delimiter="|")
+        inrows = list(reader)
+    log.info(f"Found {len(inrows)} utterances in file.")
+    inrows = get_shard_rows(inrows, args.shard)
+    if args.shard is not None:
+        log.info(f"Processing {len(inrows)} utterances in shard {args.shard[0]}/{args.shard[1]}")
+    wav_path = root.joinpath("wav")
+    writer = None
+    if args.packed:
+        out_packed = output_dir.joinpath(out_filename).with_suffix(PACKED_SUFFIX)
+        if out_packed.exists():
+            log.error(f"Packed dataset {out_packed} already exist. Stopping")
+            exit(1)
+        writer = PackedFeatureWriter(out_packed, n_feats=n_feats, precision=args.precision)
+    results = [None] * len(inrows)
+    pending = []
+    for position, row in enumerate(inrows):
+        file_stem = Path(parse_row(row)[0]).name
+        if writer is None and is_processed(data_dir, file_stem):
+            results[position] = (file_stem, read_manifest_row(data_dir.joinpath(file_stem)))
+        else:
+            pending.append(position)
+    if len(pending) < len(inrows):
+        log.info(f"Skipping {len(inrows) - len(pending)} utterances processed by a previous run")
+
+    def get_audio_size(position):
+        audio_path = wav_path.joinpath(parse_row(inrows[position])[0] + ".wav")
+        return audio_path.stat().st_size if audio_path.is_file() else 0
+
+    # Utterances of similar lengths go to the same batches (results are still written in the metadata order)
+    pending.sort(key=get_audio_size)
+    text_futures = {}
+    if phonemizer is not None:
+        # Texts are phonemized while the audio features are extracted
+        for position in pending:
+            __, __, lang, text = parse_row(inrows[position])
+            text_futures[position] = phonemizer.submit(text, lang=lang)
+    worker_func = functools.partial(
+        process_rows_in_worker,
+        wav_path=wav_path,
+        data_dir=data_dir,
+        sids=sids,
+        lids=lids,
+        precision=args.precision,
+        packed=writer is not None,
+    )
+    chunks = [
+        [inrows[position] for position in pending[start : start + args.batch_size]]
+        for start in range(0, len(pending), args.batch_size)
+    ]
+    iterator = itertools.chain.from_iterable(executor.map(worker_func, chunks))
+    for position, (filestem, retval) in tqdm(
+        zip(pending, iterator), total=len(pending), desc="processing", unit="utterance"
+    ):
+        if (phonemizer is not None) and not isinstance(retval, Exception):
+            retval = add_phonemes(data_dir, filestem, retval, text_futures.pop(position))
+        if (writer is not None) and not isinstance(retval, Exception):
+            data, sid, lid = retval
+            writer.add(
+                name=os.fspath(data_dir.joinpath(filestem).resolve()),
+                phoneme_ids=data["phoneme_ids"],
+                text=data["text"],
+                wav=data["wav"],
+                mel=data["mel"],
+                energy=data["energy"],
+                pitch=data["pitch"],
+                sid=sid,
+                lid=lid,
+                position=position,
+            )
+            retval = None
+        results[position] = (filestem, retval)
+    out_filelist = []
+    manifest_rows = []
+    for (filestem, retval) in results:
+        if isinstance(retval, Exception):
+            log.error(f"Failed to process item {filestem}. Error: {retval.args[0]}.\nCaused by: " + "".join(retval.args[1]))
+        else:
+            out_filelist.append(data_dir.joinpath(filestem))
+            manifest_rows.append(retval)
+    if writer is not None:
+        writer.close()
+        log.info(f"Wrote packed dataset: {out_packed}")
+        return
+    out_txt = output_dir.joinpath(get_shard_filename(out_filename, args.shard))
+    write_filelist(out_txt, out_filelist, manifest_rows)
+
+
+def write_filelist(out_txt, out_filelist, manifest_rows):
+    with open(out_txt, "w", encoding="utf-8", newline="\n") as file:
+        filelist = [os.fspath(fn.resolve()) for fn in out_filelist]
+        file.write("\n".join(filelist))
+    log.info(f"Wrote file: {out_txt}")
+    # Lengths and IDs of the utterances, so that they can be sampled and filtered without reading their files
+    manifest = np.stack(manifest_rows) if len(manifest_rows) else np.zeros(0, dtype=MANIFEST_DTYPE)
+    out_manifest = write_manifest(out_txt, manifest)
+    log.info(f"Wrote manifest: {out_manifest}")
+
+
+def find_shards(output_dir, filename):
+    """Filelists (or ID maps) written by the shards of a run, in shard order."""
+    stem, suffix = os.path.splitext(filename)
+    pattern = re.compile(rf"{re.escape(stem)}\.shard-(\d+)-of-(\d+){re.escape(suffix)}")
+    shards = {}
+    for path in output_dir.iterdir():
+        match = pattern.fullmatch(path.name)
+        if match is not None:
+            shards[(int(match.group(1)), int(match.group(2)))] = path
+    counts = {count for (__, count) in shards}
+    if len(counts) > 1:
+        log.error(f"Found `{filename}` shards of runs with different numbers of shards: {sorted(counts)}. Stopping")
+        exit(1)
+    if not shards:
+        return []
+    count = counts.pop()
+    missing = [index for index in range(count) if (index, count) not in shards]
+    if missing:
+        log.error(f"Missing `{filename}` shards {missing} (of {count}). Stopping")
+        exit(1)
+    return [shards[(index, count)] for index in range(count)]
+
+
+def merge_shards(output_dir, data_dir, packed=False, precision="float32"):
+    """Merge the filelists, manifests and ID maps written by the shards of a run."""
+    for name in ID_MAPS:
+        shard_paths = find_shards(output_dir, f"{name}.json")
+        if not shard_paths:
+            continue
+        id_maps = []
+        for path in shard_paths:
+            with open(path, encoding="utf-8") as jfile:
+                id_maps.append(json.load(jfile))
+        if any(ids != id_maps[0] for ids in id_maps):
+            log.error(f"The shards have different {ID_MAPS[name]}, they were run on different metadata. Stopping")
+            exit(1)
+        write_id_maps(output_dir, [id_maps[0] if n == name else None for n in ID_MAPS])
+    for split in SPLITS:
+        out_filename = f"{split}.txt"
+        shard_paths = find_shards(output_dir, out_filename)
+        if not shard_paths:
+            log.error(f"No shards found for `{out_filename}` in {output_dir}. Stopping")
+            exit(1)
+        out_filelist = []
+        manifests = []
+        for path in shard_paths:
+            filepaths = parse_filelist(path) if path.stat().st_size else []
+            # Shards may have been processed on other machines
+            shard_filelist = [data_dir.joinpath(Path(filepath).name) for filepath in filepaths]
+            manifests.append(load_manifest(path, [os.fspath(fn) for fn in shard_filelist]))
+            out_filelist.extend(shard_filelist)
+        log.info(f"Merging {len(shard_paths)} shards of `{out_filename}` ({len(out_filelist)} utterances)")
+        out_txt = output_dir.joinpath(out_filename)
+        write_filelist(out_txt, out_filelist, np.concatenate(manifests))
+        if packed:
+            out_packed = out_txt.with_suffix(PACKED_SUFFIX)
+            pack_filelist(out_txt, out_packed, precision=precision)
+            log.info(f"Wrote packed dataset: {out_packed}")
+
+
 def main():
     root_path = rootutils.find_root(search_from=__file__, indicator=".project-root")
 
@@ -134,21 +455,65 @@ def main():
         default=cpu_count() // 2,
         help="Number of worker processes to use",
     )
+    parser.add_argument(
+        "--phonemizer-workers",
+        type=int,
+        default=1,
+        help="Number of phonemizer processes per language (multi-language datasets only)",
+    )
     parser.add_argument(
         "-b",
         "--batch-size",
         type=int,
         default=8,
-        help="Batch size",
+        help="Number of utterances sent to a worker at once, their audio features are extracted as one batch",
+    )
+    parser.add_argument(
+        "--packed",
+        action="store_true",
+        help="Write each split to a packed feature store (`train.packed/`, `val.packed/`) instead of per-utterance files",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=STORAGE_PRECISIONS,
+        default="float32",
+        help="Storage precision of the arrays. `compact` stores wav as int16 and mel/pitch/energy as float16",
+    )
+    parser.add_argument(
+        "--feature-cache",
+        type=str,
+        default=None,
+        help="Directory to cache the audio features in (keyed by audio content and feature extractor config), "
+        "so that they're reused when preprocessing the same audio again (e.g. with another text processor)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="Only process shard `i/N` (0 <= i < N) of each split, e.g. to split the work across machines",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge the filelists, manifests and ID maps written by the `--shard` runs",
     )
     args = parser.parse_args()
 
+    if args.shard is not None and (args.packed or args.merge):
+        log.error("`--shard` can't be used with `--packed` or `--merge`. Pass `--packed` to `--merge` instead")
+        exit(1)
+    output_dir = Path(args.output_dir)
+    data_dir = output_dir.joinpath("data")
+    if args.merge:
+        merge_shards(output_dir, data_dir, packed=args.packed, precision=args.precision)
+        log.info("Process done!")
+        return
+
     with initialize(version_base=None, config_path="../../configs/data"):
         cfg = compose(config_name=args.dataset)
         cfg["seed"] = 1234
     text_processor = hydra.utils.instantiate(cfg.text_processor)
     feature_extractor = hydra.utils.instantiate(cfg.feature_extractor)
-    feature_extractor.initialize_components()
     dataset = TextWavDataset(
         num_speakers=cfg.num_speakers,
         filelist_path=os.devnull,
@@ -176,65 +541,42 @@ def main():
         ("train.txt", train_root),
         ("val.txt", val_root),
     )
-    output_dir = Path(args.output_dir)
-    if output_dir.is_dir():
-        log.error(f"Output directory {output_dir} already exist. Stopping")
-        exit(1)
-    output_dir.mkdir(parents=True)
-    data_dir = output_dir.joinpath("data")
-    data_dir.mkdir()
-    # eSpeak uses global state for language.
-    # Comment this line if you're not using eSpeak for phonemization
-    n_workers = args.n_workers if not text_processor.is_multi_language else 1
-    for out_filename, root in outputs:
-        if not root.is_dir():
-            log.warning(f"Datasplit `{root.name}` not found. Skipping...")
-            exit(1)
-        log.info(f"Extracting datasplit `{root.name}`")
-        with open(root.joinpath("metadata.csv"), encoding="utf-8") as file:
-            reader = csv.reader(file, delimiter="|")
-            inrows = list(reader)
-        log.info(f"Found {len(inrows)} utterances in file.")
-        wav_path = root.joinpath("wav")
-        out_filelist = []
-        worker_func = functools.partial(
-            process_row,
-            feature_extractor=feature_extractor,
-            text_processor=text_processor,
-            wav_path=wav_path,
-            data_dir=data_dir,
-            sids=sids,
-            lids=lids,
-        )
-        # iterator = map(worker_func, inrows)
-        # for (filestem, retval) in tqdm(iterator, total=len(inrows), desc="processing", unit="utterance"):
-        #     if isinstance(retval, Exception):
-        #         log.error(f"Failed to process item {filestem}. Error: {retval.args[0]}.\nCaused by: " + "".join(retval.args[1]))
-        #     else:
-        #         out_filelist.append(data_dir.joinpath(filestem))
-        results = thread_map(worker_func, inrows, desc="processing", unit="utterance", max_workers=n_workers)
-        for (filestem, retval) in results:
-            if isinstance(retval, Exception):
-                log.error(f"Failed to process item {filestem}. Error: {retval.args[0]}.\nCaused by: " + "".join(retval.args[1]))
-            else:
-                out_filelist.append(data_dir.joinpath(filestem))
-        out_txt = output_dir.joinpath(out_filename)
-        with open(out_txt, "w", encoding="utf-8", newline="\n") as file:
-            filelist = [os.fspath(fn.resolve()) for fn in out_filelist]
-            file.write("\n".join(filelist))
-        log.info(f"Wrote file: {out_txt}")
+    # Utterances processed by a previous (interrupted) run are skipped
+    output_dir.mkdir(parents=True, exist_ok=True)
+    data_dir.mkdir(exist_ok=True)
+    # Texts of multi-language datasets are phonemized by separate processes for each language
+    phonemizer = None
+    if text_processor.is_multi_language:
+        phonemizer = PhonemizerPool(text_processor, processes_per_language=args.phonemizer_workers)
+    # Spawned workers don't inherit the thread pools and the eSpeak state of this process.
+    # Workers are only started if there are utterances left to process
+    with ProcessPoolExecutor(
+        max_workers=max(args.n_workers, 1),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(cfg, phonemizer is None, args.feature_cache),
+    ) as executor, (phonemizer or contextlib.nullcontext()):
+        for out_filename, root in outputs:
+            if not root.is_dir():
+                log.warning(f"Datasplit `{root.name}` not found. Skipping...")
+                exit(1)
+            process_split(
+                args,
+                executor,
+                phonemizer,
+                root,
+                output_dir,
+                data_dir,
+                out_filename,
+                sids,
+                lids,
+                feature_extractor.n_feats,
+            )
 
     # write speaker-ids and language-ids
-    if sids is not None:
-        sids_json = output_dir.joinpath("speaker_ids.json")
-        with open(sids_json, "w", encoding="utf-8") as jfile:
-            json.dump(sids, jfile, ensure_ascii=False, indent=2)
-        log.info(f"Wrote speaker IDs to file: {sids_json}")
-    if lids is not None:
-        lids_json = output_dir.joinpath("language_ids.json")
-        with open(lids_json, "w", encoding="utf-8") as jfile:
-            json.dump(lids, jfile, ensure_ascii=False, indent=2)
-        log.info(f"Wrote language IDs to file: {lids_json}")
+    write_id_maps(output_dir, (sids, lids), args.shard)
+    if args.shard is not None:
+        log.info("Once all shards are done, run the same command with `--merge` instead of `--shard`")
     log.info("Process done!")
 
 
@@ -0,0 +1,151 @@
+import argparse
+import csv
+import json
+import os
+import traceback
+from pathlib import Path
+
+import hydra
+import numpy as np
+from hydra import compose, initialize
+from tqdm import tqdm
+
+from optispeech.dataset import TextWavDataset
+from optispeech.dataset.manifest import load_manifest, write_manifest
+from optispeech.dataset.packed import PACKED_SUFFIX, rewrite_packed_texts
+from optispeech.dataset.text_wav_datamodule import DURATIONS_SUFFIX, parse_filelist
+from optispeech.text.phonemizer_pool import PhonemizerPool
+from optispeech.tools.preprocess_dataset import SPLITS, get_sids_and_lids, parse_row, write_id_maps, write_text_data
+from optispeech.utils import get_script_logger
+
+log = get_script_logger(__name__)
+
+
+def phonemize_rows(phonemizer, rows, sids, lids, is_multi_language):
+    """
+    Returns:
+        dict: `file_stem -> (phoneme_ids, text, sid, lid)` of the rows that were phonemized successfully
+    """
+    futures = {}
+    for row in rows:
+        filestem, speaker, lang, text = parse_row(row)
+        sid = sids.index(speaker.strip().lower()) if speaker else None
+        lid = lids.index(lang.strip().lower()) if lang else None
+        lang = lang if is_multi_language else None
+        futures[Path(filestem).name] = (phonemizer.submit(text, lang=lang), sid, lid)
+    text_data = {}
+    for file_stem, (future, sid, lid) in tqdm(futures.items(), desc="phonemizing", unit="utterance"):
+        try:
+            phoneme_ids, text = future.result()
+        except Exception as e:
+            formatted_exception = "".join(traceback.format_exception(e))
+            log.error(
+                f"Failed to phonemize the text of {file_stem}, keeping its phonemes.\nCaused by: " + formatted_exception
+            )
+            continue
+        text_data[file_stem] = (phoneme_ids, text, sid, lid)
+    return text_data
+
+
+def remove_durations(filepath):
+    # Durations are only valid for the phonemes they were extracted for
+    Path(filepath).with_suffix(DURATIONS_SUFFIX).unlink(missing_ok=True)
+
+
+def retokenize_filelist(filelist_path, text_data):
+    """Rewrite the `.json` files and the manifest of a filelist, returns the number of changed phoneme IDs."""
+    filepaths = parse_filelist(filelist_path)
+    manifest = np.array(load_manifest(filelist_path, filepaths))
+    num_changed = 0
+    for i, filepath in enumerate(tqdm(filepaths, desc=f"Rewriting {Path(filelist_path).name}", unit="utterance")):
+        input_file = Path(filepath)
+        if input_file.name not in text_data:
+            log.warning(f"Utterance `{input_file.name}` not found in the metadata, keeping its phonemes")
+            continue
+        phoneme_ids, text, sid, lid = text_data[input_file.name]
+        with open(input_file.with_suffix(".json"), encoding="utf-8") as file:
+            changed = json.load(file)["phoneme_ids"] != phoneme_ids
+        write_text_data(input_file.parent, input_file.name, phoneme_ids, text, sid, lid)
+        if changed:
+            num_changed += 1
+            remove_durations(filepath)
+        manifest[i]["x_len"] = len(phoneme_ids)
+        manifest[i]["sid"] = sid if sid is not None else -1
+        manifest[i]["lid"] = lid if lid is not None else -1
+    # Invalidates caches keyed on the filelist (e.g. the shared-memory dataset cache), the manifest comes after it
+    os.utime(filelist_path)
+    write_manifest(filelist_path, manifest)
+    return num_changed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rewrite the phoneme IDs of a preprocessed dataset with the dataset config's text processor, "
+        "without extracting the audio features again"
+    )
+    parser.add_argument(
+        "dataset",
+        type=str,
+        help="dataset config relative to `configs/data/` (without the suffix)",
+    )
+    parser.add_argument(
+        "input_dir",
+        type=str,
+        help="original data directory",
+    )
+    parser.add_argument(
+        "output_dir",
+        type=str,
+        help="directory written by `preprocess_dataset` (its filelists and packed splits are rewritten in place)",
+    )
+    parser.add_argument(
+        "-w",
+        "--n-workers",
+        type=int,
+        default=max(os.cpu_count() // 2, 1),
+        help="Number of phonemizer processes per language",
+    )
+    args = parser.parse_args()
+
+    with initialize(version_base=None, config_path="../../configs/data"):
+        cfg = compose(config_name=args.dataset)
+    text_processor = hydra.utils.instantiate(cfg.text_processor)
+    feature_extractor = hydra.utils.instantiate(cfg.feature_extractor)
+    dataset = TextWavDataset(
+        num_speakers=cfg.num_speakers,
+        filelist_path=os.devnull,
+        text_processor=text_processor,
+        feature_extractor=feature_extractor,
+    )
+    output_dir = Path(args.output_dir)
+    rows = {}
+    for split in SPLITS:
+        with open(Path(args.input_dir).joinpath(split, "metadata.csv"), encoding="utf-8") as file:
+            rows[split] = list(csv.reader(file, delimiter="|"))
+    # Languages may have changed with the text processor
+    sids, lids = get_sids_and_lids(dataset, [row for split_rows in rows.values() for row in split_rows])
+
+    with PhonemizerPool(text_processor, processes_per_language=args.n_workers) as phonemizer:
+        for split in SPLITS:
+            filelist_path = output_dir.joinpath(f"{split}.txt")
+            packed_dir = output_dir.joinpath(split).with_suffix(PACKED_SUFFIX)
+            if not (filelist_path.is_file() or packed_dir.is_dir()):
+                log.warning(f"No filelist or packed dataset found for datasplit `{split}`. Skipping...")
+                continue
+            log.info(f"Phonemizing datasplit `{split}`")
+            text_data = phonemize_rows(phonemizer, rows[split], sids, lids, text_processor.is_multi_language)
+            if filelist_path.is_file():
+                num_changed = retokenize_filelist(filelist_path, text_data)
+                log.info(f"Rewrote {filelist_path}: phoneme IDs of {num_changed} utterances changed")
+            if packed_dir.is_dir():
+                changed = rewrite_packed_texts(packed_dir, lambda name: text_data.get(Path(name).name))
+                for name in changed:
+                    remove_durations(name)
+                log.info(f"Rewrote {packed_dir}: phoneme IDs of {len(changed)} utterances changed")
+    write_id_maps(output_dir, (sids, lids))
+    log.info("Precomputed durations (if any) of changed utterances were removed, extract them again if needed")
+    log.info("Process done!")
+
+
+if __name__ == "__main__":
+    main()
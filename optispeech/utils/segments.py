@@ -26,15 +26,33 @@ def get_random_segments(
         Tensor: Start index tensor (B,).
 
     """
-    batches = x.shape[0]
+    start_idxs = get_random_segment_start_idxs(x_lengths, segment_size)
+    segments = get_segments(x, start_idxs, segment_size)
+
+    return segments, start_idxs
+
+
+def get_random_segment_start_idxs(
+    x_lengths: torch.Tensor,
+    segment_size: int,
+) -> torch.Tensor:
+    """Get random segment start indices.
+
+    Args:
+        x_lengths (Tensor): Length tensor (B,).
+        segment_size (int): Segment size.
+
+    Returns:
+        Tensor: Start index tensor (B,).
+
+    """
+    batches = x_lengths.shape[0]
     max_start_idx = x_lengths - segment_size
     max_start_idx[max_start_idx < 0] = 0
-    start_idxs = (torch.rand([batches]).to(x.device) * max_start_idx).to(
+    start_idxs = (torch.rand([batches]).to(x_lengths.device) * max_start_idx).to(
         dtype=torch.long,
     )
-    segments = get_segments(x, start_idxs, segment_size)
-
-    return segments, start_idxs
+    return start_idxs
 
 
 def get_segments(
@@ -51,13 +69,14 @@ def get_segments(
 
     Returns:
         Tensor: Segmented tensor (B, C, segment_size).
+            Frames past the end of `x` are zero.
 
     """
-    b, c, _ = x.size()
-    segments = x.new_zeros(b, c, segment_size)
-    for i, start_idx in enumerate(start_idxs):
-        segments[i] = x[i, :, start_idx : start_idx + segment_size]
-    return segments
+    b, c, t = x.size()
+    idxs = start_idxs.to(device=x.device, dtype=torch.long).unsqueeze(1) + torch.arange(segment_size, device=x.device)
+    valid = (idxs < t).unsqueeze(1)
+    segments = torch.gather(x, 2, idxs.clamp(max=t - 1).unsqueeze(1).expand(b, c, segment_size))
+    return segments.masked_fill(~valid, 0)
 
 
 def get_segments_numpy(
@@ -65,8 +84,11 @@ def get_segments_numpy(
     start_idxs: np.ndarray,
     segment_size: int,
 ) -> np.ndarray:
-    b, c, _ = x.shape
-    segments = np.zeros((b, c, segment_size), dtype=np.float32)
-    for i, start_idx in enumerate(start_idxs):
-        segments[i] = x[i, :, start_idx : start_idx + segment_size]
+    """Get segments (numpy version of `get_segments`, always returns float32)."""
+    if isinstance(start_idxs, torch.Tensor):
+        start_idxs = start_idxs.cpu().numpy()
+    t = x.shape[-1]
+    idxs = np.asarray(start_idxs, dtype=np.int64)[:, None] + np.arange(segment_size)
+    segments = np.take_along_axis(x, np.minimum(idxs, t - 1)[:, None, :], axis=2).astype(np.float32)
+    segments[np.broadcast_to((idxs >= t)[:, None, :], segments.shape)] = 0.0
     return segments
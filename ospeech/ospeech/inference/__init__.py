@@ -35,10 +35,11 @@ class OptiSpeechONNXModel:
         self.is_multilanguage = len(self.languages) > 1
 
     @classmethod
-    def from_onnx_session(cls, session: onnxruntime.InferenceSession):
+    def from_onnx_session(cls, session: onnxruntime.InferenceSession, text_processor: TextProcessor | None = None):
         meta = session.get_modelmeta()
         infer_params = json.loads(meta.custom_metadata_map["inference"])
-        text_processor = TextProcessor.from_dict(infer_params["text_processor"])
+        if text_processor is None:
+            text_processor = TextProcessor.from_dict(infer_params["text_processor"])
         return cls(
             session=session,
             name=infer_params["name"],
@@ -50,8 +51,14 @@ class OptiSpeechONNXModel:
         )
 
     @classmethod
-    def from_onnx_file_path(cls, onnx_path: str, onnx_providers: list[str] = ONNX_CPU_PROVIDERS):
-        session = onnxruntime.InferenceSession(onnx_path, providers=onnx_providers)
+    def from_onnx_file_path(
+        cls,
+        onnx_path: str,
+        onnx_providers: list[str] = ONNX_CPU_PROVIDERS,
+        session_options: onnxruntime.SessionOptions | None = None,
+    ):
+        # Models exported with external data are resolved relative to `onnx_path`
+        session = onnxruntime.InferenceSession(onnx_path, sess_options=session_options, providers=onnx_providers)
         return cls.from_onnx_session(session)
 
     def prepare_input(
@@ -1,22 +1,66 @@
 import  argparse
+import hashlib
+import json
 import os
+import shutil
+import threading
+import time
+import urllib.parse
 from collections import namedtuple
-from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
 
 import mureq
 from tqdm import tqdm
 
 
 ModelInfo = namedtuple("ModelInfo", "id name lang url")
+RemoteFileInfo = namedtuple("RemoteFileInfo", "url size sha256 accepts_ranges")
 MODEL_BASE_URL = "https://huggingface.co/mush42/optispeech/resolve/main/"
 MODEL_LIST_URL = MODEL_BASE_URL + "models.json"
 CHUNK_SIZE = 1024 * 1024
+# Size of the byte ranges fetched in parallel. Also the unit of resumption.
+RANGE_SIZE = 8 * CHUNK_SIZE
+MODEL_LIST_TTL = 60 * 60
+MAX_REDIRECTS = 10
+MAX_RETRIES = 3
+DEFAULT_NUM_WORKERS = 4
 
 
-def get_models():
-    resp = mureq.get(MODEL_LIST_URL)
-    resp.raise_for_status()
-    onnx_models = resp.json()["onnx"]
+def get_cache_dir():
+    cache_dir = os.environ.get("OSPEECH_CACHE_DIR")
+    if not cache_dir:
+        xdg_cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+        cache_dir = os.path.join(xdg_cache_home, "ospeech")
+    return cache_dir
+
+
+def get_model_list(cache_dir=None, ttl=MODEL_LIST_TTL):
+    """
+    Fetch the model listing, caching it on disk for `ttl` seconds.
+    A stale listing is used if the listing can not be fetched.
+    """
+    cache_dir = cache_dir or get_cache_dir()
+    cache_file = os.path.join(cache_dir, "models.json")
+    if os.path.isfile(cache_file) and (time.time() - os.path.getmtime(cache_file)) < ttl:
+        with open(cache_file, "r", encoding="utf-8") as file:
+            return json.load(file)
+    try:
+        resp = mureq.get(MODEL_LIST_URL, max_redirects=MAX_REDIRECTS)
+        resp.raise_for_status()
+        model_list = resp.json()
+    except Exception:
+        if not os.path.isfile(cache_file):
+            raise
+        print("Failed to fetch model list. Using the cached one.")
+        with open(cache_file, "r", encoding="utf-8") as file:
+            return json.load(file)
+    os.makedirs(cache_dir, exist_ok=True)
+    _write_atomic(cache_file, json.dumps(model_list).encode("utf-8"))
+    return model_list
+
+
+def get_models(cache_dir=None, ttl=MODEL_LIST_TTL):
+    onnx_models = get_model_list(cache_dir, ttl)["onnx"]
     models = []
     for lang, variants in onnx_models.items():
         for vname, speakers in variants.items():
@@ -55,22 +99,210 @@ def format_as_table(*cols: tuple[str, list[str]]) -> str:
     return summary
 
 
+def _write_atomic(path, data: bytes):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+def _parse_sha256(etag):
+    # HuggingFace reports the sha256 of LFS files as their (linked) etag
+    if not etag:
+        return None
+    etag = etag.strip().removeprefix("W/").strip('"').lower()
+    if len(etag) == 64 and all(c in "0123456789abcdef" for c in etag):
+        return etag
+    return None
+
+
+def probe_remote_file(url) -> RemoteFileInfo:
+    """Follow redirects to the final file URL, collecting its size, content hash and range support."""
+    size = sha256 = None
+    for __ in range(MAX_REDIRECTS + 1):
+        with mureq.yield_response("HEAD", url) as resp:
+            headers = resp.headers
+            sha256 = sha256 or _parse_sha256(headers.get("X-Linked-Etag")) or _parse_sha256(headers.get("ETag"))
+            if headers.get("X-Linked-Size"):
+                size = size or int(headers["X-Linked-Size"])
+            location = resp.getheader("Location")
+            if resp.status in (301, 302, 303, 307, 308) and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if resp.status >= 400:
+                raise mureq.HTTPErrorStatus(resp.status)
+            if headers.get("Content-Length"):
+                size = int(headers["Content-Length"])
+            accepts_ranges = headers.get("Accept-Ranges", "").lower() == "bytes"
+            return RemoteFileInfo(url, size, sha256, accepts_ranges and (size is not None))
+    raise mureq.TooManyRedirects([url])
 
-def do_download_file(url):
-    with mureq.yield_response('GET', url) as resp:
-        if resp.status == 302:
-            url = resp.getheader("Location")
-            yield from do_download_file(url)
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class RangesNotSupported(mureq.HTTPException):
+    """The server answered a range request with the whole file."""
+
+
+def _fetch_range(url, part_file, start, end, progress):
+    """Write bytes `start..end` (inclusive) of `url` to the same offsets of `part_file`."""
+    headers = {"Range": f"bytes={start}-{end}"}
+    for attempt in range(MAX_RETRIES):
+        written = 0
+        try:
+            with mureq.yield_response("GET", url, headers=headers) as resp, open(part_file, "r+b") as file:
+                if resp.status == 200:
+                    raise RangesNotSupported(f"`{url}` ignored the range request")
+                if resp.status != 206:
+                    raise mureq.HTTPException(f"Expected a partial response, got status {resp.status}")
+                file.seek(start)
+                while chunk := resp.read(CHUNK_SIZE):
+                    file.write(chunk)
+                    written += len(chunk)
+                    progress.update(len(chunk))
+            if written != end - start + 1:
+                raise mureq.HTTPException(f"Incomplete range {start}-{end}")
             return
-        yield int(resp.headers["content-length"])
-        while True:
-            chunk = resp.read(CHUNK_SIZE)
-            if not chunk:
-                break
-            yield chunk
-
-def list_command():
-    models = get_models()
+        except RangesNotSupported:
+            raise
+        except (mureq.HTTPException, OSError):
+            progress.update(-written)
+            if attempt == MAX_RETRIES - 1:
+                raise
+
+
+def _download_ranges(remote: RemoteFileInfo, part_file, num_workers, progress):
+    state_file = part_file + ".json"
+    state = dict(url=remote.url, size=remote.size, sha256=remote.sha256, range_size=RANGE_SIZE, done=[])
+    if os.path.isfile(part_file) and os.path.isfile(state_file):
+        with open(state_file, "r", encoding="utf-8") as file:
+            prev_state = json.load(file)
+        # The signed URL changes between requests, so identify the file by its size and hash
+        if all(prev_state.get(k) == state[k] for k in ("size", "sha256", "range_size")):
+            state["done"] = prev_state["done"]
+    if not state["done"]:
+        with open(part_file, "wb") as file:
+            file.truncate(remote.size)
+    ranges = [
+        (idx, start, min(start + RANGE_SIZE, remote.size) - 1)
+        for (idx, start) in enumerate(range(0, remote.size, RANGE_SIZE))
+    ]
+    done = set(state["done"])
+    progress.update(sum(end - start + 1 for (idx, start, end) in ranges if idx in done))
+    state_lock = threading.Lock()
+
+    def fetch(idx, start, end):
+        _fetch_range(remote.url, part_file, start, end, progress)
+        with state_lock:
+            state["done"].append(idx)
+            _write_atomic(state_file, json.dumps(state).encode("utf-8"))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(fetch, *r) for r in ranges if r[0] not in done]
+        for future in futures:
+            future.result()
+
+
+def _download_stream(remote: RemoteFileInfo, part_file, progress):
+    with mureq.yield_response("GET", remote.url, max_redirects=MAX_REDIRECTS) as resp, open(part_file, "wb") as file:
+        if resp.status >= 400:
+            raise mureq.HTTPErrorStatus(resp.status)
+        while chunk := resp.read(CHUNK_SIZE):
+            file.write(chunk)
+            progress.update(len(chunk))
+
+
+def download_file(url, output_file, num_workers=DEFAULT_NUM_WORKERS, desc="Downloading"):
+    """
+    Download `url` to `output_file`.
+
+    The file is downloaded in byte ranges in parallel (when the server supports them) to
+    `<output_file>.part`, resuming a previously interrupted download of the same file.
+    The content hash is verified against the one advertised by the server, and the file
+    is moved into place only once complete. The sha256 of the file is written to `<output_file>.sha256`.
+
+    Returns:
+        str: sha256 of the downloaded file
+    """
+    remote = probe_remote_file(url)
+    part_file = output_file + ".part"
+    with tqdm(total=remote.size, desc=desc, unit="B", unit_scale=True, unit_divisor=1024) as progress:
+        use_ranges = remote.accepts_ranges and (num_workers > 1)
+        if use_ranges:
+            try:
+                _download_ranges(remote, part_file, num_workers, progress)
+            except RangesNotSupported:
+                # Advertised `Accept-Ranges`, but sends the whole file for every request
+                use_ranges = False
+                progress.reset()
+                if os.path.isfile(part_file + ".json"):
+                    os.remove(part_file + ".json")
+        if not use_ranges:
+            _download_stream(remote, part_file, progress)
+    sha256 = hash_file(part_file)
+    if (remote.sha256 is not None) and (sha256 != remote.sha256):
+        os.remove(part_file)
+        if os.path.isfile(part_file + ".json"):
+            os.remove(part_file + ".json")
+        raise ValueError(f"Checksum mismatch for `{url}`: expected {remote.sha256}, got {sha256}")
+    _write_atomic(output_file + ".sha256", sha256.encode("utf-8"))
+    os.replace(part_file, output_file)
+    if os.path.isfile(part_file + ".json"):
+        os.remove(part_file + ".json")
+    return sha256
+
+
+def is_cached(model_file, url, refresh=False):
+    """
+    Whether `model_file` was completely downloaded, according to the sha256 written next to it by `download_file`.
+
+    With `refresh`, the file is hashed again and compared with the remote file. If the remote file
+    can not be probed (e.g. when offline), the cached file is used.
+    """
+    hash_file_path = model_file + ".sha256"
+    if not (os.path.isfile(model_file) and os.path.isfile(hash_file_path)):
+        return False
+    with open(hash_file_path, "r", encoding="utf-8") as file:
+        cached_sha256 = file.read().strip()
+    if not refresh:
+        return True
+    if hash_file(model_file) != cached_sha256:
+        return False
+    try:
+        remote = probe_remote_file(url)
+    except Exception:
+        print("Failed to check the remote model file. Using the cached one.")
+        return True
+    if remote.sha256 is not None:
+        return cached_sha256 == remote.sha256
+    return os.path.getsize(model_file) == remote.size
+
+
+def download_model(model: ModelInfo, cache_dir=None, num_workers=DEFAULT_NUM_WORKERS, refresh=False):
+    """
+    Download `model` into the model cache (if not already there) and return its path.
+    With `refresh`, a cached model is checked against the remote one, and downloaded again if it changed.
+    """
+    models_dir = os.path.join(cache_dir or get_cache_dir(), "models")
+    os.makedirs(models_dir, exist_ok=True)
+    filename = f"{model.id}.onnx"
+    model_file = os.path.join(models_dir, filename)
+    if is_cached(model_file, model.url, refresh=refresh):
+        print(f"Using cached `{filename}`")
+        return model_file
+    print(f"Downloading `{filename}`")
+    download_file(model.url, model_file, num_workers=num_workers)
+    return model_file
+
+
+def list_command(refresh=False, cache_dir=None):
+    models = get_models(cache_dir, ttl=0 if refresh else MODEL_LIST_TTL)
     cols = (
         ("Lang", [m.lang for m in models]),
         ("Speaker", [m.name for m in models]),
@@ -79,53 +311,54 @@ def list_command():
     print(format_as_table(*cols))
 
 
-def download_command(id, dir):
+def download_command(id, dir, num_workers=DEFAULT_NUM_WORKERS, cache_dir=None, refresh=False):
     if not os.path.isdir(dir):
         print(f"The output directory {dir} does not exist.")
         return
-    models = get_models()
+    models = get_models(cache_dir)
     try:
         model = next(filter(lambda m: m.id == id, models))
     except StopIteration:
         print(f"A model with the given ID not found: {id}`")
         return
-    streamer = do_download_file(model.url)
     try:
-        model_size = next(streamer)
+        cached_file = download_model(model, cache_dir, num_workers, refresh)
     except Exception as e:
         print("Failed to download model file.")
         raise e
-    num_chunks = model_size // CHUNK_SIZE
-    filename = f"{model.id}.onnx"
     output_file = os.path.abspath(
-        os.path.join(dir, filename)
+        os.path.join(dir, os.path.basename(cached_file))
     )
-    print(f"Downloading `{filename}`")
-    with SpooledTemporaryFile() as temp_file:
-        for chunk in tqdm(streamer, total=num_chunks, desc="Downloading", unit="MB"):
-            temp_file.write(chunk)
-        temp_file.seek(0)
-        with open(output_file, "wb") as outfile:
-            outfile.write(temp_file.read())
+    if os.path.abspath(cached_file) != output_file:
+        if os.path.isfile(output_file):
+            os.remove(output_file)
+        try:
+            # Avoid keeping two copies of the model on disk
+            os.link(cached_file, output_file)
+        except OSError:
+            shutil.copyfile(cached_file, output_file)
     print(f"Downloaded model to: {output_file}")
-    
 
 
 def main():
     parser = argparse.ArgumentParser(description="List and download ospeech models from HuggingFace.")
+    parser.add_argument('--cache-dir', type=str, default=None, help='Model cache directory (default: $OSPEECH_CACHE_DIR or ~/.cache/ospeech)')
     subparsers = parser.add_subparsers(dest='command')
     ls_parser = subparsers.add_parser('ls', help='List available models')
+    ls_parser.add_argument('--refresh', action='store_true', help='Ignore the cached model list')
     ls_parser.set_defaults(func=list_command)
     dl_parser = subparsers.add_parser('dl', help='Download ospeech models from HuggingFace')
     dl_parser.add_argument('id', type=str, help='Model ID. Run ospeech ls to list available models.')
     dl_parser.add_argument('dir', type=str, help='Directory to download the model to')
+    dl_parser.add_argument('-w', '--workers', type=int, default=DEFAULT_NUM_WORKERS, help='Number of parallel connections')
+    dl_parser.add_argument('--refresh', action='store_true', help='Check a cached model against the remote one')
     dl_parser.set_defaults(func=download_command)
     args = parser.parse_args()
     if 'func' in args:
         if args.command == 'dl':
-            args.func(args.id, args.dir)
+            args.func(args.id, args.dir, args.workers, args.cache_dir, args.refresh)
         else:
-            args.func()
+            args.func(args.refresh, args.cache_dir)
     else:
         parser.print_help()
 
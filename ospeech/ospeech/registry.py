@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import perf_counter
+
+import onnxruntime
+
+from .inference import ONNX_CPU_PROVIDERS, OptiSpeechONNXModel
+from .text import TextProcessor
+
+
+log = logging.getLogger("registry")
+
+
+@dataclass
+class RegistryMetrics:
+    hits: int = 0
+    misses: int = 0
+    loads: int = 0
+    evictions: int = 0
+    load_time_ms: float = 0.0
+    resident_bytes: int = 0
+    resident_voices: int = 0
+
+    def as_dict(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            loads=self.loads,
+            evictions=self.evictions,
+            load_time_ms=self.load_time_ms,
+            resident_bytes=self.resident_bytes,
+            resident_voices=self.resident_voices,
+        )
+
+
+@dataclass
+class _RegistryEntry:
+    model: OptiSpeechONNXModel
+    size: int
+
+
+class ModelRegistry:
+    """
+    Lazily loads ONNX voices on first use and keeps the most recently used
+    ones resident under a memory budget.
+
+    Voices are looked up as `<model_dir>/<voice_id>.onnx` (the layout written by `ospeech-models dl`).
+    The memory used by a voice is estimated from the size of its model files,
+    which is what onnxruntime keeps resident for the weights.
+    Voices whose text processor config is identical share a single `TextProcessor` instance.
+    """
+
+    def __init__(
+        self,
+        model_dir: str,
+        memory_budget: int,
+        prewarm: list[str] | None = None,
+        onnx_providers: list[str] = ONNX_CPU_PROVIDERS,
+        session_options: onnxruntime.SessionOptions | None = None,
+    ):
+        """
+        Args:
+            model_dir (str): directory containing `<voice_id>.onnx` files
+            memory_budget (int): maximum number of bytes to keep resident
+            prewarm (list[str]|None): voice IDs to load right away
+            onnx_providers (list[str]): onnxruntime execution providers
+            session_options (onnxruntime.SessionOptions|None): options for every session
+        """
+        self.model_dir = model_dir
+        self.memory_budget = memory_budget
+        self.onnx_providers = onnx_providers
+        self.session_options = session_options
+        self.metrics = RegistryMetrics()
+        self._entries: OrderedDict[str, _RegistryEntry] = OrderedDict()
+        self._text_processors = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        self._load_locks: dict[str, threading.Lock] = {}
+        if prewarm:
+            self.prewarm(prewarm)
+
+    def __contains__(self, voice_id: str) -> bool:
+        return voice_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, voice_id: str) -> OptiSpeechONNXModel:
+        """Return the model for `voice_id`, loading it (and evicting others) if needed."""
+        with self._lock:
+            entry = self._entries.get(voice_id)
+            if entry is not None:
+                self._entries.move_to_end(voice_id)
+                self.metrics.hits += 1
+                return entry.model
+            self.metrics.misses += 1
+            load_lock = self._load_locks.setdefault(voice_id, threading.Lock())
+        # Load outside the registry lock so that other voices keep being served
+        with load_lock:
+            try:
+                with self._lock:
+                    entry = self._entries.get(voice_id)
+                    if entry is not None:
+                        # Loaded by another thread while we were waiting
+                        self._entries.move_to_end(voice_id)
+                        return entry.model
+                entry = self._load(voice_id)
+                with self._lock:
+                    self._entries[voice_id] = entry
+                    self.metrics.resident_bytes += entry.size
+                    self._evict(keep=voice_id)
+                    self._update_resident_count()
+                return entry.model
+            finally:
+                # Also when loading failed, so that the lock of a missing voice doesn't linger
+                with self._lock:
+                    if self._load_locks.get(voice_id) is load_lock:
+                        del self._load_locks[voice_id]
+
+    def prewarm(self, voice_ids: list[str]):
+        for voice_id in voice_ids:
+            self.get(voice_id)
+
+    def evict(self, voice_id: str) -> bool:
+        with self._lock:
+            entry = self._entries.pop(voice_id, None)
+            if entry is None:
+                return False
+            self._drop(voice_id, entry)
+            self._update_resident_count()
+            return True
+
+    def model_path(self, voice_id: str) -> str:
+        return os.path.join(self.model_dir, f"{voice_id}.onnx")
+
+    def _load(self, voice_id: str) -> _RegistryEntry:
+        onnx_path = self.model_path(voice_id)
+        if not os.path.isfile(onnx_path):
+            raise KeyError(f"A voice with the given ID was not found: `{voice_id}`")
+        t0 = perf_counter()
+        session = onnxruntime.InferenceSession(
+            onnx_path, sess_options=self.session_options, providers=self.onnx_providers
+        )
+        text_processor = self._get_text_processor(session)
+        model = OptiSpeechONNXModel.from_onnx_session(session, text_processor=text_processor)
+        load_time_ms = (perf_counter() - t0) * 1000
+        with self._lock:
+            self.metrics.loads += 1
+            self.metrics.load_time_ms += load_time_ms
+        log.info(f"Loaded voice `{voice_id}` in {round(load_time_ms)} ms")
+        return _RegistryEntry(model=model, size=self._estimate_size(onnx_path))
+
+    def _get_text_processor(self, session: onnxruntime.InferenceSession) -> TextProcessor:
+        meta = session.get_modelmeta()
+        text_processor_config = json.loads(meta.custom_metadata_map["inference"])["text_processor"]
+        key = json.dumps(text_processor_config, sort_keys=True)
+        with self._lock:
+            text_processor = self._text_processors.get(key)
+            if text_processor is None:
+                text_processor = TextProcessor.from_dict(text_processor_config)
+                self._text_processors[key] = text_processor
+        return text_processor
+
+    def _evict(self, keep: str):
+        # Least recently used first
+        while self.metrics.resident_bytes > self.memory_budget and len(self._entries) > 1:
+            voice_id = next(iter(self._entries))
+            if voice_id == keep:
+                break
+            self._drop(voice_id, self._entries.pop(voice_id))
+
+    def _drop(self, voice_id: str, entry: _RegistryEntry):
+        self.metrics.resident_bytes -= entry.size
+        self.metrics.evictions += 1
+        log.info(f"Evicted voice `{voice_id}`")
+
+    def _update_resident_count(self):
+        self.metrics.resident_voices = len(self._entries)
+
+    @staticmethod
+    def _estimate_size(onnx_path: str) -> int:
+        size = os.path.getsize(onnx_path)
+        # Weights exported with `--external-data`
+        external_data_path = onnx_path + ".data"
+        if os.path.isfile(external_data_path):
+            size += os.path.getsize(external_data_path)
+        return size
@@ -0,0 +1,203 @@
+"""
+Check `ospeech.models.download_file` against a local stand-in for the model host.
+
+The stand-in is an `http.server` that serves one random file, supports byte ranges,
+and advertises the sha256 of the file the way HuggingFace does (`X-Linked-Etag`).
+It can also be told to ignore `Range`, to fail some ranges or every request, or to advertise a wrong hash.
+
+Usage: python scripts/check_downloads.py  (from the `ospeech` directory)
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from ospeech import models
+
+# Small ranges, so that a small file is still downloaded in many of them
+RANGE_SIZE = 64 * 1024
+FILE_SIZE = 16 * RANGE_SIZE + 1234
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, content):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.content = content
+        self.sha256 = hashlib.sha256(content).hexdigest()
+        self.reset()
+
+    def reset(self, ignore_range=False, fail_from=None, advertised_sha256=None, offline=False):
+        self.ignore_range = ignore_range
+        # Answer every request with an error, like a host that is down
+        self.offline = offline
+        # Answer ranges starting at or after this offset with an error
+        self.fail_from = fail_from
+        self.advertised_sha256 = advertised_sha256 or self.sha256
+        self.served_ranges = []
+        self.full_downloads = 0
+        self.num_requests = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/model.onnx"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.server.num_requests += 1
+        if self.server.offline:
+            self.send_error(HTTPStatus.SERVICE_UNAVAILABLE)
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_common_headers(len(self.server.content))
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.num_requests += 1
+        if self.server.offline:
+            self.send_error(HTTPStatus.SERVICE_UNAVAILABLE)
+            return
+        content = self.server.content
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if (match is None) or self.server.ignore_range:
+            self.server.full_downloads += 1
+            self.send_response(HTTPStatus.OK)
+            self.send_common_headers(len(content))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        start, end = int(match[1]), int(match[2])
+        if (self.server.fail_from is not None) and (start >= self.server.fail_from):
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+            return
+        self.server.served_ranges.append((start, end))
+        self.send_response(HTTPStatus.PARTIAL_CONTENT)
+        self.send_common_headers(end - start + 1)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+        self.end_headers()
+        self.wfile.write(content[start : end + 1])
+
+    def send_common_headers(self, content_length):
+        self.send_header("Content-Length", str(content_length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("X-Linked-Etag", f'"{self.server.advertised_sha256}"')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def read(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def check_parallel_download(server, output_dir):
+    output_file = os.path.join(output_dir, "parallel.onnx")
+    sha256 = models.download_file(server.url, output_file, num_workers=4)
+    assert read(output_file) == server.content
+    assert sha256 == server.sha256 == read(output_file + ".sha256").decode("utf-8")
+    assert server.full_downloads == 0
+    assert len(server.served_ranges) == -(-FILE_SIZE // RANGE_SIZE)
+    assert not os.path.exists(output_file + ".part")
+    assert not os.path.exists(output_file + ".part.json")
+
+
+def check_resume(server, output_dir):
+    output_file = os.path.join(output_dir, "resumed.onnx")
+    part_file = output_file + ".part"
+    half = FILE_SIZE // 2
+    server.reset(fail_from=half)
+    try:
+        models.download_file(server.url, output_file, num_workers=4)
+    except Exception:
+        pass
+    else:
+        raise AssertionError("The interrupted download did not fail")
+    assert not os.path.exists(output_file)
+    with open(part_file + ".json", "r", encoding="utf-8") as file:
+        state = json.load(file)
+    assert len(state["done"]) == len(server.served_ranges) > 0
+    first_served = set(server.served_ranges)
+
+    server.reset()
+    models.download_file(server.url, output_file, num_workers=4)
+    assert read(output_file) == server.content
+    # Only the ranges missing from the `.part` file were requested again
+    assert not first_served & set(server.served_ranges)
+    assert all(start >= half for (start, end) in server.served_ranges)
+    assert not os.path.exists(part_file)
+    assert not os.path.exists(part_file + ".json")
+
+
+def check_hash_mismatch(server, output_dir):
+    output_file = os.path.join(output_dir, "mismatch.onnx")
+    server.reset(advertised_sha256="0" * 64)
+    try:
+        models.download_file(server.url, output_file, num_workers=4)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("A download with the wrong hash was accepted")
+    for path in (output_file, output_file + ".sha256", output_file + ".part", output_file + ".part.json"):
+        assert not os.path.exists(path), path
+
+
+def check_ignored_range(server, output_dir):
+    output_file = os.path.join(output_dir, "no-range.onnx")
+    server.reset(ignore_range=True)
+    sha256 = models.download_file(server.url, output_file, num_workers=4)
+    assert read(output_file) == server.content
+    assert sha256 == server.sha256
+    assert server.served_ranges == []
+    assert not os.path.exists(output_file + ".part")
+    assert not os.path.exists(output_file + ".part.json")
+
+
+def check_cached(server, output_dir):
+    output_file = os.path.join(output_dir, "cached.onnx")
+    models.download_file(server.url, output_file, num_workers=4)
+    # A cached file is used without asking the host, even when it is down
+    server.reset(offline=True)
+    assert models.is_cached(output_file, server.url)
+    assert server.num_requests == 0
+    assert models.is_cached(output_file, server.url, refresh=True)
+    # When asked to refresh, a changed remote file is downloaded again
+    server.reset(advertised_sha256="0" * 64)
+    assert not models.is_cached(output_file, server.url, refresh=True)
+    server.reset()
+    assert models.is_cached(output_file, server.url, refresh=True)
+    # So is a cached file that doesn't match its own hash
+    with open(output_file, "r+b") as file:
+        file.write(b"corrupted")
+    assert models.is_cached(output_file, server.url)
+    assert not models.is_cached(output_file, server.url, refresh=True)
+
+
+def main():
+    models.RANGE_SIZE = RANGE_SIZE
+    server = StandInServer(os.urandom(FILE_SIZE))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    checks = (check_parallel_download, check_resume, check_hash_mismatch, check_ignored_range, check_cached)
+    try:
+        with tempfile.TemporaryDirectory() as output_dir:
+            for check in checks:
+                server.reset()
+                check(server, output_dir)
+                print(f"ok: {check.__name__}")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
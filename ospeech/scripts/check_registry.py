@@ -0,0 +1,118 @@
+"""
+Check `ospeech.registry.ModelRegistry` on tiny stand-in voices: least recently used voices are evicted
+first to stay under the memory budget, voices with identical text processor configs share one
+`TextProcessor`, and a voice that fails to load leaves no load lock behind.
+
+The stand-in voices are built with the `onnx` package (installed along with optispeech).
+
+Usage: python scripts/check_registry.py  (from the `ospeech` directory)
+"""
+
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+import onnx
+import onnxruntime
+from onnx import TensorProto, helper, numpy_helper
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from ospeech.registry import ModelRegistry
+
+TEXT_PROCESSOR = dict(tokenizer="ipa", add_blank=True, add_bos_eos=True, normalize_text=True, languages=["en-us"])
+
+
+def make_voice(model_dir, voice_id, num_weights, text_processor=TEXT_PROCESSOR):
+    """Write an identity model padded with `num_weights` float weights, with the metadata of an exported voice."""
+    weights = numpy_helper.from_array(np.zeros(num_weights, dtype=np.float32), name="weights")
+    graph = helper.make_graph(
+        [helper.make_node("Identity", ["x"], ["y"])],
+        voice_id,
+        [helper.make_tensor_value_info("x", TensorProto.FLOAT, [None])],
+        [helper.make_tensor_value_info("y", TensorProto.FLOAT, [None])],
+        initializer=[weights],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)])
+    model.ir_version = 8
+    infer_params = dict(
+        name=voice_id,
+        sample_rate=22050,
+        inference_args=dict(d_factor=1.0, p_factor=1.0, e_factor=1.0),
+        text_processor=text_processor,
+        speakers=[],
+        languages=text_processor["languages"],
+    )
+    helper.set_model_props(model, {"inference": json.dumps(infer_params)})
+    onnx_path = os.path.join(model_dir, f"{voice_id}.onnx")
+    onnx.save(model, onnx_path)
+    return os.path.getsize(onnx_path)
+
+
+def check_lru_eviction(model_dir):
+    sizes = {voice_id: make_voice(model_dir, voice_id, 1000) for voice_id in "abcd"}
+    # Twice as large as the others
+    sizes["bb"] = make_voice(model_dir, "bb", 2000)
+    # Room for three of the smaller voices
+    registry = ModelRegistry(model_dir, memory_budget=sizes["a"] + sizes["b"] + sizes["c"])
+    for voice_id in "abc":
+        registry.get(voice_id)
+    assert list(registry._entries) == list("abc")
+    # `a` becomes the most recently used, so `b` is the first to go
+    registry.get("a")
+    registry.get("d")
+    assert list(registry._entries) == list("cad"), list(registry._entries)
+    assert registry.metrics.resident_bytes == sizes["c"] + sizes["a"] + sizes["d"] <= registry.memory_budget
+    # Evicting `c` alone doesn't free enough room for the larger voice
+    registry.get("bb")
+    assert list(registry._entries) == ["d", "bb"], list(registry._entries)
+    assert registry.metrics.resident_bytes == sizes["d"] + sizes["bb"] <= registry.memory_budget
+    assert registry.metrics.evictions == 3
+    assert registry.metrics.hits == 1 and registry.metrics.misses == registry.metrics.loads == 5
+    # A voice larger than the budget is still kept while it is in use
+    registry.memory_budget = 1
+    registry.get("a")
+    assert list(registry._entries) == ["a"]
+    assert registry.metrics.resident_voices == 1
+
+
+def check_shared_text_processors(model_dir):
+    make_voice(model_dir, "shared-1", 10)
+    make_voice(model_dir, "shared-2", 10)
+    make_voice(model_dir, "other", 10, text_processor={**TEXT_PROCESSOR, "add_blank": False})
+    registry = ModelRegistry(model_dir, memory_budget=1 << 30)
+    shared_1, shared_2, other = (registry.get(voice_id) for voice_id in ("shared-1", "shared-2", "other"))
+    assert shared_1.text_processor is shared_2.text_processor
+    assert other.text_processor is not shared_1.text_processor
+    assert len(registry._text_processors) == 2
+
+
+def check_failed_loads(model_dir):
+    with open(os.path.join(model_dir, "corrupt.onnx"), "wb") as file:
+        file.write(b"not an onnx model")
+    registry = ModelRegistry(model_dir, memory_budget=1 << 30)
+    for voice_id in ("missing", "corrupt"):
+        try:
+            registry.get(voice_id)
+        except Exception:
+            pass
+        else:
+            raise AssertionError(f"Loading `{voice_id}` did not fail")
+        assert voice_id not in registry
+    assert registry._load_locks == {}, registry._load_locks
+
+
+def main():
+    # The padding weights are unused, which onnxruntime warns about
+    onnxruntime.set_default_logger_severity(3)
+    checks = (check_lru_eviction, check_shared_text_processors, check_failed_loads)
+    for check in checks:
+        with tempfile.TemporaryDirectory() as model_dir:
+            check(model_dir)
+        print(f"ok: {check.__name__}")
+
+
+if __name__ == "__main__":
+    main()
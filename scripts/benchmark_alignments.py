@@ -0,0 +1,353 @@
+"""
+Benchmark the alignment helpers used by the generator during training
+against their previous (per batch item) implementations.
+
+The inputs are random, with lengths drawn around typical utterance lengths.
+"""
+
+import os
+import sys
+
+import rootutils
+
+root_path = rootutils.setup_root(search_from=os.getcwd(), indicator=".project-root")
+sys.path.append(os.fspath(root_path))
+
+import argparse
+from time import perf_counter
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from numba import jit
+from scipy.stats import betabinom
+
+from optispeech.model.generator.alignments import (
+    AlignmentModule,
+    _monotonic_alignment_search,
+    average_by_duration,
+    viterbi_decode,
+)
+from optispeech.model.generator.loss import ForwardSumLoss
+
+
+def viterbi_decode_reference(log_p_attn, text_lengths, feats_lengths):
+    """Previous implementation of `viterbi_decode` (one host round-trip per batch item)."""
+    B = log_p_attn.size(0)
+    T_text = log_p_attn.size(2)
+    device = log_p_attn.device
+
+    bin_loss = 0
+    ds = torch.zeros((B, T_text), device=device)
+    for b in range(B):
+        cur_log_p_attn = log_p_attn[b, : feats_lengths[b], : text_lengths[b]]
+        viterbi = _monotonic_alignment_search(cur_log_p_attn.detach().float().cpu().numpy())
+        _ds = np.bincount(viterbi)
+        ds[b, : len(_ds)] = torch.from_numpy(_ds).to(device)
+
+        t_idx = torch.arange(feats_lengths[b])
+        bin_loss = bin_loss - cur_log_p_attn[t_idx, viterbi].mean()
+    bin_loss = bin_loss / B
+    return ds, bin_loss
+
+
+@jit(nopython=True)
+def _average_by_duration_reference(ds, xs, text_lengths, feats_lengths):
+    B = ds.shape[0]
+    xs_avg = np.zeros_like(ds)
+    ds = ds.astype(np.int32)
+    for b in range(B):
+        t_text = text_lengths[b]
+        t_feats = feats_lengths[b]
+        d = ds[b, :t_text]
+        d_cumsum = d.cumsum()
+        d_cumsum = [0] + list(d_cumsum)
+        x = xs[b, :t_feats]
+        for n, (start, end) in enumerate(zip(d_cumsum[:-1], d_cumsum[1:])):
+            if len(x[start:end]) != 0:
+                xs_avg[b, n] = x[start:end].mean()
+            else:
+                xs_avg[b, n] = 0
+    return xs_avg
+
+
+def average_by_duration_reference(ds, xs, text_lengths, feats_lengths):
+    """Previous implementation of `average_by_duration` (numba, on the host)."""
+    device = ds.device
+    args = [ds, xs, text_lengths, feats_lengths]
+    args = [arg.detach().float().cpu().numpy() for arg in args]
+    xs_avg = _average_by_duration_reference(*args)
+    xs_avg = torch.from_numpy(xs_avg).to(device)
+    return xs_avg
+
+
+class PriorReference:
+    """Previous implementation of `AlignmentModule._generate_prior` (unbounded per-item cache)."""
+
+    def __init__(self):
+        self._cache = {}
+
+    def cache_bytes(self):
+        return sum(prob.nbytes for prob in self._cache.values())
+
+    def __call__(self, text_lengths, feats_lengths, w=1):
+        B = len(text_lengths)
+        T_text = text_lengths.max()
+        T_feats = feats_lengths.max()
+
+        bb_prior = torch.full((B, T_feats, T_text), fill_value=-np.inf)
+        for bidx in range(B):
+            T = feats_lengths[bidx].item()
+            N = text_lengths[bidx].item()
+
+            key = str(T) + "," + str(N)
+            if key in self._cache:
+                prob = self._cache[key]
+            else:
+                alpha = w * np.arange(1, T + 1, dtype=float)  # (T,)
+                beta = w * np.array([T - t + 1 for t in alpha])
+                k = np.arange(N)
+                batched_k = k[..., None]  # (N,1)
+                prob = betabinom.logpmf(batched_k, N, alpha, beta)  # (N,T)
+                self._cache[key] = prob
+
+            prob = torch.from_numpy(prob).transpose(0, 1)  # -> (T,N)
+            bb_prior[bidx, :T, :N] = prob
+
+        return bb_prior.to(text_lengths.device)
+
+
+def pairwise_distance_reference(feats, text):
+    """Previous distance computation of `AlignmentModule.forward`."""
+    dist = feats.unsqueeze(2) - text.unsqueeze(1)
+    return torch.norm(dist, p=2, dim=3)
+
+
+def forwardsum_loss_reference(log_p_attn, ilens, olens, blank_prob=np.e**-1):
+    """Previous implementation of `ForwardSumLoss.forward` (one `ctc_loss` call per batch item)."""
+    B = log_p_attn.size(0)
+    log_p_attn_pd = F.pad(log_p_attn, (1, 0, 0, 0, 0, 0), value=np.log(blank_prob))
+    loss = 0
+    for bidx in range(B):
+        target_seq = torch.arange(1, ilens[bidx] + 1).unsqueeze(0)
+        cur_log_p_attn_pd = log_p_attn_pd[bidx, : olens[bidx], : ilens[bidx] + 1].unsqueeze(1)
+        cur_log_p_attn_pd = F.log_softmax(cur_log_p_attn_pd, dim=-1)
+        loss += F.ctc_loss(
+            log_probs=cur_log_p_attn_pd,
+            targets=target_seq,
+            input_lengths=olens[bidx : bidx + 1],
+            target_lengths=ilens[bidx : bidx + 1],
+            zero_infinity=True,
+        )
+    loss = loss / B
+    return loss
+
+
+def make_batch(batch_size, max_text_length, frames_per_token, device):
+    text_lengths = torch.randint(max_text_length // 2, max_text_length + 1, (batch_size,))
+    text_lengths[0] = max_text_length
+    feats_lengths = text_lengths * frames_per_token + torch.randint(0, frames_per_token, (batch_size,))
+    scores = torch.randn(batch_size, feats_lengths.max(), max_text_length)
+    text_mask = torch.arange(max_text_length).unsqueeze(0) >= text_lengths.unsqueeze(1)
+    scores = scores.masked_fill(text_mask.unsqueeze(1), -np.inf)
+    log_p_attn = F.log_softmax(scores, dim=-1)
+    return log_p_attn.to(device), text_lengths.to(device), feats_lengths.to(device)
+
+
+def timeit(fn, num_runs, device):
+    fn()  # warmup (and numba compilation)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    t0 = perf_counter()
+    for __ in range(num_runs):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (perf_counter() - t0) * 1000 / num_runs
+
+
+def time_once(fn, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    t0 = perf_counter()
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (perf_counter() - t0) * 1000
+
+
+def benchmark_viterbi_decode(batch_size, max_text_length, frames_per_token, num_runs, device):
+    log_p_attn, text_lengths, feats_lengths = make_batch(batch_size, max_text_length, frames_per_token, device)
+    ds_ref, bin_loss_ref = viterbi_decode_reference(log_p_attn, text_lengths, feats_lengths)
+    ds, bin_loss = viterbi_decode(log_p_attn, text_lengths, feats_lengths)
+    assert torch.equal(ds, ds_ref), "Durations differ from the reference implementation"
+    assert torch.allclose(bin_loss, bin_loss_ref), "Binarization loss differs from the reference implementation"
+    ref_ms = timeit(lambda: viterbi_decode_reference(log_p_attn, text_lengths, feats_lengths), num_runs, device)
+    new_ms = timeit(lambda: viterbi_decode(log_p_attn, text_lengths, feats_lengths), num_runs, device)
+    return ref_ms, new_ms
+
+
+def benchmark_average_by_duration(batch_size, max_text_length, frames_per_token, num_runs, device):
+    log_p_attn, text_lengths, feats_lengths = make_batch(batch_size, max_text_length, frames_per_token, device)
+    ds, __ = viterbi_decode(log_p_attn, text_lengths, feats_lengths)
+    pitches = torch.rand(batch_size, log_p_attn.size(1), device=device) * 300 + 80
+    energies = torch.rand(batch_size, log_p_attn.size(1), device=device) * 10
+
+    def reference():
+        # Called once per feature, as the generator used to
+        pitch_avg = average_by_duration_reference(ds, pitches.unsqueeze(-1), text_lengths, feats_lengths)
+        energy_avg = average_by_duration_reference(ds, energies.unsqueeze(-1), text_lengths, feats_lengths)
+        return pitch_avg, energy_avg
+
+    def fused():
+        return average_by_duration(ds, torch.stack([pitches, energies], dim=-1), text_lengths, feats_lengths).unbind(-1)
+
+    for avg_ref, avg in zip(reference(), fused()):
+        # The reference sums sequentially in float32, so allow for float32 rounding
+        assert torch.allclose(avg, avg_ref, rtol=1e-6, atol=0), "Averages differ from the reference implementation"
+        assert torch.equal(avg == 0, avg_ref == 0), "Empty tokens differ from the reference implementation"
+    return timeit(reference, num_runs, device), timeit(fused, num_runs, device)
+
+
+def benchmark_prior(batch_size, max_text_length, frames_per_token, num_runs, device, dataset_size=2000):
+    # Draw every batch from a fixed pool of utterances, as during training
+    pool_text_lengths = torch.randint(max_text_length // 4, max_text_length + 1, (dataset_size,))
+    pool_feats_lengths = pool_text_lengths * frames_per_token + torch.randint(0, frames_per_token, (dataset_size,))
+    batches = []
+    for __ in range(num_runs):
+        idx = torch.randint(0, dataset_size, (batch_size,))
+        batches.append((pool_text_lengths[idx].to(device), pool_feats_lengths[idx].to(device)))
+
+    reference = PriorReference()
+    alignment_module = AlignmentModule(adim=1, odim=1).to(device)
+    text_lengths, feats_lengths = batches[0]
+    prior_ref = reference(text_lengths, feats_lengths).float()
+    prior = alignment_module._generate_prior(text_lengths, feats_lengths)
+    assert torch.allclose(prior, prior_ref, rtol=1e-5, atol=0, equal_nan=True), "Prior differs from the reference"
+
+    # A single pass over the batches: a warmup pass would fill the caches
+    ref_ms = time_once(lambda: [reference(*batch) for batch in batches], device) / num_runs
+    new_ms = time_once(lambda: [alignment_module._generate_prior(*batch) for batch in batches], device) / num_runs
+    ref_mb = reference.cache_bytes() / 1024**2
+    new_mb = alignment_module._cache_bytes / 1024**2
+    return ref_ms, new_ms, f"cache after {num_runs} steps: {ref_mb:.1f} MB -> {new_mb:.1f} MB"
+
+
+def distance_step(alignment_module, distance_fn, text, feats, text_lengths, feats_lengths):
+    """Forward and backward of `AlignmentModule` with the given distance function.
+
+    Returns the bytes of all tensors saved for backward (the activation memory of the step).
+    """
+    saved_bytes = 0
+    saved_storages = set()
+
+    def pack(tensor):
+        nonlocal saved_bytes
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in saved_storages:
+            saved_storages.add(storage.data_ptr())
+            saved_bytes += storage.nbytes()
+        return tensor
+
+    original_cdist = torch.cdist
+    torch.cdist = lambda x1, x2, p=2.0: distance_fn(x1, x2)
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            log_p_attn = alignment_module(text, feats, text_lengths, feats_lengths)
+        log_p_attn.masked_fill(torch.isinf(log_p_attn), 0).sum().backward()
+    finally:
+        torch.cdist = original_cdist
+    return saved_bytes
+
+
+def benchmark_distance(batch_size, max_text_length, frames_per_token, num_runs, device, dim=256, n_feats=80):
+    __, text_lengths, feats_lengths = make_batch(batch_size, max_text_length, frames_per_token, device)
+    alignment_module = AlignmentModule(adim=dim, odim=n_feats, cache_prior=False).to(device)
+    text = torch.randn(batch_size, max_text_length, dim, device=device, requires_grad=True)
+    feats = torch.randn(batch_size, feats_lengths.max(), n_feats, device=device)
+
+    def step(distance_fn):
+        alignment_module.zero_grad()
+        text.grad = None
+        return distance_step(alignment_module, distance_fn, text, feats, text_lengths, feats_lengths)
+
+    ref_bytes = step(pairwise_distance_reference)
+    grads_ref = [text.grad.clone()] + [p.grad.clone() for p in alignment_module.parameters()]
+    new_bytes = step(torch.cdist)
+    grads = [text.grad.clone()] + [p.grad.clone() for p in alignment_module.parameters()]
+    for grad, grad_ref in zip(grads, grads_ref):
+        # Float32 rounding, relative to the scale of the gradient
+        max_diff = (grad - grad_ref).abs().max()
+        assert max_diff <= 1e-5 * grad_ref.abs().max(), "Gradients differ from the reference"
+
+    ref_ms = timeit(lambda: step(pairwise_distance_reference), num_runs, device)
+    new_ms = timeit(lambda: step(torch.cdist), num_runs, device)
+    notes = [f"saved activations: {ref_bytes / 1024**2:.0f} MB -> {new_bytes / 1024**2:.0f} MB"]
+    if device.type == "cuda":
+        peaks = []
+        for distance_fn in (pairwise_distance_reference, torch.cdist):
+            torch.cuda.reset_peak_memory_stats(device)
+            step(distance_fn)
+            peaks.append(torch.cuda.max_memory_allocated(device) / 1024**2)
+        notes.append(f"peak CUDA memory: {peaks[0]:.0f} MB -> {peaks[1]:.0f} MB")
+    return ref_ms, new_ms, *notes
+
+
+def benchmark_forwardsum_loss(batch_size, max_text_length, frames_per_token, num_runs, device):
+    log_p_attn, text_lengths, feats_lengths = make_batch(batch_size, max_text_length, frames_per_token, device)
+    forwardsum_loss = ForwardSumLoss()
+
+    def step(loss_fn):
+        inputs = log_p_attn.detach().requires_grad_()
+        loss = loss_fn(inputs, text_lengths, feats_lengths)
+        loss.backward()
+        return loss.detach(), inputs.grad
+
+    loss_ref, grad_ref = step(forwardsum_loss_reference)
+    loss, grad = step(forwardsum_loss)
+    assert torch.allclose(loss, loss_ref, rtol=1e-6), "Loss differs from the reference implementation"
+    assert torch.allclose(grad, grad_ref, rtol=1e-5, atol=1e-7), "Gradients differ from the reference implementation"
+    ref_ms = timeit(lambda: step(forwardsum_loss_reference), num_runs, device)
+    new_ms = timeit(lambda: step(forwardsum_loss), num_runs, device)
+    return ref_ms, new_ms
+
+
+BENCHMARKS = {
+    "viterbi_decode": benchmark_viterbi_decode,
+    "average_by_duration": benchmark_average_by_duration,
+    "prior": benchmark_prior,
+    "distance": benchmark_distance,
+    "forwardsum_loss": benchmark_forwardsum_loss,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the alignment helpers used during training")
+    parser.add_argument("-b", "--benchmarks", nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[8, 16, 32])
+    parser.add_argument("--text-lengths", nargs="+", type=int, default=[64, 128, 256])
+    parser.add_argument("--frames-per-token", type=int, default=4, help="Average number of frames per token")
+    parser.add_argument("-n", "--num-runs", type=int, default=10)
+    parser.add_argument("--cuda", action="store_true", help="Put inputs on the GPU")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device("cuda" if args.cuda else "cpu")
+    for name in args.benchmarks:
+        print(f"\n{name}")
+        header = f"{'batch':>6} | {'T_text':>6} | {'reference (ms)':>15} | {'new (ms)':>10} | {'speedup':>8}"
+        print(header)
+        print("-" * len(header))
+        for batch_size in args.batch_sizes:
+            for max_text_length in args.text_lengths:
+                ref_ms, new_ms, *notes = BENCHMARKS[name](
+                    batch_size, max_text_length, args.frames_per_token, args.num_runs, device
+                )
+                print(
+                    f"{batch_size:>6} | {max_text_length:>6} | {ref_ms:>15.2f} | {new_ms:>10.2f} | {ref_ms / new_ms:>7.2f}x"
+                    + "".join(f" | {note}" for note in notes)
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Time the per-utterance feature extraction of a dataset config, by stage, and check that sharing
+one STFT between the mel spectrogram and the energy gives the same features as computing
+an STFT for each of them. Then time the batched extraction (`FeatureExtractor.extract_batch`),
+and compare its features to the per-utterance ones.
+
+The audio files are only read, nothing is written.
+"""
+
+import os
+import sys
+
+import rootutils
+
+root_path = rootutils.setup_root(search_from=os.getcwd(), indicator=".project-root")
+sys.path.append(os.fspath(root_path))
+
+import argparse
+from pathlib import Path
+from time import perf_counter
+
+import hydra
+import numpy as np
+import torch
+from hydra import compose, initialize
+from tqdm import tqdm
+
+AUDIO_SUFFIXES = (".wav", ".flac", ".mp3", ".ogg")
+
+
+def timed(func, *args, **kwargs):
+    start = perf_counter()
+    retval = func(*args, **kwargs)
+    return retval, perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the feature extraction of a dataset config")
+    parser.add_argument("dataset", type=str, help="dataset config relative to `configs/data/` (without the suffix)")
+    parser.add_argument("audio_dir", type=str, help="directory of audio files (searched recursively)")
+    parser.add_argument("-n", "--num-utterances", type=int, default=None, help="Only look at the first N utterances")
+    parser.add_argument("-b", "--batch-size", type=int, default=16, help="Utterances per batch of `extract_batch`")
+    parser.add_argument("--threads", type=int, default=1, help="Number of torch threads (1 like preprocessing workers)")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    with initialize(version_base="1.3", config_path="../configs/data"):
+        cfg = compose(config_name=args.dataset)
+    feature_extractor = hydra.utils.instantiate(cfg.feature_extractor)
+    feature_extractor.initialize_components()
+    audio_paths = sorted(path for path in Path(args.audio_dir).rglob("*") if path.suffix.lower() in AUDIO_SUFFIXES)
+    audio_paths = audio_paths[: args.num_utterances]
+    if not audio_paths:
+        raise FileNotFoundError(f"No audio files found in {args.audio_dir}")
+
+    # Warm up the cached windows and filterbanks
+    feature_extractor(audio_paths[0])
+
+    timings = dict.fromkeys(("total", "separate STFTs", "shared STFT", "pitch"), 0.0)
+    max_errors = dict(mel=0.0, energy=0.0)
+    num_seconds = 0.0
+    features = []
+    for audio_path in tqdm(audio_paths, desc="Extracting", unit="utterance"):
+        (wav, mel, energy, pitch), elapsed = timed(feature_extractor, audio_path)
+        features.append((wav, mel, energy, pitch))
+        timings["total"] += elapsed
+        num_seconds += len(wav) / feature_extractor.sample_rate
+
+        def separate():
+            mel = feature_extractor.get_mel(wav)
+            return mel, feature_extractor.get_energy(wav, mel.shape[-1])
+
+        def shared():
+            magnitudes = feature_extractor.get_magnitudes(wav)
+            mel = feature_extractor.get_mel(wav, magnitudes=magnitudes)
+            return mel, feature_extractor.get_energy(wav, mel.shape[-1], magnitudes=magnitudes)
+
+        (separate_mel, separate_energy), elapsed = timed(separate)
+        timings["separate STFTs"] += elapsed
+        (shared_mel, shared_energy), elapsed = timed(shared)
+        timings["shared STFT"] += elapsed
+        _, elapsed = timed(feature_extractor.get_pitch, wav, mel.shape[-1])
+        timings["pitch"] += elapsed
+        max_errors["mel"] = max(max_errors["mel"], float(np.abs(separate_mel - shared_mel).max()))
+        max_errors["energy"] = max(max_errors["energy"], float(np.abs(separate_energy - shared_energy).max()))
+
+    batch_features, timings["batched"] = timed(feature_extractor.extract_batch, audio_paths, batch_size=args.batch_size)
+    batch_errors = dict(wav=0.0, mel=0.0, energy=0.0, pitch=0.0)
+    for (item_features, item_batch_features) in zip(features, batch_features):
+        for (name, array, batch_array) in zip(batch_errors, item_features, item_batch_features):
+            if array.shape != batch_array.shape:
+                raise ValueError(f"Batched {name} has shape {batch_array.shape} instead of {array.shape}")
+            batch_errors[name] = max(batch_errors[name], float(np.abs(array - batch_array).max(initial=0.0)))
+
+    num_utterances = len(audio_paths)
+    print(f"\n{num_utterances} utterances, {num_seconds:.1f} seconds of audio, {args.threads} torch thread(s)")
+    header = f"{'stage':>16} | {'ms/utterance':>12} | {'real-time factor':>16}"
+    print(header)
+    print("-" * len(header))
+    for name, seconds in timings.items():
+        print(f"{name:>16} | {1000 * seconds / num_utterances:>12.2f} | {seconds / num_seconds:>16.5f}")
+    speedup = timings["separate STFTs"] / max(timings["shared STFT"], 1e-12)
+    print(f"mel + energy speedup from the shared STFT: {speedup:.2f}x")
+    print(f"max abs difference: mel {max_errors['mel']:.2e}, energy {max_errors['energy']:.2e}")
+    print(f"batched extraction speedup: {timings['total'] / max(timings['batched'], 1e-12):.2f}x")
+    print("max abs difference of the batched features: " + ", ".join(f"{k} {v:.2e}" for k, v in batch_errors.items()))
+    print("(Crepe dithers its pitch, so its batched pitch differs slightly)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Check that segment-local decoding produces the same vocoder segments as decoding the full
+sequence, and compare the generator's training step time and saved activations in both modes.
+
+The inputs are random, with lengths drawn around typical utterance lengths.
+"""
+
+import os
+import sys
+
+import rootutils
+
+root_path = rootutils.setup_root(search_from=os.getcwd(), indicator=".project-root")
+sys.path.append(os.fspath(root_path))
+
+import argparse
+from time import perf_counter
+
+import hydra
+import torch
+from hydra import compose, initialize
+
+WAV_ATOL = 1e-4
+
+
+def build_generator(model_config, data_config, device):
+    with initialize(version_base="1.3", config_path="../configs"):
+        data_cfg = compose(config_name=f"data/{data_config}.yaml").data
+        model_cfg = compose(config_name=f"model/{model_config}.yaml").model
+    feature_extractor = hydra.utils.instantiate(data_cfg.feature_extractor)
+    generator = hydra.utils.instantiate(model_cfg.generator)(
+        dim=model_cfg.dim,
+        feature_extractor=feature_extractor,
+        data_statistics=data_cfg.data_statistics,
+        num_speakers=1,
+        num_languages=1,
+    )
+    return generator.to(device)
+
+
+def make_batch(generator, batch_size, max_text_length, frames_per_token, device):
+    x_lengths = torch.randint(max_text_length // 2, max_text_length + 1, (batch_size,))
+    x_lengths[0] = max_text_length
+    durations = torch.randint(1, 2 * frames_per_token, (batch_size, max_text_length))
+    durations *= torch.arange(max_text_length).unsqueeze(0) < x_lengths.unsqueeze(1)
+    mel_lengths = durations.sum(dim=1)
+    x = torch.randint(1, 100, (batch_size, max_text_length)) * (durations > 0)
+    mel = torch.randn(batch_size, generator.n_feats, mel_lengths.max().item())
+    pitches = torch.randn(batch_size, max_text_length)
+    energies = torch.randn(batch_size, max_text_length)
+    batch = dict(
+        x=x,
+        x_lengths=x_lengths,
+        mel=mel,
+        mel_lengths=mel_lengths,
+        pitches=pitches,
+        energies=energies,
+        sids=None,
+        lids=None,
+        durations=durations,
+    )
+    return {key: value.to(device) if value is not None else None for key, value in batch.items()}
+
+
+def step(generator, batch, segment_local_decoding, seed=None):
+    generator.segment_local_decoding = segment_local_decoding
+    if seed is not None:
+        torch.manual_seed(seed)
+    saved_bytes = 0
+
+    def pack(tensor):
+        nonlocal saved_bytes
+        saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    generator.zero_grad()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        outputs = generator(**batch)
+    (outputs["loss"] + outputs["wav_hat"].square().mean()).backward()
+    return outputs, saved_bytes
+
+
+def timeit(fn, num_runs, device):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    t0 = perf_counter()
+    for __ in range(num_runs):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (perf_counter() - t0) * 1000 / num_runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark segment-local decoding during training")
+    parser.add_argument("-m", "--models", nargs="+", default=["convnext_tts", "lightspeech"])
+    parser.add_argument("-d", "--data-config", type=str, default="hfc_female-en_us")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[8, 16])
+    parser.add_argument("--text-lengths", nargs="+", type=int, default=[64, 128, 256])
+    parser.add_argument("--frames-per-token", type=int, default=4, help="Average number of frames per token")
+    parser.add_argument("-n", "--num-runs", type=int, default=5)
+    parser.add_argument("--cuda", action="store_true", help="Run on the GPU")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device("cuda" if args.cuda else "cpu")
+    failed = False
+    for model_config in args.models:
+        generator = build_generator(model_config, args.data_config, device)
+        print(f"\n{model_config} (decoder receptive field: {generator.decoder.receptive_field} frames)")
+        header = (
+            f"{'batch':>6} | {'T_text':>6} | {'T_feats':>7} | {'max wav diff':>12} | {'full (ms)':>10} | "
+            f"{'local (ms)':>10} | {'speedup':>8} | {'saved activations (MB)':>22}"
+        )
+        print(header)
+        print("-" * len(header))
+        for batch_size in args.batch_sizes:
+            for max_text_length in args.text_lengths:
+                batch = make_batch(generator, batch_size, max_text_length, args.frames_per_token, device)
+                # Parity is checked without dropout, starting from the same random state
+                generator.eval()
+                full_outputs, __ = step(generator, batch, False, seed=0)
+                local_outputs, __ = step(generator, batch, True, seed=0)
+                assert torch.equal(full_outputs["start_idx"], local_outputs["start_idx"])
+                wav_diff = (full_outputs["wav_hat"] - local_outputs["wav_hat"]).abs().max().item()
+                failed = failed or (wav_diff > WAV_ATOL)
+
+                generator.train()
+                __, full_bytes = step(generator, batch, False)
+                __, local_bytes = step(generator, batch, True)
+                full_ms = timeit(lambda: step(generator, batch, False), args.num_runs, device)
+                local_ms = timeit(lambda: step(generator, batch, True), args.num_runs, device)
+                saved = f"{full_bytes / 1024**2:.0f} -> {local_bytes / 1024**2:.0f}"
+                print(
+                    f"{batch_size:>6} | {max_text_length:>6} | {batch['mel_lengths'].max().item():>7} | "
+                    f"{wav_diff:>12.2e} | {full_ms:>10.2f} | {local_ms:>10.2f} | {full_ms / local_ms:>7.2f}x | {saved:>22}"
+                )
+
+    if failed:
+        print("Parity check FAILED")
+        sys.exit(1)
+    print("Parity check passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Measure per-worker memory when serving a model with several worker processes.
+
+Modes:
+    copy     every worker is spawned and reads its own copy of the weights
+    mmap     every worker is spawned and memory-maps the weights (slim checkpoints only)
+    prefork  the model is loaded once, then the workers are forked (see `optispeech.serve`)
+
+PSS (proportional set size) splits shared pages between the processes mapping them,
+so the sum of PSS over workers is the actual memory used by the whole pool.
+"""
+
+import os
+import sys
+
+import rootutils
+
+root_path = rootutils.setup_root(search_from=os.getcwd(), indicator=".project-root")
+sys.path.append(os.fspath(root_path))
+
+import argparse
+import multiprocessing as mp
+
+SENTENCE = "A rainbow is a meteorological phenomenon that is caused by reflection, refraction and dispersion of light."
+MEMORY_FIELDS = ("Rss", "Pss", "Shared_Clean", "Private_Clean", "Private_Dirty")
+MODEL = None
+
+
+def read_memory_stats() -> dict[str, float]:
+    """Memory stats of the current process in MB (Linux only)."""
+    stats = {}
+    with open("/proc/self/smaps_rollup", encoding="utf-8") as file:
+        for line in file:
+            parts = line.split()
+            key = parts[0].rstrip(":")
+            if key in MEMORY_FIELDS:
+                stats[key] = int(parts[1]) / 1024
+    return stats
+
+
+def load(model_path, mode):
+    from optispeech.model import OptiSpeech
+    from optispeech.serve import load_model
+
+    if model_path.endswith(".onnx") or (mode != "copy"):
+        return load_model(model_path)
+    return OptiSpeech.load_from_slim_checkpoint(model_path, map_location="cpu", mmap=False)
+
+
+def worker(model_path, mode, barrier, results):
+    import torch
+
+    from optispeech.serve import synthesise_wav
+
+    global MODEL
+    torch.set_num_threads(1)
+    if MODEL is None:
+        MODEL = load(model_path, mode)
+    # Touch every weight page
+    synthesise_wav(MODEL, dict(text=SENTENCE))
+    # Measure while all workers are alive, otherwise PSS is meaningless
+    barrier.wait()
+    results.put(read_memory_stats())
+    barrier.wait()
+
+
+def run(model_path, mode, num_workers):
+    global MODEL
+    if mode == "prefork":
+        import gc
+
+        ctx = mp.get_context("fork")
+        MODEL = load(model_path, mode)
+        gc.freeze()
+    else:
+        ctx = mp.get_context("spawn")
+    barrier = ctx.Barrier(num_workers)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(model_path, mode, barrier, results)) for __ in range(num_workers)]
+    for proc in procs:
+        proc.start()
+    stats = [results.get() for __ in range(num_workers)]
+    for proc in procs:
+        proc.join()
+    MODEL = None
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-worker memory of multi-process serving")
+    parser.add_argument("model_path", type=str, help="Path to an ONNX model or a slim checkpoint")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Number of worker processes")
+    parser.add_argument("-m", "--modes", nargs="+", default=["copy", "mmap", "prefork"], help="Modes to benchmark")
+    args = parser.parse_args()
+
+    modes = args.modes
+    if args.model_path.endswith(".onnx") and "mmap" in modes:
+        # onnxruntime copies initializers into its own arena
+        print("Skipping `mmap` mode for ONNX models")
+        modes = [m for m in modes if m != "mmap"]
+
+    header = f"{'mode':<8} | " + " | ".join(f"{field + ' (MB)':>18}" for field in MEMORY_FIELDS) + f" | {'pool total (MB)':>16}"
+    print(header)
+    print("-" * len(header))
+    for mode in modes:
+        stats = run(args.model_path, mode, args.workers)
+        means = {field: sum(s[field] for s in stats) / len(stats) for field in MEMORY_FIELDS}
+        pool_total = sum(s["Pss"] for s in stats)
+        print(
+            f"{mode:<8} | "
+            + " | ".join(f"{means[field]:>18.1f}" for field in MEMORY_FIELDS)
+            + f" | {pool_total:>16.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
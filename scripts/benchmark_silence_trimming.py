@@ -0,0 +1,125 @@
+"""
+Compare the silence trimming of `trim_audio` (one decode, batched VAD) with the previous implementation
+(decoding each file twice, and running the VAD model once per chunk), in speed and output.
+
+The previous implementation carried the VAD state over from one file to the next. Here, it starts
+each file from a fresh state (like `trim_audio` does), so that both trim the same ranges.
+The audio files are only read, nothing is written.
+"""
+
+import os
+import sys
+
+import rootutils
+
+root_path = rootutils.setup_root(search_from=os.getcwd(), indicator=".project-root")
+sys.path.append(os.fspath(root_path))
+
+import argparse
+from pathlib import Path
+from time import perf_counter
+
+import librosa
+import numpy as np
+
+from optispeech.dataset.feature_extractors.norm_audio import (
+    VAD_SAMPLE_RATE,
+    decode_audio,
+    make_silence_detector,
+    trim_audio,
+    trim_audio_batch,
+)
+from optispeech.dataset.feature_extractors.norm_audio.trim import trim_silence_batch
+
+AUDIO_SUFFIXES = (".wav", ".flac", ".mp3", ".ogg")
+
+
+def legacy_trim_silence(audio_array, detector, threshold, samples_per_chunk, keep_chunks_before, keep_chunks_after):
+    offset_sec, duration_sec = 0.0, None
+    first_chunk = last_chunk = None
+    chunk, audio_array = audio_array[:samples_per_chunk], audio_array[samples_per_chunk:]
+    chunk_idx = 0
+    detector.reset_states()
+    while len(audio_array) > 0:
+        if detector(chunk, sample_rate=VAD_SAMPLE_RATE) >= threshold:
+            if first_chunk is None:
+                first_chunk = chunk_idx
+            else:
+                last_chunk = chunk_idx
+        chunk, audio_array = audio_array[:samples_per_chunk], audio_array[samples_per_chunk:]
+        chunk_idx += 1
+    if (first_chunk is not None) and (last_chunk is not None):
+        first_chunk = max(0, first_chunk - keep_chunks_before)
+        last_chunk = min(chunk_idx, last_chunk + keep_chunks_after)
+        offset_sec = first_chunk * samples_per_chunk / VAD_SAMPLE_RATE
+        duration_sec = (last_chunk + 1) * samples_per_chunk / VAD_SAMPLE_RATE - offset_sec
+    return offset_sec, duration_sec
+
+
+def legacy_trim_audio(audio_path, detector, sample_rate, trim_args):
+    audio_16khz, __ = librosa.load(path=audio_path, sr=VAD_SAMPLE_RATE)
+    offset_sec, duration_sec = legacy_trim_silence(audio_16khz, detector, **trim_args)
+    audio, __ = librosa.load(path=audio_path, sr=sample_rate, offset=offset_sec, duration=duration_sec)
+    return audio, (offset_sec, duration_sec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark silence trimming against the previous implementation")
+    parser.add_argument("audio_dir", type=str, help="directory of audio files (searched recursively)")
+    parser.add_argument("-n", "--num-utterances", type=int, default=None, help="Only look at the first N utterances")
+    parser.add_argument("-s", "--sample-rate", type=int, default=22050, help="Target sample rate")
+    parser.add_argument("-b", "--batch-size", type=int, default=16, help="Files per call of `trim_audio_batch`")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Speech probability threshold")
+    args = parser.parse_args()
+
+    audio_paths = sorted(path for path in Path(args.audio_dir).rglob("*") if path.suffix.lower() in AUDIO_SUFFIXES)
+    audio_paths = audio_paths[: args.num_utterances]
+    if not audio_paths:
+        raise FileNotFoundError(f"No audio files found in {args.audio_dir}")
+    detector = make_silence_detector()
+    trim_args = dict(threshold=args.threshold, samples_per_chunk=480, keep_chunks_before=2, keep_chunks_after=2)
+    audio_trim_args = {f"silence_{name}": value for (name, value) in trim_args.items()}
+
+    start = perf_counter()
+    legacy = [legacy_trim_audio(audio_path, detector, args.sample_rate, trim_args) for audio_path in audio_paths]
+    legacy_time = perf_counter() - start
+    start = perf_counter()
+    single = [trim_audio(audio_path, detector, args.sample_rate, **audio_trim_args)[0] for audio_path in audio_paths]
+    single_time = perf_counter() - start
+    start = perf_counter()
+    batched = []
+    for i in range(0, len(audio_paths), args.batch_size):
+        trimmed = trim_audio_batch(audio_paths[i : i + args.batch_size], detector, args.sample_rate, **audio_trim_args)
+        batched.extend(wav for (wav, __sr) in trimmed)
+    batched_time = perf_counter() - start
+
+    # Trim ranges of the batched VAD, to compare with the per-chunk ones
+    audios_16khz = [decode_audio(audio_path, args.sample_rate)[0] for audio_path in audio_paths]
+    trim_ranges = trim_silence_batch(audios_16khz, detector, sample_rate=VAD_SAMPLE_RATE, **trim_args)
+    num_different_ranges = sum(
+        not np.allclose(np.array(legacy_range, dtype=float), np.array(trim_range, dtype=float), equal_nan=True)
+        for ((__, legacy_range), trim_range) in zip(legacy, trim_ranges)
+    )
+    max_length_diff = max_abs_diff = 0
+    for ((legacy_audio, __), audio, batched_audio) in zip(legacy, single, batched):
+        if not np.array_equal(audio, batched_audio):
+            raise ValueError("`trim_audio` and `trim_audio_batch` trimmed a file differently")
+        length = min(len(audio), len(legacy_audio))
+        max_length_diff = max(max_length_diff, abs(len(audio) - len(legacy_audio)))
+        max_abs_diff = max(max_abs_diff, float(np.abs(audio[:length] - legacy_audio[:length]).max(initial=0.0)))
+
+    num_seconds = sum(len(audio) for audio in single) / args.sample_rate
+    print(f"\n{len(audio_paths)} files, {num_seconds:.1f} seconds of trimmed audio")
+    header = f"{'implementation':>24} | {'ms/file':>9} | {'speedup':>7}"
+    print(header)
+    print("-" * len(header))
+    for (name, seconds) in (("previous", legacy_time), ("trim_audio", single_time), ("trim_audio_batch", batched_time)):
+        print(f"{name:>24} | {1000 * seconds / len(audio_paths):>9.2f} | {legacy_time / seconds:>6.2f}x")
+    print(f"files with a different trim range: {num_different_ranges}")
+    print(f"max length difference: {max_length_diff} samples, max abs difference: {max_abs_diff:.2e}")
+    print("(the previous implementation resampled the trimmed segment, `trim_audio` trims the resampled file:")
+    print(" when they aren't at the target sample rate, trimmed files can start up to a sample apart)")
+
+
+if __name__ == "__main__":
+    main()
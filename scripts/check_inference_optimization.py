@@ -0,0 +1,76 @@
+"""
+Check that `OptiSpeechGenerator.optimize_for_inference` keeps outputs unchanged, and measure its speedup.
+"""
+
+import os
+import sys
+
+import rootutils
+
+root_path = rootutils.setup_root(search_from=os.getcwd(), indicator=".project-root")
+sys.path.append(os.fspath(root_path))
+
+import argparse
+import copy
+from time import perf_counter
+
+import torch
+
+from optispeech.model import OptiSpeech
+
+SENTENCES = [
+    "A rainbow is a meteorological phenomenon that is caused by reflection, refraction and dispersion of light.",
+    "It takes the form of a multicoloured circular arc.",
+    "Rainbows caused by sunlight always appear in the section of sky directly opposite the Sun.",
+]
+WAV_ATOL = 1e-4
+
+
+def load(checkpoint_path):
+    if checkpoint_path.endswith(".ckpt"):
+        model = OptiSpeech.load_from_checkpoint(checkpoint_path, map_location="cpu")
+        del model.discriminator
+        del model.generator.alignment_module
+        return model.eval()
+    return OptiSpeech.load_from_slim_checkpoint(checkpoint_path, map_location="cpu", mmap=False)
+
+
+def timeit(model, inputs, num_runs):
+    model.synthesise(inputs)
+    t0 = perf_counter()
+    for __ in range(num_runs):
+        model.synthesise(inputs)
+    return (perf_counter() - t0) * 1000 / num_runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check output parity of the inference optimization pass")
+    parser.add_argument("checkpoint_path", type=str, help="Path to a lightning checkpoint or a slim checkpoint")
+    parser.add_argument("-n", "--num-runs", type=int, default=10, help="Number of timed runs")
+    args = parser.parse_args()
+
+    model = load(args.checkpoint_path)
+    optimized_model = copy.deepcopy(model)
+    optimized_model.generator.optimize_for_inference()
+
+    inputs = model.prepare_input(" ".join(SENTENCES), split_sentences=True)
+    outputs = model.synthesise(inputs)
+    optimized_outputs = optimized_model.synthesise(inputs)
+
+    durations_equal = torch.equal(outputs.durations, optimized_outputs.durations)
+    wav_diff = (outputs.wav - optimized_outputs.wav).abs().max().item()
+    print(f"durations equal: {durations_equal}")
+    print(f"max wav difference: {wav_diff:.3e}")
+
+    base_ms = timeit(model, inputs, args.num_runs)
+    optimized_ms = timeit(optimized_model, inputs, args.num_runs)
+    print(f"latency: {base_ms:.2f} ms -> {optimized_ms:.2f} ms ({base_ms / optimized_ms:.2f}x)")
+
+    if not durations_equal or wav_diff > WAV_ATOL:
+        print("Parity check FAILED")
+        sys.exit(1)
+    print("Parity check passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -67,10 +67,9 @@ def ensure_model_loaded(load_latest_ckpt):
             MODEL = OptiSpeech.load_from_checkpoint(MODEL_PATH, map_location="cpu")
             MODEL.to(DEVICE)
             MODEL.eval()
-            # For information purposes
-            data = torch.load(MODEL_PATH, map_location="cpu")
-            CKPT_EPOCH = data["epoch"]
-            CKPT_GSTEP = data["global_step"]
+            # For information purposes (recorded by `on_load_checkpoint`)
+            CKPT_EPOCH = MODEL.ckpt_loaded_epoch
+            CKPT_GSTEP = MODEL.ckpt_loaded_global_step
             # Run name
             config_path = Path(CKPT_PATH).parent.parent.joinpath(".hydra").joinpath("config.yaml")
             if config_path.is_file():
@@ -0,0 +1,127 @@
+"""
+Report the size reduction of storing a preprocessed dataset in `compact` precision
+(int16 wav, float16 mel/pitch/energy), and how much it changes the data statistics.
+
+The utterances of the dataset's training filelist are converted in memory, nothing is written.
+"""
+
+import os
+import sys
+
+import rootutils
+
+root_path = rootutils.setup_root(search_from=os.getcwd(), indicator=".project-root")
+sys.path.append(os.fspath(root_path))
+
+import argparse
+
+import hydra
+import numpy as np
+from hydra import compose, initialize
+from tqdm import tqdm
+
+from optispeech.dataset.manifest import ARRAY_NAMES
+from optispeech.dataset.storage import from_storage, to_storage_precision
+from optispeech.dataset.text_wav_datamodule import TextWavDataset
+
+
+class StatsAccumulator:
+    """Same statistics as `optispeech.tools.generate_data_statistics`, in float64."""
+
+    def __init__(self, n_feats, uv_threshold):
+        self.n_feats = n_feats
+        self.uv_threshold = uv_threshold
+        self.sums = dict.fromkeys(("mel", "mel_sq", "pitch", "pitch_sq", "energy", "energy_sq", "frames"), 0.0)
+        self.pitch_min = self.energy_min = float("inf")
+        self.pitch_max = self.energy_max = -float("inf")
+
+    def update(self, arrays):
+        mel = arrays["mel"].astype(np.float64)
+        pitch = arrays["pitch"].astype(np.float64)
+        pitch[pitch <= self.uv_threshold] = 0.0
+        energy = arrays["energy"].astype(np.float64)
+        self.sums["mel"] += mel.sum()
+        self.sums["mel_sq"] += np.square(mel).sum()
+        self.sums["pitch"] += pitch.sum()
+        self.sums["pitch_sq"] += np.square(pitch).sum()
+        self.sums["energy"] += energy.sum()
+        self.sums["energy_sq"] += np.square(energy).sum()
+        self.sums["frames"] += mel.shape[-1]
+        self.pitch_min, self.pitch_max = min(self.pitch_min, pitch.min()), max(self.pitch_max, pitch.max())
+        self.energy_min, self.energy_max = min(self.energy_min, energy.min()), max(self.energy_max, energy.max())
+
+    def stats(self):
+        frames = self.sums["frames"]
+        stats = dict(pitch_min=self.pitch_min, pitch_max=self.pitch_max)
+        stats["pitch_mean"] = self.sums["pitch"] / frames
+        stats["pitch_std"] = np.sqrt(self.sums["pitch_sq"] / frames - stats["pitch_mean"] ** 2)
+        stats.update(energy_min=self.energy_min, energy_max=self.energy_max)
+        stats["energy_mean"] = self.sums["energy"] / frames
+        stats["energy_std"] = np.sqrt(self.sums["energy_sq"] / frames - stats["energy_mean"] ** 2)
+        stats["mel_mean"] = self.sums["mel"] / (frames * self.n_feats)
+        stats["mel_std"] = np.sqrt(self.sums["mel_sq"] / (frames * self.n_feats) - stats["mel_mean"] ** 2)
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the effect of compact storage precision on a dataset")
+    parser.add_argument("dataset", type=str, help="dataset config relative to `configs/data/` (without the suffix)")
+    parser.add_argument("-f", "--filelist", type=str, default=None, help="Filelist to use instead of the training one")
+    parser.add_argument("-n", "--num-utterances", type=int, default=None, help="Only look at the first N utterances")
+    args = parser.parse_args()
+
+    with initialize(version_base="1.3", config_path="../configs/data"):
+        cfg = compose(config_name=args.dataset)
+    feature_extractor = hydra.utils.instantiate(cfg.feature_extractor)
+    filelist_path = args.filelist or os.path.join(root_path, cfg.train_filelist_path)
+    dataset = TextWavDataset(
+        num_speakers=cfg.num_speakers,
+        filelist_path=filelist_path,
+        text_processor=None,
+        feature_extractor=feature_extractor,
+    )
+    file_paths = sorted(dataset.file_paths)[: args.num_utterances]
+
+    reference = StatsAccumulator(feature_extractor.n_feats, dataset.uv_threshold)
+    compact = StatsAccumulator(feature_extractor.n_feats, dataset.uv_threshold)
+    sizes = {"float32": dict.fromkeys(ARRAY_NAMES, 0), "compact": dict.fromkeys(ARRAY_NAMES, 0)}
+    max_errors = dict.fromkeys(ARRAY_NAMES, 0.0)
+    signal_power = noise_power = 0.0
+    for filepath in tqdm(file_paths, desc="Converting", unit="utterance"):
+        with np.load(filepath + ".npz", allow_pickle=False) as data:
+            arrays = {name: from_storage(data[name]) for name in ARRAY_NAMES}
+        stored = to_storage_precision(arrays, "compact")
+        restored = {name: from_storage(array) for name, array in stored.items()}
+        for name in ARRAY_NAMES:
+            sizes["float32"][name] += arrays[name].astype(np.float32).nbytes
+            sizes["compact"][name] += stored[name].nbytes
+            max_errors[name] = max(max_errors[name], float(np.abs(arrays[name] - restored[name]).max(initial=0.0)))
+        signal_power += np.square(arrays["wav"].astype(np.float64)).sum()
+        noise_power += np.square((arrays["wav"] - restored["wav"]).astype(np.float64)).sum()
+        reference.update(arrays)
+        compact.update(restored)
+
+    print(f"\nStorage size of {len(file_paths)} utterances (MiB)")
+    header = f"{'array':>8} | {'float32':>10} | {'compact':>10} | {'ratio':>6} | {'max abs error':>13}"
+    print(header)
+    print("-" * len(header))
+    for name in ARRAY_NAMES:
+        size32, size16 = sizes["float32"][name] / 1024**2, sizes["compact"][name] / 1024**2
+        print(f"{name:>8} | {size32:>10.2f} | {size16:>10.2f} | {size32 / size16:>5.2f}x | {max_errors[name]:>13.2e}")
+    total32, total16 = sum(sizes["float32"].values()) / 1024**2, sum(sizes["compact"].values()) / 1024**2
+    print(f"{'total':>8} | {total32:>10.2f} | {total16:>10.2f} | {total32 / total16:>5.2f}x |")
+    print(f"wav quantization SNR: {10 * np.log10(signal_power / max(noise_power, 1e-20)):.1f} dB")
+
+    print("\nData statistics")
+    header = f"{'statistic':>12} | {'float32':>12} | {'compact':>12} | {'rel. change':>11}"
+    print(header)
+    print("-" * len(header))
+    compact_stats = compact.stats()
+    for key, value in reference.stats().items():
+        compact_value = compact_stats[key]
+        change = abs(compact_value - value) / max(abs(value), 1e-12)
+        print(f"{key:>12} | {value:>12.6f} | {compact_value:>12.6f} | {change:>11.2e}")
+
+
+if __name__ == "__main__":
+    main()